@@ -1,18 +1,52 @@
 import base64
+import functools
+import hashlib
+from collections import defaultdict
 from datetime import datetime
 import json
 import os
+import time
+import urllib
 import webapp2
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext.ndb.tasklets import Future
 from webapp2_extras import routes
 from google.appengine.ext import ndb
-from models import Campaign, Platform
+from google.appengine.ext.deferred import deferred
+from audit import get_last_audit
+from cache import (get_cached_response, invalidate_responses, invalidate_routing, negative_cache, routing_cache,
+                   set_cached_response)
+from counters import (COUNTER_BACKENDS, get_counter_shards, get_counters_async, get_platform_total,
+                      get_platform_uniques, purge_counters_async, recompute_platform_total)
+from export import (EXPORT_CONTENT_TYPES, EXPORT_FORMATS, export_batches, format_header, format_rows, read_export,
+                    start_export)
+from filters import get_filtered_counts, platform_filter
+from limits import reset_click_cap, validate_limits
+from metrics import MetricsMiddleware, metrics
+from models import BUCKET_RESOLUTIONS, Campaign, CampaignExport, Platform, PlatformTotal, get_platforms_async
+from rates import TRACKER_HOT_CAMPAIGNS_CAPACITY, get_hot_campaigns
+from serializers import campaign_fields, encode, platform_fields
+from stats import delete_platform_buckets, get_click_series
+from targets import normalize_targets, validate_targets
+from uniques import estimate_uniques, merge_sketches
 
 __author__ = 'damjan'
 __version__ = (1, 0)
 
 # List of possible platforms
 PLATFORMS = ("android", "ios", "wp")
+# default and maximum number of items on a page of a paginated listing
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+# number of items fetched from the Datastore at once when streaming a listing
+FETCH_BATCH_SIZE = 100
+# maximum number of operations in a single batch request and number of entities written at once
+MAX_BATCH_SIZE = 1000
+WRITE_BATCH_SIZE = 500
+# campaign parameters that can be omitted when a campaign is created
+OPTIONAL_CAMPAIGN_KEYS = {"targets", "click_cap", "rate_limit", "cap_link"}
+# default and maximum number of campaigns in a page of a streamed export
+EXPORT_PAGE_SIZE = 10000
 
 
 class TrackerException(Exception):
@@ -40,19 +74,13 @@ def handle_error(request, response, exception):
         response.set_status(500)
 
 
-def json_serial(obj):
-    """JSON serializer for datetime objects."""
-    if isinstance(obj, datetime):
-        serial = obj.isoformat()
-        return serial
-    raise TypeError("Type not serializable")
-
-
 class AdminHandler(webapp2.RequestHandler):
     def dispatch(self):
         """Overrides default dispatch by setting the default HTTP Content-type to JSON, performs user authorization
         checking and caches any TrackerException during the dispatch and convert it into meaninful response."""
         self.response.content_type = 'application/json'
+        # compact responses have unsorted keys and no whitespace, which makes them considerably faster to serialize
+        self.compact = self.request.GET.get("compact", "").lower() in ("1", "true", "yes")
         try:
             self.check_auth()
             output = super(AdminHandler, self).dispatch()
@@ -63,10 +91,16 @@ class AdminHandler(webapp2.RequestHandler):
             if isinstance(output, basestring):
                 self.response.write(output)
             elif output is not None:
-                self.response.write(json.dumps(output, default=json_serial, sort_keys=True))
+                self.response.write(self.encode(output))
         except TrackerException, e:
+            # drop any partially streamed output
+            self.response.clear()
             self.response.status_int = e.status_code
-            self.response.write(json.dumps({"error": e.message}, default=json_serial, sort_keys=True))
+            self.response.write(self.encode({"error": e.message}))
+
+    def encode(self, output):
+        """Serialize the output to JSON, compact if requested with the compact parameter."""
+        return encode(output, self.compact)
 
     def check_auth(self):
         basic_auth = self.request.headers.get('Authorization')
@@ -92,8 +126,100 @@ class AdminHandler(webapp2.RequestHandler):
                                    "and set Content-Type as 'application/json'.", status_code=400)
         return campaign_dict
 
+    def get_page_params(self, default_limit=DEFAULT_PAGE_SIZE, max_limit=MAX_PAGE_SIZE):
+        """
+        Gets the pagination parameters limit (default default_limit, at most max_limit) and cursor from the request or
+        raises TrackerException if they are invalid.
+        :return: Tuple of limit and Cursor instance (None for the first page).
+        """
+        try:
+            limit = int(self.request.get("limit") or default_limit)
+        except ValueError:
+            raise TrackerException("Limit parameter must be an integer.", status_code=400)
+        if not 0 < limit <= max_limit:
+            raise TrackerException("Limit parameter must be between 1 and %d." % max_limit, status_code=400)
+        cursor = None
+        if self.request.get("cursor"):
+            try:
+                cursor = Cursor(urlsafe=self.request.get("cursor"))
+            except Exception, e:
+                raise TrackerException("Invalid cursor parameter.", status_code=400)
+        return limit, cursor
+
+    def set_next_page(self, limit, cursor, **params):
+        """
+        Sets the Link and X-Next-Cursor headers pointing to the next page of results starting at cursor.
+        :param params: Additional query parameters of the next page.
+        """
+        next_cursor = cursor.urlsafe()
+        params.update(limit=limit, cursor=next_cursor)
+        self.response.headers["X-Next-Cursor"] = next_cursor
+        self.response.headers["Link"] = '<%s?%s>; rel="next"' % (self.request.path_url,
+                                                                  urllib.urlencode(sorted(params.items())))
+
+
+def cached_response(scopes):
+    """
+    Decorator of AdminHandler GET methods caching their serialized responses in memcache, keyed by the request path and
+    query string. Cached responses are invalidated by the admin mutations and the counter flushes through the scopes
+    they depend on. Responses carry an ETag, so that clients can revalidate them with If-None-Match.
+    :param scopes: Function getting the list of scopes from the arguments of the method.
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            key = self.request.path_qs
+            generations, cached = get_cached_response(key, scopes(*args, **kwargs))
+            if cached is not None:
+                etag, body = cached
+            else:
+                output = method(self, *args, **kwargs)
+                if output is None:
+                    # the response was streamed
+                    body = self.response.body
+                elif isinstance(output, basestring):
+                    body = output
+                else:
+                    body = self.encode(output)
+                if self.response.status_int != 200:
+                    return output
+                etag = hashlib.md5(body).hexdigest()
+                if generations is not None:
+                    set_cached_response(key, generations, etag, body)
+            self.response.headers["ETag"] = '"%s"' % etag
+            if etag in self.request.if_none_match:
+                self.response.clear()
+                self.response.status_int = 304
+                return None
+            if cached is None and output is None:
+                return None
+            return body
+        return wrapper
+    return decorator
+
+
+class JsonListWriter(object):
+    """Writes a JSON list to the response of the handler item by item, so that no list of the encoded items is built.
+    The response body is still buffered until the handler returns, so the memory used grows with the number of items
+    written, which the campaign listing caps with its page limit."""
+
+    def __init__(self, handler):
+        self.response = handler.response
+        self.encode = handler.encode
+        self.count = 0
+        self.response.write("[")
 
-def validate_campaign_dict(campaign_dict, all_required=True):
+    def write(self, item):
+        if self.count:
+            self.response.write(",")
+        self.response.write(self.encode(item))
+        self.count += 1
+
+    def close(self):
+        self.response.write("]")
+
+
+def validate_campaign_dict(campaign_dict, all_required=True, optional_keys=()):
     valid_keys = {"name", "link", "platforms"}
     errors = []
     dict_keys = set(campaign_dict.keys())
@@ -101,8 +227,8 @@ def validate_campaign_dict(campaign_dict, all_required=True):
         # get a list of missing keys
         for missing_key in valid_keys.difference(dict_keys):
             errors.append("Missing parameter '%s'." % missing_key)
-    # get a list of invalid keys
-    for invalid_key in dict_keys.difference(valid_keys):
+    # get a list of invalid keys, redirect targets and click limits are optional for all operations
+    for invalid_key in dict_keys.difference(valid_keys).difference(optional_keys).difference(OPTIONAL_CAMPAIGN_KEYS):
         errors.append("Invalid parameter '%s'." % invalid_key)
 
     # check if platforms are valid
@@ -112,6 +238,13 @@ def validate_campaign_dict(campaign_dict, all_required=True):
                 errors.append("Platforms parameter contains invalid platform '%s'." % invalid_platform)
         else:
             errors.append("Platforms parameter must be a list of platform names.")
+    # check if redirect targets are valid
+    if "targets" in campaign_dict:
+        errors.extend(validate_targets(campaign_dict["targets"]))
+    errors.extend(validate_limits(campaign_dict))
+    # check if counter backend is valid
+    if campaign_dict.get("counter_backend", "memcache") not in COUNTER_BACKENDS:
+        errors.append("Counter backend parameter must be one of %s." % ", ".join(COUNTER_BACKENDS))
     # raise exception if any errors were detected
     if errors:
         raise TrackerException("Invalid request. %s" % " ".join(errors), status_code=400)
@@ -119,47 +252,259 @@ def validate_campaign_dict(campaign_dict, all_required=True):
 
 class CampaignCollectionHandler(AdminHandler):
     def get(self):
-        """List all existing campaigns."""
-
-        @ndb.tasklet
-        def callback(campaign):
-            platforms = yield Platform.query(Platform.campaign == campaign.key,
-                                             projection=[Platform.name, Platform.counter]).order(
-                Platform.name).fetch_async(3)
-            raise ndb.Return(campaign_to_dict(campaign, platforms=platforms))
+        """
+        List existing campaigns, a page of at most limit campaigns starting at cursor. The campaigns are fetched in
+        batches of FETCH_BATCH_SIZE and written to the buffered response, so the page limit bounds the memory used. If
+        there are more campaigns, the response headers point to the next page.
+        """
 
+        limit, cursor = self.get_page_params()
         query = Campaign.query()
-        output = query.map(callback)
-        return output
+        writer = JsonListWriter(self)
+        future = query.fetch_page_async(min(FETCH_BATCH_SIZE, limit), start_cursor=cursor)
+        while future is not None:
+            campaigns, cursor, more = future.get_result()
+            remaining = limit - writer.count - len(campaigns)
+            # prefetch the next batch while the current one is being processed
+            future = query.fetch_page_async(min(FETCH_BATCH_SIZE, remaining), start_cursor=cursor) \
+                if more and remaining > 0 else None
+            for output in campaigns_to_dicts_async(campaigns).get_result():
+                writer.write(output)
+        writer.close()
+        if more:
+            self.set_next_page(limit, cursor)
 
     @ndb.toplevel
     def post(self):
         """Create a new campaign."""
         campaign_dict = self.get_request_json()
-        validate_campaign_dict(campaign_dict)
-        # get a list of platforms
-        platforms_list = campaign_dict["platforms"]
-        del campaign_dict["platforms"]
-        # construct and store a new campaign
-        campaign = Campaign(**campaign_dict)
-        campaign.put()
+        validate_campaign_dict(campaign_dict, optional_keys={"counter_backend"})
+        # construct and store a new campaign and its platforms
+        campaign, platforms = create_campaign(campaign_dict)
         campaign_id = campaign.key.id()
-        # construct and store platforms for campaign
-        platforms = []
-        for platform_name in platforms_list:
-            platform = Platform(name=platform_name, counter=0, campaign=campaign.key,
-                                id="%d-%s" % (campaign_id, platform_name))
-            platforms.append(platform)
+        platform_filter.add([platform.key.id() for platform in platforms])
         ndb.put_multi_async(platforms)
+        invalidate_routing()
+        invalidate_responses([campaign_id])
         # prepare response representation of the created campaign
-        output = campaign_to_dict(campaign, platforms=platforms)
+        output = campaign_to_dict(campaign, platforms=platforms, counters=[0] * len(platforms))
         # set the appropriate response headers
         self.response.location = self.uri_for("campaign-detail", campaign_id=campaign_id)
         self.response.status_int = 201
         return output
 
 
+class CampaignBatchHandler(AdminHandler):
+    OPERATIONS = ("create", "update", "delete")
+
+    def post(self):
+        """
+        Create, update and delete campaigns in bulk. The request is a JSON list of operations of the form
+        {"op": "create", "campaign": {...}}, {"op": "update", "id": 123, "campaign": {...}} or
+        {"op": "delete", "id": 123}. Campaign data is the same as for the single campaign endpoints. The response is a
+        list of per operation results with status, id and campaign or error.
+        """
+        operations = self.get_request_json()
+        if not isinstance(operations, list):
+            raise TrackerException("Invalid request. Request must be a list of operations.", status_code=400)
+        if len(operations) > MAX_BATCH_SIZE:
+            raise TrackerException("Invalid request. At most %d operations are allowed." % MAX_BATCH_SIZE,
+                                   status_code=400)
+
+        results = [None] * len(operations)
+        creates, updates, deletes = [], [], []
+        for index, operation in enumerate(operations):
+            try:
+                self.validate_operation(operation)
+            except TrackerException, e:
+                results[index] = {"status": e.status_code, "error": e.message}
+                continue
+            {"create": creates, "update": updates, "delete": deletes}[operation["op"]].append(index)
+        # operations are applied concurrently, so none of the operations on a repeated campaign is applied
+        id_counts = defaultdict(int)
+        for index in updates + deletes:
+            id_counts[int(operations[index]["id"])] += 1
+        for index in updates + deletes:
+            if id_counts[int(operations[index]["id"])] > 1:
+                results[index] = {"status": 400, "error": "Campaign with id %s is repeated in the batch." %
+                                                          operations[index]["id"]}
+        updates = [index for index in updates if results[index] is None]
+        deletes = [index for index in deletes if results[index] is None]
+
+        # fetch all campaigns that are updated or deleted and their platforms in batches
+        campaign_keys = [ndb.Key(Campaign, int(operations[index]["id"])) for index in updates + deletes]
+        campaigns = ndb.get_multi(campaign_keys)
+        campaigns_platforms = get_platforms_async(campaign_keys).get_result()
+        existing = dict(zip(updates + deletes, zip(campaigns, campaigns_platforms)))
+
+        entities = []
+        route_updates = []
+        keys_to_delete = []
+        totals = defaultdict(int)
+        if creates:
+            first_id, last_id = Campaign.allocate_ids(len(creates))
+            for index, campaign_id in zip(creates, range(first_id, last_id + 1)):
+                campaign, platforms = create_campaign(operations[index]["campaign"], ndb.Key(Campaign, campaign_id))
+                entities.append(campaign)
+                entities.extend(platforms)
+                results[index] = {"status": 201, "id": campaign_id,
+                                  "campaign": campaign_to_dict(campaign, platforms=platforms,
+                                                               counters=[0] * len(platforms))}
+        for index in updates:
+            campaign, existing_platforms = existing[index]
+            if campaign is None:
+                results[index] = {"status": 404, "error": "Campaign with id %s does not exist." %
+                                                          operations[index]["id"]}
+                continue
+            platforms, platforms_to_store, stale_keys = update_campaign(campaign, existing_platforms,
+                                                                        operations[index]["campaign"])
+            entities.append(campaign)
+            entities.extend(platforms_to_store)
+            if stale_keys:
+                route_updates.append((stale_keys, campaign))
+            results[index] = {"status": 200, "id": campaign.key.id(),
+                              "campaign": campaign_to_dict(campaign, platforms=platforms)}
+        # the clicks of all deleted platforms are read concurrently
+        deleted_platforms = [platform for index in deletes if existing[index][0] for platform in existing[index][1]]
+        deletions = {index: delete_platforms_async(existing[index][1]) for index in deletes if existing[index][0]}
+        for index in deletes:
+            campaign, platforms = existing[index]
+            if campaign is not None:
+                keys, deltas = deletions[index].get_result()
+                keys_to_delete.append(campaign.key)
+                keys_to_delete.extend(keys)
+                for platform_name, delta in deltas.items():
+                    totals[platform_name] += delta
+            # deleting a campaign that does not exist is not an error, just as for the single campaign endpoint
+            results[index] = {"status": 204 if campaign is None else 200, "id": int(operations[index]["id"])}
+
+        platform_filter.add([entity.key.id() for entity in entities if isinstance(entity, Platform)])
+        futures = []
+        for i in range(0, len(entities), WRITE_BATCH_SIZE):
+            futures.extend(ndb.put_multi_async(entities[i:i + WRITE_BATCH_SIZE]))
+        for i in range(0, len(keys_to_delete), WRITE_BATCH_SIZE):
+            futures.extend(ndb.delete_multi_async(keys_to_delete[i:i + WRITE_BATCH_SIZE]))
+        futures.extend(set_platforms_route_async(keys, campaign) for keys, campaign in route_updates)
+        if deleted_platforms:
+            futures.append(purge_counters_async(deleted_platforms))
+        Future.wait_all(futures)
+        for future in futures:
+            future.check_success()
+        PlatformTotal.add(dict(totals))
+        if deleted_platforms:
+            deferred.defer(delete_platform_buckets, [platform.key.id() for platform in deleted_platforms])
+        if keys_to_delete:
+            platform_filter.schedule_rebuild()
+        invalidate_routing()
+        invalidate_responses([result["id"] for result in results if "id" in result])
+        return results
+
+    def validate_operation(self, operation):
+        """Validates a single batch operation or raises TrackerException if it is invalid."""
+        if not isinstance(operation, dict) or operation.get("op") not in self.OPERATIONS:
+            raise TrackerException("Invalid operation. Operation must be one of %s." % ", ".join(self.OPERATIONS),
+                                   status_code=400)
+        if operation["op"] != "create":
+            try:
+                int(operation.get("id"))
+            except (TypeError, ValueError):
+                raise TrackerException("Invalid operation. Missing or invalid parameter 'id'.", status_code=400)
+        if operation["op"] != "delete":
+            if not isinstance(operation.get("campaign"), dict):
+                raise TrackerException("Invalid operation. Missing or invalid parameter 'campaign'.", status_code=400)
+            if operation["op"] == "create":
+                validate_campaign_dict(operation["campaign"], optional_keys={"counter_backend"})
+            else:
+                validate_campaign_dict(operation["campaign"], all_required=False)
+
+
+class CampaignExportHandler(AdminHandler):
+    def get_format(self, export_format):
+        """Gets the validated export format, ndjson if not specified, or raises TrackerException if it is invalid."""
+        export_format = export_format or "ndjson"
+        if export_format not in EXPORT_FORMATS:
+            raise TrackerException("Format must be one of %s." % ", ".join(EXPORT_FORMATS), status_code=400)
+        return export_format
+
+    def get(self):
+        """
+        Export the campaigns with their platform counters as NDJSON (one campaign per line) or CSV (with a header
+        line on the first page), a page of at most limit campaigns starting at cursor. The campaigns are fetched and
+        written to the response in batches, if there are more campaigns, the response headers point to the next page.
+        """
+        export_format = self.get_format(self.request.get("format"))
+        limit, cursor = self.get_page_params(EXPORT_PAGE_SIZE, EXPORT_PAGE_SIZE)
+        self.response.content_type = EXPORT_CONTENT_TYPES[export_format]
+        if cursor is None:
+            self.response.write(format_header(export_format))
+        for rows, cursor, more in export_batches(cursor, limit=limit):
+            self.response.write(format_rows(rows, export_format))
+        if more:
+            self.set_next_page(limit, cursor, format=export_format)
+
+    def post(self):
+        """Start a background export of all campaigns in the format given in the request (default ndjson)."""
+        request_dict = self.get_request_json() if self.request.body else {}
+        if not isinstance(request_dict, dict):
+            raise TrackerException("Invalid request. Request must be a JSON object.", status_code=400)
+        export = start_export(self.get_format(request_dict.get("format")))
+        self.response.location = self.uri_for("export-detail", export_id=export.key.id())
+        self.response.status_int = 202
+        return export_to_dict(export)
+
+
+def export_to_dict(export):
+    """Transform CampaignExport instance into dictionary that is suitable for JSON serialization."""
+    output = delete_keys(export.to_dict(), ["cursor"])
+    output["id"] = export.key.id()
+    return output
+
+
+class ExportHandler(AdminHandler):
+    def get_export(self, export_id):
+        """Gets the CampaignExport with the given ID or raises TrackerException if it does not exist."""
+        export = CampaignExport.get_by_id(int(export_id))
+        if export is None:
+            raise TrackerException("Export with id %s does not exist." % export_id, status_code=404)
+        return export
+
+    def get(self, export_id):
+        """Display the progress of the background export."""
+        return export_to_dict(self.get_export(export_id))
+
+
+class ExportDataHandler(ExportHandler):
+    def get(self, export_id):
+        """Stream the data of the finished background export."""
+        export = self.get_export(export_id)
+        if export.status != "done":
+            raise TrackerException("Export with id %s is not done yet." % export_id, status_code=409)
+        self.response.content_type = EXPORT_CONTENT_TYPES[export.format]
+        for data in read_export(export):
+            self.response.write(data)
+
+
+class HotCampaignsHandler(AdminHandler):
+    def get(self):
+        """
+        List the campaigns with the highest recent click rates (clicks per second), at most limit (default 10)
+        campaigns. Rates are estimated with a fixed size sketch, error is the maximum overestimation of the rate.
+        """
+        try:
+            limit = int(self.request.get("limit") or 10)
+        except ValueError:
+            raise TrackerException("Limit parameter must be an integer.", status_code=400)
+        if not 0 < limit <= TRACKER_HOT_CAMPAIGNS_CAPACITY:
+            raise TrackerException("Limit parameter must be between 1 and %d." % TRACKER_HOT_CAMPAIGNS_CAPACITY,
+                                   status_code=400)
+        hot_campaigns = get_hot_campaigns(limit)
+        campaigns = ndb.get_multi([ndb.Key(Campaign, campaign_id) for campaign_id, rate, error in hot_campaigns])
+        return [{"id": campaign_id, "name": campaign.name if campaign else None, "clicks_per_second": rate,
+                 "error": error} for (campaign_id, rate, error), campaign in zip(hot_campaigns, campaigns)]
+
+
 class CampaignHandler(AdminHandler):
+    @cached_response(lambda campaign_id: ["campaign:%s" % campaign_id])
     def get(self, campaign_id):
         """
         Display information about the existing campaign.
@@ -175,15 +520,10 @@ class CampaignHandler(AdminHandler):
     def delete(self, campaign_id):
         """Delete the existing campaign."""
         campaign_id = int(campaign_id)
-        campaign = Campaign.get_by_id(campaign_id)
-
-        if campaign:
-            # delete the campaign first, so that updates are not possible
-            futures = [campaign.key.delete_async()]
-            # delete all platforms that correspond to the campaign
-            futures.extend(ndb.delete_multi_async([platform.key for platform in
-                                                   Platform.query(Platform.campaign == campaign.key).fetch(3)]))
-            Future.wait_all(futures)
+        if delete_campaign_async(ndb.Key(Campaign, campaign_id)).get_result():
+            platform_filter.schedule_rebuild()
+            invalidate_routing()
+            invalidate_responses([campaign_id])
         else:
             # the campaign does not exist, just send 204
             self.response.status_int = 204
@@ -191,57 +531,170 @@ class CampaignHandler(AdminHandler):
     def put(self, campaign_id):
         """Update the existing campaign."""
         campaign_id = int(campaign_id)
-        future = Campaign.get_by_id_async(campaign_id)
+        campaign_key = ndb.Key(Campaign, campaign_id)
+        # the campaign and its platforms are read concurrently while the request is being validated
+        campaign_future = campaign_key.get_async()
+        platforms_future = get_platforms_async([campaign_key])
         campaign_dict = self.get_request_json()
         validate_campaign_dict(campaign_dict, all_required=False)
 
-        campaign = future.get_result()
-
-        platforms = []
-        # get a list of existing campaign platforms
-        existing_platforms_list = {platform.name: platform for platform in
-                                   Platform.query(Platform.campaign == campaign.key).fetch(3)}
-
-        # special processing for platforms field
-        platforms_to_store = []
-        if "platforms" in campaign_dict:
-            # get a list of platforms from the request
-            platforms_list = campaign_dict["platforms"]
-            del campaign_dict["platforms"]
-            # construct platforms for campaign
-            for platform_name in platforms_list:
-                if platform_name not in existing_platforms_list:
-                    platform = Platform(name=platform_name, counter=0, campaign=campaign.key,
-                                        id="%d-%s" % (campaign_id, platform_name))
-                    platforms_to_store.append(platform)
-                else:
-                    platform = existing_platforms_list[platform_name]
-                platforms.append(platform)
-        else:
-            # no changes to platforms field, just copy
-            for platform in existing_platforms_list.values():
-                platforms.append(platform)
-
-        # update the rest of the fields
-        for field_name in campaign_dict:
-            setattr(campaign, field_name, campaign_dict[field_name])
-        campaign.update_date = datetime.now()
+        campaign = campaign_future.get_result()
+        if campaign is None:
+            raise TrackerException("Campaign with id %s does not exist." % campaign_id, status_code=404)
+        existing_platforms = platforms_future.get_result()[0]
+        platforms, platforms_to_store, stale_keys = update_campaign(campaign, existing_platforms, campaign_dict)
 
-        @ndb.transactional_async(xg=True)
+        @ndb.transactional_tasklet(xg=True)
         def _update():
             """Do the update in transaction"""
-            ndb.put_multi_async(platforms_to_store)
-            campaign.put_async()
+            # re-read the existing platforms within the transaction, so that concurrent counter updates are kept
+            stale_platforms = filter(None, (yield ndb.get_multi_async(stale_keys)))
+            for platform in stale_platforms:
+                platform.set_route(campaign)
+            yield ndb.put_multi_async(platforms_to_store + stale_platforms) + [campaign.put_async()]
 
+        platform_filter.add([platform.key.id() for platform in platforms_to_store])
         future = _update()
 
         output = campaign_to_dict(campaign, platforms=platforms)
         # explicitly do the json conversion here, while we may be waiting for the _update to finish
-        output = json.dumps(output, default=json_serial, sort_keys=True)
+        output = self.encode(output)
         future.get_result()
+        invalidate_routing()
+        invalidate_responses([campaign_id])
         return output
 
 
+def create_campaign(campaign_dict, campaign_key=None):
+    """
+    Construct a new campaign and its platforms from the validated campaign_dict.
+    :param campaign_dict: Dictionary with campaign data.
+    :param campaign_key: Key of the new campaign, if None the campaign is stored to obtain its key.
+    :return: Tuple of Campaign instance and list of Platform instances that need to be stored.
+    """
+    campaign_dict = dict(campaign_dict)
+    platforms_list = campaign_dict.pop("platforms")
+    counter_shards = get_counter_shards(campaign_dict.pop("counter_backend", None))
+    if "targets" in campaign_dict:
+        campaign_dict["targets"] = normalize_targets(campaign_dict["targets"])
+    campaign = Campaign(key=campaign_key, **campaign_dict)
+    if campaign_key is None:
+        campaign.put()
+    campaign_id = campaign.key.id()
+    platforms = [Platform(name=platform_name, counter=0, campaign=campaign.key, counter_shards=counter_shards,
+                          id="%d-%s" % (campaign_id, platform_name))
+                 for platform_name in platforms_list]
+    # the link and the compiled redirect targets are denormalized onto the platforms
+    for platform in platforms:
+        platform.set_route(campaign)
+    return campaign, platforms
+
+
+def update_campaign(campaign, existing_platforms, campaign_dict):
+    """
+    Apply the validated campaign_dict to the campaign and construct its newly enabled platforms.
+    :param campaign: Campaign instance.
+    :param existing_platforms: List of existing Platform instances of the campaign.
+    :param campaign_dict: Dictionary with updated campaign data.
+    :return: Tuple of list of Platform instances of the updated campaign, list of new Platform instances that need to
+    be stored and list of keys of the existing platforms whose link or redirect targets need to be updated.
+    """
+    campaign_dict = dict(campaign_dict)
+    if "targets" in campaign_dict:
+        campaign_dict["targets"] = normalize_targets(campaign_dict["targets"])
+    platforms = []
+    # get a list of existing campaign platforms
+    existing_platforms_list = {platform.name: platform for platform in existing_platforms}
+
+    # special processing for platforms field
+    platforms_to_store = []
+    # new platforms use the same counter backend as the existing ones
+    counter_shards = existing_platforms[0].counter_shards if existing_platforms else get_counter_shards()
+    if "platforms" in campaign_dict:
+        # get a list of platforms from the request
+        platforms_list = campaign_dict.pop("platforms")
+        # construct platforms for campaign
+        for platform_name in platforms_list:
+            if platform_name not in existing_platforms_list:
+                platform = Platform(name=platform_name, counter=0, campaign=campaign.key,
+                                    counter_shards=counter_shards, id="%d-%s" % (campaign.key.id(), platform_name))
+                platforms_to_store.append(platform)
+            else:
+                platform = existing_platforms_list[platform_name]
+            platforms.append(platform)
+    else:
+        # no changes to platforms field, just copy
+        platforms.extend(existing_platforms)
+
+    if campaign_dict.get("click_cap") and campaign_dict["click_cap"] != campaign.click_cap:
+        # the budget of the new cap starts at the flushed clicks, not at the clicks taken from the previous one
+        reset_click_cap(campaign.key.id(), campaign_dict["click_cap"],
+                        sum(get_counters_async(existing_platforms).get_result()))
+
+    # update the rest of the fields
+    for field_name in campaign_dict:
+        setattr(campaign, field_name, campaign_dict[field_name])
+    campaign.update_date = datetime.now()
+
+    # keep the link and the redirect targets denormalized onto the platforms in sync with the campaign
+    for platform in platforms_to_store:
+        platform.set_route(campaign)
+    stale_keys = [platform.key for platform in existing_platforms if platform.set_route(campaign)]
+    return platforms, platforms_to_store, stale_keys
+
+
+@ndb.tasklet
+def delete_platforms_async(platforms):
+    """
+    Prepare the deletion of given platforms.
+    :param platforms: List of Platform instances.
+    :return: Tuple of list of keys to delete (platforms and their counter shards) and dictionary of platform totals
+    deltas that remove the clicks of deleted platforms from the platform totals.
+    """
+    keys = []
+    totals = defaultdict(int)
+    counters = yield get_counters_async(platforms)
+    for platform, counter in zip(platforms, counters):
+        keys.append(platform.key)
+        keys.extend(platform.shard_keys())
+        totals[platform.name] -= counter
+    raise ndb.Return((keys, dict(totals)))
+
+
+@ndb.tasklet
+def delete_campaign_async(campaign_key):
+    """
+    Delete the campaign, its platforms, their counter shards and (in a deferred task) their statistics buckets, remove
+    their clicks from the platform totals and purge their clicks that are not flushed yet. The campaign and its
+    platforms are read concurrently, using the deterministic platform keys.
+    :param campaign_key: Key of the campaign.
+    :return: False if the campaign does not exist.
+    """
+    campaign, campaigns_platforms = yield campaign_key.get_async(), get_platforms_async([campaign_key])
+    if campaign is None:
+        raise ndb.Return(False)
+    platforms = campaigns_platforms[0]
+    keys, totals = yield delete_platforms_async(platforms)
+    yield ndb.delete_multi_async([campaign_key] + keys), purge_counters_async(platforms)
+    PlatformTotal.add(totals)
+    if platforms:
+        # the statistics buckets are children of the platforms, there may be thousands of them
+        deferred.defer(delete_platform_buckets, [platform.key.id() for platform in platforms])
+    raise ndb.Return(True)
+
+
+@ndb.transactional_tasklet(xg=True)
+def set_platforms_route_async(platform_keys, campaign):
+    """
+    Update the denormalized link and redirect targets of given platforms, re-reading them so that concurrent counter
+    updates are kept.
+    """
+    platforms = filter(None, (yield ndb.get_multi_async(platform_keys)))
+    for platform in platforms:
+        platform.set_route(campaign)
+    yield ndb.put_multi_async(platforms)
+
+
 def delete_keys(dict_object, keys):
     """
     Remove keys from dict like object.
@@ -263,10 +716,13 @@ def platform_to_dict(platform):
     :param platform: Platform instance.
     :return: Dictionary
     """
-    return delete_keys(platform.to_dict(), ["campaign", "group_id"])
+    output = platform_fields(platform)
+    output["counter"] = get_counters_async([platform]).get_result()[0]
+    output["uniques"] = estimate_uniques(platform.uniques)
+    return output
 
 
-def campaign_to_dict(campaign, platforms=None, fetch_platforms=True):
+def campaign_to_dict(campaign, platforms=None, fetch_platforms=True, counters=None):
     """
     Transform Campaign instance into dictionary that is suitable for JSON serialization display to end-user. If
     platforms parameter is specified it appends the campaign information about enabled platforms. If parameter 
@@ -275,40 +731,67 @@ def campaign_to_dict(campaign, platforms=None, fetch_platforms=True):
     :param campaign: Campaign instance.
     :param platforms: List of Platform instances.
     :param fetch_platforms: Boolean indicating whether to fetch platforms data from the Datastore.
+    :param counters: List of platform click counts as returned by get_counters_async, fetched if not specified.
     :return: Dictionary
     """
     fetch_platforms = fetch_platforms and platforms is None
-    output = campaign.to_dict()
+    output = campaign_fields(campaign)
 
     if fetch_platforms:
-        query = Platform.query(Platform.campaign == campaign.key,
-                               projection=[Platform.name, Platform.counter]).order(Platform.name).fetch(3)
-        output["platform_counters"] = {platform.name: platform.counter for platform in query}
-    elif platforms is not None:
-        output["platform_counters"] = {platform.name: platform.counter for platform in platforms}
+        platforms = get_platforms_async([campaign.key]).get_result()[0]
+    if platforms is not None:
+        if counters is None:
+            counters = get_counters_async(platforms).get_result()
+        output["platform_counters"] = {platform.name: counter for platform, counter in zip(platforms, counters)}
+        if campaign.click_cap:
+            # the state of the budget is derived from the flushed clicks
+            clicks = sum(counters)
+            output["cap_state"] = {"clicks": clicks, "remaining": max(0, campaign.click_cap - clicks),
+                                   "exhausted": clicks >= campaign.click_cap}
+        if campaign.targets:
+            # clicks of every redirect target on all platforms
+            output["target_counters"] = [sum(platform.target_counters[index] for platform in platforms
+                                             if index < len(platform.target_counters))
+                                         for index in range(len(campaign.targets))]
     output["id"] = campaign.key.id()
 
     return output
 
 
+@ndb.tasklet
+def campaigns_to_dicts_async(campaigns):
+    """
+    Transform Campaign instances into dictionaries as campaign_to_dict does, but fetch the platforms and click
+    counts of all campaigns in batches instead of once per campaign.
+    :param campaigns: List of Campaign instances.
+    :return: List of dictionaries.
+    """
+    campaigns_platforms = yield get_platforms_async([campaign.key for campaign in campaigns])
+    counters = yield get_counters_async([platform for platforms in campaigns_platforms for platform in platforms])
+    counters = iter(counters)
+    raise ndb.Return([campaign_to_dict(campaign, platforms=platforms, counters=[next(counters) for _ in platforms])
+                      for campaign, platforms in zip(campaigns, campaigns_platforms)])
+
+
 class PlatformCampaignsHandler(AdminHandler):
+    @cached_response(lambda platform_name: ["all"])
     def get(self, platform_name):
         """List all existing campaigns available on a given platform."""
-
-        @ndb.tasklet
-        def callback(platform):
-            campaign, platforms = yield platform.campaign.get_async(), \
-                                        Platform.query(Platform.campaign == platform.campaign,
-                                                       projection=[Platform.name, Platform.counter]).order(
-                                            Platform.name).fetch_async(3)
-            raise ndb.Return(campaign_to_dict(campaign, platforms=platforms))
-
-        query = Platform.query(Platform.name == platform_name, projection=[Platform.campaign])
-        output = query.map(callback)
-        return output
+        # campaign IDs are a part of the platform IDs, so a keys only query is sufficient
+        query = Platform.query(Platform.name == platform_name)
+        writer = JsonListWriter(self)
+        cursor, more = None, True
+        while more:
+            platform_keys, cursor, more = query.fetch_page(FETCH_BATCH_SIZE, keys_only=True, start_cursor=cursor)
+            campaigns = ndb.get_multi([ndb.Key(Campaign, int(platform_key.id().rsplit("-", 1)[0]))
+                                       for platform_key in platform_keys])
+            for output in campaigns_to_dicts_async(filter(None, campaigns)).get_result():
+                writer.write(output)
+        writer.close()
 
 
 class CampaignClicksHandler(AdminHandler):
+    @cached_response(lambda campaign_id, platform_name: ["campaign:%s" % campaign_id])
     def get(self, campaign_id, platform_name):
         """Retrieves the number of clicks for given campaign on the given platform."""
         campaign_id = int(campaign_id)
@@ -318,28 +801,151 @@ class CampaignClicksHandler(AdminHandler):
 
 class PlatformClicksHandler(AdminHandler):
     def get(self, platform_name):
-        """Retrieve the number of clicks on the given platform."""
+        """
+        Retrieve the number of clicks on the given platform from its pre-aggregated total. If the recompute
+        parameter is set, the total is rebuilt in the background and the response status is 202.
+        """
+        if platform_name not in PLATFORMS:
+            return 0
+        if self.request.get("recompute"):
+            deferred.defer(recompute_platform_total, platform_name)
+            self.response.status_int = 202
+        return get_platform_total(platform_name)
+
+
+class CampaignUniquesHandler(AdminHandler):
+    def get(self, campaign_id):
+        """Retrieves the estimated number of distinct visitors of the given campaign in total and on every platform."""
+        campaign_id = int(campaign_id)
+        platforms = get_platforms_async([ndb.Key(Campaign, campaign_id)]).get_result()[0]
+        return {
+            "uniques": estimate_uniques(merge_sketches(*[platform.uniques for platform in platforms])),
+            "platform_uniques": {platform.name: estimate_uniques(platform.uniques) for platform in platforms},
+        }
+
+
+class PlatformUniquesHandler(AdminHandler):
+    def get(self, platform_name):
+        """
+        Retrieve the estimated number of distinct visitors of all campaigns on the given platform from its
+        pre-aggregated total.
+        """
+        if platform_name not in PLATFORMS:
+            return 0
+        return get_platform_uniques(platform_name)
+
+
+class CampaignFilteredHandler(AdminHandler):
+    def get(self, campaign_id):
+        """Retrieves the numbers of clicks on the given campaign that were not counted, by reason."""
+        return get_filtered_counts(int(campaign_id))
+
+
+class FilteredClicksHandler(AdminHandler):
+    def get(self):
+        """Retrieves the numbers of clicks on all campaigns that were not counted, by reason."""
+        return get_filtered_counts()
+
+
+class CounterAuditHandler(AdminHandler):
+    def get(self):
+        """Retrieve the summary of the last audit of the flushed clicks against the event log."""
+        audit = get_last_audit()
+        if audit is None:
+            raise TrackerException("No clicks were audited yet.", status_code=404)
+        output = audit.to_dict()
+        output["drift"] = audit.logged - audit.counted
+        return output
+
+
+class StatsHandler(AdminHandler):
+    def get_stats(self, platform_ids):
+        """
+        Get the click statistics of given platforms for the time range specified by the request parameters resolution
+        (minute, hour or day, default hour), start and end (UNIX timestamps, by default the last 24 buckets including
+        the current one).
+        :param platform_ids: List of platform IDs whose clicks are added up.
+        :return: Dictionary
+        """
+        resolution = self.request.get("resolution", "hour")
+        if resolution not in BUCKET_RESOLUTIONS:
+            raise TrackerException("Resolution must be one of %s." % ", ".join(sorted(BUCKET_RESOLUTIONS)),
+                                   status_code=400)
+        try:
+            length = BUCKET_RESOLUTIONS[resolution]
+            now = int(time.time())
+            end = int(self.request.get("end") or now - now % length + length)
+            start = int(self.request.get("start") or end - 24 * length)
+            series = get_click_series(platform_ids, resolution, start, end)
+        except ValueError, e:
+            raise TrackerException("Invalid time range. %s" % e, status_code=400)
+        return {
+            "resolution": resolution,
+            "start": start,
+            "end": end,
+            "total": sum(clicks for bucket_start, clicks, uniques in series),
+            "uniques": estimate_uniques(merge_sketches(*[uniques for bucket_start, clicks, uniques in series])),
+            "buckets": [{"start": bucket_start, "clicks": clicks, "uniques": estimate_uniques(uniques)}
+                        for bucket_start, clicks, uniques in series],
+        }
+
+
+class CampaignStatsHandler(StatsHandler):
+    def get(self, campaign_id):
+        """Retrieves the click statistics of the given campaign on all platforms."""
+        campaign_id = int(campaign_id)
+        return self.get_stats(["%d-%s" % (campaign_id, platform_name) for platform_name in PLATFORMS])
 
-        @ndb.tasklet
-        def callback(platform):
-            raise ndb.Return(platform.counter)
-        
-        query = Platform.query(Platform.name == platform_name, projection=[Platform.counter])
-        clicks_sum = sum(query.map(callback))
 
-        return clicks_sum
+class PlatformStatsHandler(StatsHandler):
+    def get(self, campaign_id, platform_name):
+        """Retrieves the click statistics of the given campaign on the given platform."""
+        campaign_id = int(campaign_id)
+        return self.get_stats(["%d-%s" % (campaign_id, platform_name)])
+
+
+class RoutingCacheHandler(AdminHandler):
+    def get(self):
+        """Retrieve the usage statistics of the routing cache and of the negative cache of missing platforms on the
+        instance serving the request."""
+        stats = routing_cache.stats()
+        stats["negative"] = negative_cache.stats()
+        return stats
+
+
+class MetricsHandler(AdminHandler):
+    def get(self):
+        """Retrieve the request and RPC latency histograms aggregated over all instances."""
+        # add the histograms of this instance first, so that the recent requests are included
+        metrics.flush()
+        return metrics.read()
 
 
-app = webapp2.WSGIApplication([
+application = webapp2.WSGIApplication([
     routes.PathPrefixRoute('/api/admin', [
         webapp2.Route(r'/campaign', CampaignCollectionHandler),
+        webapp2.Route(r'/campaign/batch', CampaignBatchHandler),
+        webapp2.Route(r'/campaign/hot', HotCampaignsHandler),
+        webapp2.Route(r'/campaign/export', CampaignExportHandler),
+        webapp2.Route(r'/campaign/export/<export_id:\d+>', ExportHandler, name="export-detail"),
+        webapp2.Route(r'/campaign/export/<export_id:\d+>/data', ExportDataHandler),
         webapp2.Route(r'/campaign/<campaign_id:\d+>/platform/<platform_name>', CampaignClicksHandler),
+        webapp2.Route(r'/campaign/<campaign_id:\d+>/platform/<platform_name>/stats', PlatformStatsHandler),
+        webapp2.Route(r'/campaign/<campaign_id:\d+>/stats', CampaignStatsHandler),
+        webapp2.Route(r'/campaign/<campaign_id:\d+>/uniques', CampaignUniquesHandler),
+        webapp2.Route(r'/campaign/<campaign_id:\d+>/filtered', CampaignFilteredHandler),
         webapp2.Route(r'/campaign/<campaign_id:\d+>', CampaignHandler, name="campaign-detail"),
         webapp2.Route(r'/platform/<platform_name>/campaigns', PlatformCampaignsHandler),
         webapp2.Route(r'/platform/<platform_name>/clicks', PlatformClicksHandler),
+        webapp2.Route(r'/platform/<platform_name>/uniques', PlatformUniquesHandler),
+        webapp2.Route(r'/clicks/filtered', FilteredClicksHandler),
+        webapp2.Route(r'/clicks/audit', CounterAuditHandler),
+        webapp2.Route(r'/cache/routing', RoutingCacheHandler),
+        webapp2.Route(r'/metrics', MetricsHandler),
     ])
 ], debug=False)
-app.error_handlers[405] = handle_error
-app.error_handlers[404] = handle_error
-app.error_handlers[400] = handle_error
-app.error_handlers[500] = handle_error
+application.error_handlers[405] = handle_error
+application.error_handlers[404] = handle_error
+application.error_handlers[400] = handle_error
+application.error_handlers[500] = handle_error
+app = MetricsMiddleware(application, "admin")
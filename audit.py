@@ -0,0 +1,139 @@
+import logging
+import os
+import time
+from collections import defaultdict
+from datetime import datetime
+
+from google.appengine.ext import ndb
+
+from events import event_buffer
+from models import (BUCKET_RESOLUTIONS, TRACKER_COUNTER_UPDATE_INTERVAL_LENGTH, ClickBucket, ClickEventLog,
+                    CounterAudit, Platform, PlatformTotal)
+
+# recoverable clicks (logged, but lost before they were flushed) are added to the counters by the audit
+TRACKER_AUDIT_REPLAY = os.environ.get("TRACKER_AUDIT_REPLAY", "").lower() in ("1", "true", "yes")
+# number of seconds after the end of an hour before it is audited, so that its clicks are flushed and its events stored
+AUDIT_DELAY = 900
+# number of seconds an event may be buffered before its batch is shipped, batches starting up to this long before the
+# audited hour are read as well
+EVENT_LOG_LAG = 3600
+# maximum number of platforms with the largest drift kept in the audit summary
+AUDITED_PLATFORMS_KEPT = 100
+HOUR = BUCKET_RESOLUTIONS["hour"]
+
+
+def get_logged_clicks(start, batch_size=100):
+    """
+    Count the clicks of the hour in the event log, which is written independently of the memcache counters. The flush
+    adds the clicks of an interval to the hour bucket containing the start of the interval, so the events are assigned
+    to the hours by the start of their intervals too, not by their own timestamps.
+    :param start: UNIX timestamp of the start of the hour.
+    :param batch_size: Number of event log entities fetched at once.
+    :return: Dictionary of platform IDs and numbers of counted clicks.
+    """
+    clicks = defaultdict(int)
+    query = ClickEventLog.query(ClickEventLog.start >= datetime.utcfromtimestamp(start - EVENT_LOG_LAG),
+                                ClickEventLog.start < datetime.utcfromtimestamp(start + HOUR +
+                                                                                TRACKER_COUNTER_UPDATE_INTERVAL_LENGTH))
+    cursor, more = None, True
+    while more:
+        logs, cursor, more = query.fetch_page(batch_size, start_cursor=cursor)
+        for log in logs:
+            for event in log.events:
+                interval_start = int(event[0] / TRACKER_COUNTER_UPDATE_INTERVAL_LENGTH) * \
+                    TRACKER_COUNTER_UPDATE_INTERVAL_LENGTH
+                # filtered clicks are not counted, events of older versions do not record the reason
+                if start <= interval_start < start + HOUR and (len(event) < 6 or event[5] is None):
+                    clicks[event[1]] += 1
+    return dict(clicks)
+
+
+def get_flushed_clicks(start, batch_size=500):
+    """
+    Get the clicks of the hour that were flushed into the hour buckets, together with the platform counters.
+    :param start: UNIX timestamp of the start of the hour.
+    :param batch_size: Number of buckets fetched at once.
+    :return: Dictionary of platform IDs and numbers of flushed clicks.
+    """
+    clicks = {}
+    query = ClickBucket.query(ClickBucket.resolution == "hour", ClickBucket.start == datetime.utcfromtimestamp(start))
+    cursor, more = None, True
+    while more:
+        keys, cursor, more = query.fetch_page(batch_size, keys_only=True, start_cursor=cursor)
+        for key, bucket in zip(keys, ndb.get_multi(keys)):
+            if bucket:
+                clicks[key.parent().id()] = bucket.count
+    return clicks
+
+
+@ndb.transactional
+def _replay_clicks(platform_id, start, logged):
+    """
+    Add the clicks missing from the hour to the platform counter and its hour and day buckets, and to the bucket of the
+    first minute of the hour, as the minutes of the lost clicks are not known. The missing clicks are computed in the
+    transaction (the buckets are in the entity group of the platform), so replaying them again adds nothing.
+    :return: Tuple of platform name and number of replayed clicks, None if the platform does not exist.
+    """
+    platform = Platform.get_by_id(platform_id)
+    if platform is None:
+        return None
+    keys = [ClickBucket.key_for(platform_id, resolution, start) for resolution in ("hour", "day", "minute")]
+    buckets = [bucket or ClickBucket.from_key(key) for key, bucket in zip(keys, ndb.get_multi(keys))]
+    missing = logged - buckets[0].count
+    if missing <= 0:
+        return None
+    # clicks of sharded platforms are counted in their shards, only their statistics were lost
+    if not platform.counter_shards:
+        platform.counter += missing
+    for bucket in buckets:
+        bucket.count += missing
+    ndb.put_multi([platform] + buckets)
+    return platform.name, missing
+
+
+def audit_counters(start=None, replay=TRACKER_AUDIT_REPLAY):
+    """
+    Compare the clicks flushed during an hour with the clicks in the event log and store the summary. Clicks are
+    missing from the counters if memcache evicted them before they were flushed, and from the event log if an instance
+    was shut down with buffered events, so the drift is reported both ways, but only the missing counted clicks can be
+    replayed.
+    :param start: UNIX timestamp of the start of the audited hour, by default the last hour that ended at least
+    AUDIT_DELAY seconds ago.
+    :param replay: Whether to add the clicks missing from the counters.
+    :return: CounterAudit instance or None if the event log is not captured.
+    """
+    if not event_buffer.enabled:
+        logging.warning("Counters can not be audited, the event log is not captured.")
+        return None
+    if start is None:
+        start = int(time.time() - AUDIT_DELAY) / HOUR * HOUR - HOUR
+    logged = get_logged_clicks(start)
+    counted = get_flushed_clicks(start)
+    drift = [(platform_id, counted.get(platform_id, 0), logged.get(platform_id, 0))
+             for platform_id in set(logged) | set(counted)
+             if counted.get(platform_id, 0) != logged.get(platform_id, 0)]
+
+    replayed = defaultdict(int)
+    if replay:
+        for platform_id, platform_counted, platform_logged in drift:
+            if platform_logged > platform_counted:
+                result = _replay_clicks(platform_id, start, platform_logged)
+                if result is not None:
+                    replayed[result[0]] += result[1]
+        PlatformTotal.add(dict(replayed))
+
+    drift.sort(key=lambda item: -abs(item[2] - item[1]))
+    audit = CounterAudit(id=start, start=datetime.utcfromtimestamp(start), counted=sum(counted.values()),
+                         logged=sum(logged.values()), replayed=sum(replayed.values()),
+                         platforms=[{"campaign_id": int(platform_id.rsplit("-", 1)[0]),
+                                     "platform": platform_id.rsplit("-", 1)[1],
+                                     "counted": platform_counted, "logged": platform_logged}
+                                    for platform_id, platform_counted, platform_logged
+                                    in drift[:AUDITED_PLATFORMS_KEPT]])
+    audit.put()
+    return audit
+
+
+def get_last_audit():
+    """Get the most recent CounterAudit or None if no hour was audited yet."""
+    return CounterAudit.query().order(-CounterAudit.start).get()
@@ -0,0 +1,160 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from google.appengine.api import memcache
+
+
+def get_int_setting(name, default):
+    """Read an integer setting from the environment variables, falling back to default if it is missing or invalid."""
+    try:
+        return int(os.environ.get(name, default))
+    except:
+        return default
+
+
+class LRUCache(object):
+    """Bounded in-process cache that evicts the least recently used entries and expires entries after ttl seconds.
+    Counts hits, misses and evictions, so that the size of the cache can be tuned.
+    """
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Get the cached value for key or default if it is not cached or has expired."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[1] < time.time():
+                self.misses += 1
+                return default
+            # re-insert the entry to mark it as the most recently used one
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value):
+        """Store value for key, evicting the least recently used entries if the cache is full."""
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, time.time() + self.ttl)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        """Remove all entries from the cache."""
+        with self._lock:
+            self._entries.clear()
+
+    def reset_stats(self):
+        """Reset the hit, miss and eviction counters."""
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def stats(self):
+        """Get the cache usage statistics."""
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+class GenerationalCache(LRUCache):
+    """LRU cache that is invalidated across all instances by bumping a generation number stored in memcache. Every
+    instance checks the generation at most once per check_interval seconds and drops all entries when it changes.
+    """
+
+    def __init__(self, max_size, ttl, generation_key, check_interval):
+        super(GenerationalCache, self).__init__(max_size, ttl)
+        self.generation_key = generation_key
+        self.check_interval = check_interval
+        self._generation = None
+        self._checked_at = 0
+
+    def get(self, key, default=None):
+        now = time.time()
+        if now - self._checked_at >= self.check_interval:
+            self._checked_at = now
+            generation = memcache.get(self.generation_key, namespace="cache")
+            if generation != self._generation:
+                self._generation = generation
+                self.clear()
+        return super(GenerationalCache, self).get(key, default)
+
+    def invalidate(self):
+        """Invalidate the cache on this and (within check_interval seconds) on all other instances."""
+        memcache.incr(self.generation_key, namespace="cache", initial_value=0)
+        self.clear()
+
+
+# number of seconds the serialized admin API responses are cached at most
+TRACKER_RESPONSE_CACHE_TTL = get_int_setting("TRACKER_RESPONSE_CACHE_TTL", 300)
+# maximum size of a cached response, leaving room for the rest of the value within the 1 MB memcache limit
+MAX_CACHED_RESPONSE_SIZE = 900000
+
+# cache of the platform routing data (platform id -> redirect link) used by the click handler
+routing_cache = GenerationalCache(max_size=get_int_setting("TRACKER_ROUTING_CACHE_SIZE", 10000),
+                                  ttl=get_int_setting("TRACKER_ROUTING_CACHE_TTL", 60),
+                                  generation_key="routing-generation",
+                                  check_interval=get_int_setting("TRACKER_ROUTING_CACHE_CHECK_INTERVAL", 5))
+# cache of the platform IDs that do not exist, kept separately so that requests for random IDs do not evict the routing
+# data of existing platforms, invalidated together with the routing cache
+negative_cache = GenerationalCache(max_size=get_int_setting("TRACKER_NEGATIVE_CACHE_SIZE", 10000),
+                                   ttl=get_int_setting("TRACKER_NEGATIVE_CACHE_TTL", 30),
+                                   generation_key="routing-generation",
+                                   check_interval=routing_cache.check_interval)
+
+
+def invalidate_routing():
+    """Invalidate the routing data of existing and missing platforms on this and all other instances."""
+    routing_cache.invalidate()
+    negative_cache.clear()
+
+
+def get_cached_response(key, scopes):
+    """
+    Get the serialized admin API response cached in memcache, together with the current generations of its scopes,
+    with a single memcache call. The response is only valid if none of its scopes was invalidated since it was stored.
+    :param key: Key of the response, e.g. the request path and query string.
+    :param scopes: List of scopes (e.g. "campaign:<campaign_id>" or "all") the response depends on.
+    :return: Tuple of the current generations of the scopes and the (ETag, body) tuple or None if it is not cached.
+    """
+    generation_keys = ["generation:%s" % scope for scope in scopes]
+    values = memcache.get_multi(generation_keys + ["response:%s" % key], namespace="responses")
+    missing = dict((generation_key, int(time.time() * 1000))
+                   for generation_key in generation_keys if generation_key not in values)
+    if missing:
+        # generations start at the current time, so that evicted generations do not validate old responses
+        memcache.add_multi(missing, namespace="responses")
+        return None, None
+    generations = [values[generation_key] for generation_key in generation_keys]
+    cached = values.get("response:%s" % key)
+    if cached is None or cached[0] != generations:
+        return generations, None
+    return generations, cached[1:]
+
+
+def set_cached_response(key, generations, etag, body):
+    """Cache the serialized admin API response for TRACKER_RESPONSE_CACHE_TTL seconds, unless it is too large."""
+    if len(body) <= MAX_CACHED_RESPONSE_SIZE:
+        memcache.set("response:%s" % key, (generations, etag, body), time=TRACKER_RESPONSE_CACHE_TTL,
+                     namespace="responses")
+
+
+def invalidate_responses(campaign_ids=()):
+    """Invalidate the cached admin API responses of the given campaigns and all responses depending on any campaign."""
+    keys = ["generation:all"] + ["generation:campaign:%s" % campaign_id for campaign_id in campaign_ids]
+    memcache.offset_multi(dict((key, 1) for key in keys), namespace="responses", initial_value=int(time.time() * 1000))
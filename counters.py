@@ -0,0 +1,258 @@
+import logging
+import os
+import random
+import time
+from collections import defaultdict
+
+from google.appengine.api import memcache, taskqueue
+from google.appengine.ext import ndb
+
+from cache import get_int_setting
+from models import (PLATFORMS, TRACKER_COUNTER_UPDATE_INTERVAL_LENGTH, CounterShard, Platform, PlatformTotal,
+                    counter_key, target_counter_key)
+from rates import TRACKER_COUNTER_MAX_INTERVAL_FACTOR, get_campaign_interval_factor, update_rates
+from uniques import carried_sketch_key, estimate_uniques, merge_sketches
+
+# available click counter backends, clicks are either counted in memcache and periodically flushed into the
+# Datastore or counted durably in a sharded counter
+COUNTER_BACKENDS = ("memcache", "sharded")
+TRACKER_COUNTER_BACKEND = os.environ.get("TRACKER_COUNTER_BACKEND", "memcache")
+if TRACKER_COUNTER_BACKEND not in COUNTER_BACKENDS:
+    TRACKER_COUNTER_BACKEND = "memcache"
+TRACKER_COUNTER_SHARDS = get_int_setting("TRACKER_COUNTER_SHARDS", 20)
+TRACKER_COUNTER_SHARDS_CACHE_TTL = get_int_setting("TRACKER_COUNTER_SHARDS_CACHE_TTL", 10)
+
+# pull queue holding the platform intervals with clicks that were not yet stored into the Datastore
+COUNTERS_QUEUE = "counters"
+# maximum number of intervals flushed in a single batch (at most 1000, the limit of the task queue leasing)
+TRACKER_COUNTER_FLUSH_BATCH_SIZE = get_int_setting("TRACKER_COUNTER_FLUSH_BATCH_SIZE", 500)
+# intervals with clicks are marked dirty either once per campaign (flushing all its platforms together) or once per
+# platform
+COUNTER_DIRTY_GRANULARITIES = ("campaign", "platform")
+TRACKER_COUNTER_DIRTY_GRANULARITY = os.environ.get("TRACKER_COUNTER_DIRTY_GRANULARITY", "campaign")
+if TRACKER_COUNTER_DIRTY_GRANULARITY not in COUNTER_DIRTY_GRANULARITIES:
+    TRACKER_COUNTER_DIRTY_GRANULARITY = "campaign"
+# number of the most recent intervals whose memcache counters are purged when platforms are deleted, older intervals
+# are flushed already (counters left over by a lagging flush are discarded by it, as their platforms no longer exist)
+PURGED_INTERVALS = 2 * TRACKER_COUNTER_MAX_INTERVAL_FACTOR + 2
+
+
+def get_interval_index(now=None):
+    """Get the index of the interval from the UNIX epoch time (the current time if now is None). Interval length is
+    defined by the TRACKER_COUNTER_UPDATE_INTERVAL_LENGTH.
+    """
+    return int((time.time() if now is None else now) / TRACKER_COUNTER_UPDATE_INTERVAL_LENGTH)
+
+
+def mark_dirty(platform_id, interval_index):
+    """
+    Mark the platform as having clicks in the given interval that need to be flushed into the Datastore. With the
+    campaign granularity only the first platform of a campaign marks the whole campaign dirty, so a single task covers
+    all its platforms. Hot campaigns are marked dirty for a block of consecutive intervals (depending on their recent
+    click rate), so their counters are flushed less often.
+    :param platform_id: ID of the platform.
+    :param interval_index: Index of the interval.
+    """
+    if TRACKER_COUNTER_DIRTY_GRANULARITY == "platform":
+        taskqueue.Task(payload="%s %d" % (platform_id, interval_index), method="PULL").add(COUNTERS_QUEUE)
+        return
+    campaign_id = platform_id.rsplit("-", 1)[0]
+    factor = get_campaign_interval_factor(campaign_id)
+    # blocks are aligned, so that instances using the same factor mark the same block
+    interval_index -= interval_index % factor
+    key = "%s:%d:%d" % (campaign_id, interval_index, factor)
+    # a marker evicted before the flush only causes a redundant task, which finds no counters to flush
+    if not memcache.add(key, 1, time=(factor + 10) * TRACKER_COUNTER_UPDATE_INTERVAL_LENGTH, namespace="dirty"):
+        return
+    try:
+        taskqueue.Task(payload="%s %d %d" % (campaign_id, interval_index, factor),
+                       method="PULL").add(COUNTERS_QUEUE)
+    except taskqueue.Error:
+        # let the next platform of the campaign try again
+        memcache.delete(key, namespace="dirty")
+        raise
+
+
+def flush_counters(batch_size=TRACKER_COUNTER_FLUSH_BATCH_SIZE, until=None):
+    """
+    Drain the clicks of all dirty platforms from memcache and store them into the Datastore, batch_size intervals at
+    a time. Only intervals before the until index are flushed, by default all intervals that ended at least one
+    interval ago, so that clicks from instances with a slightly skewed clock are not missed. Leases of the intervals
+    that are not due yet expire once they are, so they are picked up by one of the next flushes. The click rates of
+    the flushed campaigns are updated as well.
+    :param batch_size: Number of intervals flushed in a single batch.
+    :param until: Index of the first interval that is not flushed.
+    :return: Number of flushed intervals.
+    """
+    if until is None:
+        until = get_interval_index() - 1
+    queue = taskqueue.Queue(COUNTERS_QUEUE)
+    flushed = 0
+    while True:
+        tasks = queue.lease_tasks(lease_seconds=2 * TRACKER_COUNTER_UPDATE_INTERVAL_LENGTH, max_tasks=batch_size)
+        if not tasks:
+            break
+        due_tasks = []
+        intervals = []
+        for task in tasks:
+            # tasks of older versions have no interval factor
+            entity_id, interval_index, factor = (task.payload.split(" ") + ["1"])[:3]
+            interval_index, factor = int(interval_index), int(factor)
+            if interval_index + factor <= until:
+                due_tasks.append(task)
+                # campaign tasks cover all its platforms, whose counters are read with a single get_multi
+                platform_ids = [entity_id] if "-" in entity_id else \
+                    ["%s-%s" % (entity_id, platform_name) for platform_name in PLATFORMS]
+                intervals.extend((platform_id, index) for platform_id in platform_ids
+                                 for index in range(interval_index, interval_index + factor))
+        if due_tasks:
+            flushed_intervals, clicks = Platform.flush_counters(intervals)
+            flushed += flushed_intervals
+            campaign_clicks = defaultdict(int)
+            for platform_id, value in clicks.items():
+                campaign_clicks[platform_id.rsplit("-", 1)[0]] += value
+            try:
+                update_rates(campaign_clicks)
+            except Exception, e:
+                logging.exception("Could not update the click rates.")
+            queue.delete_tasks(due_tasks)
+        if len(tasks) < batch_size:
+            break
+    return flushed
+
+
+@ndb.tasklet
+def purge_counters_async(platforms):
+    """
+    Delete the clicks and visitor sketches of deleted platforms that are counted in memcache but not flushed yet, so
+    that the pending flush tasks of the platforms find nothing to flush. The tasks themselves cannot be removed from
+    the pull queue, they are dropped by the next flush.
+    :param platforms: List of deleted Platform instances.
+    """
+    context = ndb.get_context()
+    interval_index = get_interval_index()
+    keys = []
+    for platform in platforms:
+        platform_id = platform.key.id()
+        # the counter of older versions is flushed by deferred Platform.increment tasks
+        keys.append(counter_key(platform_id, None))
+        for index in range(interval_index - PURGED_INTERVALS, interval_index + 2):
+            keys.append(counter_key(platform_id, index))
+            if platform.targets:
+                keys.extend(target_counter_key(platform_id, index, target)
+                            for target in range(len(platform.targets["links"])))
+    # the deletes are batched into a few delete_multi calls by the context
+    futures = [context.memcache_delete(key, namespace="counters") for key in keys]
+    futures.extend(context.memcache_delete(key, namespace="uniques")
+                   for key in keys + [carried_sketch_key(platform.key.id()) for platform in platforms])
+    futures.extend(context.memcache_delete(platform.key.id(), namespace="shards")
+                   for platform in platforms if platform.counter_shards)
+    yield futures
+
+
+def get_counter_shards(counter_backend=None):
+    """
+    Get the number of counter shards for a new platform.
+    :param counter_backend: Name of the counter backend, if None the default TRACKER_COUNTER_BACKEND is used.
+    :return: Number of counter shards, 0 if clicks are counted in memcache.
+    """
+    if (counter_backend or TRACKER_COUNTER_BACKEND) == "sharded":
+        return TRACKER_COUNTER_SHARDS
+    return 0
+
+
+@ndb.transactional_tasklet
+def increment_shard_async(platform_id, counter_shards):
+    """
+    Durably count a click by incrementing a randomly selected counter shard of the platform.
+    :param platform_id: ID of the platform.
+    :param counter_shards: Number of counter shards of the platform.
+    """
+    key = CounterShard.key_for(platform_id, random.randrange(counter_shards))
+    shard = yield key.get_async()
+    if shard is None:
+        shard = CounterShard(key=key)
+    shard.count += 1
+    yield shard.put_async()
+
+
+def increment_shard(platform_id, counter_shards):
+    """Durably count a click that could not be stored into a shard by the click handler, run as a deferred task."""
+    increment_shard_async(platform_id, counter_shards).get_result()
+
+
+@ndb.tasklet
+def _get_shards_sum_async(platform):
+    """Get the sum of all counter shards of the platform, cached in memcache."""
+    context = ndb.get_context()
+    shards_sum = yield context.memcache_get(platform.key.id(), namespace="shards")
+    if shards_sum is None:
+        shards = yield ndb.get_multi_async(platform.shard_keys())
+        shards_sum = sum(shard.count for shard in shards if shard)
+        yield context.memcache_set(platform.key.id(), shards_sum, namespace="shards",
+                                   time=TRACKER_COUNTER_SHARDS_CACHE_TTL)
+    raise ndb.Return(shards_sum)
+
+
+@ndb.tasklet
+def get_counters_async(platforms):
+    """
+    Get the total number of clicks of given platforms. For sharded platforms the counter shards are added up, no
+    additional RPCs are made for the platforms counted in memcache.
+    :param platforms: List of Platform instances.
+    :return: List of click counts in the same order as platforms.
+    """
+    shards_sums = yield [_get_shards_sum_async(platform) for platform in platforms if platform.counter_shards]
+    shards_sums = iter(shards_sums)
+    raise ndb.Return([platform.counter + (next(shards_sums) if platform.counter_shards else 0)
+                      for platform in platforms])
+
+
+def get_platform_total(platform_name):
+    """
+    Get the total number of clicks on all campaigns on the platform from its pre-aggregated total, which is cached in
+    memcache. The total is computed if it does not exist yet.
+    :param platform_name: Name of the platform.
+    :return: Number of clicks.
+    """
+    counter = memcache.get(platform_name, namespace="platform-totals")
+    if counter is None:
+        total = PlatformTotal.get_by_id(platform_name)
+        counter = total.counter if total else recompute_platform_total(platform_name)
+        memcache.add(platform_name, counter, namespace="platform-totals")
+    return counter
+
+
+def get_platform_uniques(platform_name):
+    """
+    Get the estimated number of distinct visitors of all campaigns on the platform from its pre-aggregated total. The
+    total is computed if it does not exist yet.
+    :param platform_name: Name of the platform.
+    :return: Estimated number of visitors.
+    """
+    total = PlatformTotal.get_by_id(platform_name)
+    if total is None:
+        recompute_platform_total(platform_name)
+        total = PlatformTotal.get_by_id(platform_name)
+    return estimate_uniques(total.uniques)
+
+
+def recompute_platform_total(platform_name, batch_size=500):
+    """
+    Rebuild the pre-aggregated total of the platform by adding up the counters and merging the visitor sketches of all
+    its campaigns, e.g. to repair it after a failed update or to drop the visitors of deleted campaigns.
+    :param platform_name: Name of the platform.
+    :param batch_size: Number of platforms fetched at once.
+    :return: Number of clicks.
+    """
+    query = Platform.query(Platform.name == platform_name)
+    counter = 0
+    uniques = None
+    cursor, more = None, True
+    while more:
+        platforms, cursor, more = query.fetch_page(batch_size, start_cursor=cursor)
+        counter += sum(get_counters_async(platforms).get_result())
+        uniques = merge_sketches(uniques, *[platform.uniques for platform in platforms])
+    PlatformTotal(id=platform_name, counter=counter, uniques=uniques).put()
+    memcache.delete(platform_name, namespace="platform-totals")
+    return counter
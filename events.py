@@ -0,0 +1,108 @@
+import json
+import os
+import threading
+import time
+from datetime import datetime
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from cache import get_int_setting
+from models import ClickEventLog
+
+# raw click events are only captured if TRACKER_EVENT_CAPTURE is set
+TRACKER_EVENT_CAPTURE = os.environ.get("TRACKER_EVENT_CAPTURE", "").lower() in ("1", "true", "yes")
+# maximum number of events shipped in a single task and the maximum number of seconds an event is buffered
+TRACKER_EVENT_BATCH_SIZE = get_int_setting("TRACKER_EVENT_BATCH_SIZE", 500)
+TRACKER_EVENT_BUFFER_AGE = get_int_setting("TRACKER_EVENT_BUFFER_AGE", 10)
+# pull queue holding the batches of events that were not yet stored into the Datastore
+EVENTS_QUEUE = "events"
+# maximum length of the stored header values
+MAX_HEADER_LENGTH = 500
+
+
+def click_event(platform_id, request, reason=None, timestamp=None):
+    """
+    Get the raw event of a click.
+    :param platform_id: ID of the clicked platform.
+    :param request: Request of the click.
+    :param reason: Reason for not counting the click (one of FILTER_REASONS) or None if it is counted.
+    :param timestamp: UNIX timestamp of the click, the current time if None.
+    :return: List of UNIX timestamp, platform ID, user agent, referrer, country and reason.
+    """
+    headers = request.headers
+    timestamp = time.time() if timestamp is None else timestamp
+    return [int(timestamp), platform_id, headers.get("User-Agent", "")[:MAX_HEADER_LENGTH],
+            headers.get("Referer", "")[:MAX_HEADER_LENGTH], headers.get("X-AppEngine-Country", ""), reason]
+
+
+class EventBuffer(object):
+    """In-memory buffer of the click events captured by an instance. The events are shipped in batches as pull queue
+    tasks once batch_size events are buffered or the oldest event is max_age seconds old, so capturing a click only
+    costs a task queue RPC per batch."""
+
+    def __init__(self, enabled, batch_size, max_age):
+        self.enabled = enabled
+        self.batch_size = batch_size
+        self.max_age = max_age
+        self._events = []
+        self._started_at = None
+        self._lock = threading.Lock()
+
+    def append(self, event):
+        """
+        Buffer the event and ship the buffered events if the batch is full or too old.
+        :param event: Event as returned by click_event.
+        :return: RPC of the task queue add operation if the events were shipped, None otherwise.
+        """
+        with self._lock:
+            if not self._events:
+                self._started_at = time.time()
+            self._events.append(event)
+            if len(self._events) < self.batch_size and time.time() - self._started_at < self.max_age:
+                return None
+            events, self._events = self._events, []
+        return taskqueue.Task(payload=json.dumps(events), method="PULL").add_async(EVENTS_QUEUE)
+
+    def ship(self):
+        """Ship the buffered events regardless of their number and age."""
+        with self._lock:
+            events, self._events = self._events, []
+        if events:
+            taskqueue.Task(payload=json.dumps(events), method="PULL").add(EVENTS_QUEUE)
+
+    def ship_due(self):
+        """Ship the buffered events if the oldest one is max_age seconds old, without waiting for the next click."""
+        with self._lock:
+            if not self._events or time.time() - self._started_at < self.max_age:
+                return
+            events, self._events = self._events, []
+        taskqueue.Task(payload=json.dumps(events), method="PULL").add(EVENTS_QUEUE)
+
+
+event_buffer = EventBuffer(TRACKER_EVENT_CAPTURE, TRACKER_EVENT_BATCH_SIZE, TRACKER_EVENT_BUFFER_AGE)
+
+
+def store_events(batch_size=100):
+    """
+    Store the shipped batches of events into the Datastore, one event log entity per batch.
+    :param batch_size: Number of batches stored at a time.
+    :return: Number of stored events.
+    """
+    queue = taskqueue.Queue(EVENTS_QUEUE)
+    stored = 0
+    while True:
+        tasks = queue.lease_tasks(lease_seconds=60, max_tasks=batch_size)
+        if not tasks:
+            break
+        logs = []
+        for task in tasks:
+            events = json.loads(task.payload)
+            logs.append(ClickEventLog(id=task.name, start=datetime.utcfromtimestamp(min(event[0] for event in events)),
+                                      count=len(events), events=events))
+            stored += len(events)
+        ndb.put_multi(logs)
+        queue.delete_tasks(tasks)
+        if len(tasks) < batch_size:
+            break
+    return stored
@@ -0,0 +1,157 @@
+import csv
+import time
+from cStringIO import StringIO
+
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+from google.appengine.ext.deferred import deferred
+
+from cache import get_int_setting
+from counters import get_counters_async
+from models import PLATFORMS, Campaign, CampaignExport, ExportChunk, get_platforms_async
+from serializers import campaign_fields, encode
+
+EXPORT_FORMATS = ("ndjson", "csv")
+EXPORT_CONTENT_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+# number of campaigns fetched from the Datastore at once and written as a single chunk by the export task
+TRACKER_EXPORT_BATCH_SIZE = get_int_setting("TRACKER_EXPORT_BATCH_SIZE", 500)
+# number of seconds an export task runs before the export is continued by a new task, well within the task deadline
+EXPORT_TASK_DURATION = 300
+# columns of the CSV export, the platform columns hold the click counts (empty if the platform is not enabled)
+CSV_COLUMNS = ("id", "name", "link", "create_date", "update_date") + PLATFORMS
+
+
+@ndb.tasklet
+def campaigns_to_rows_async(campaigns):
+    """
+    Transform Campaign instances into export rows, fetching the platforms and click counts of all campaigns in
+    batches. Rows have the same fields as the campaigns listed by the admin API, with the dates in ISO format.
+    :param campaigns: List of Campaign instances.
+    :return: List of dictionaries.
+    """
+    campaigns_platforms = yield get_platforms_async([campaign.key for campaign in campaigns])
+    counters = yield get_counters_async([platform for platforms in campaigns_platforms for platform in platforms])
+    counters = iter(counters)
+    rows = []
+    for campaign, platforms in zip(campaigns, campaigns_platforms):
+        row = campaign_fields(campaign)
+        row["id"] = campaign.key.id()
+        row["platform_counters"] = {platform.name: next(counters) for platform in platforms}
+        rows.append(row)
+    raise ndb.Return(rows)
+
+
+def export_batches(cursor=None, limit=None, batch_size=TRACKER_EXPORT_BATCH_SIZE):
+    """
+    Generate the export rows of the campaigns in batches, so that only a single batch is held in memory. The next
+    batch is fetched while the current one is being processed.
+    :param cursor: Cursor instance of the first campaign or None to start with the first one.
+    :param limit: Maximum number of campaigns or None for all of them.
+    :param batch_size: Number of campaigns in a batch.
+    :return: Generator of tuples of list of rows, cursor of the next campaign and whether there are more campaigns.
+    """
+    query = Campaign.query()
+    exported = 0
+    future = query.fetch_page_async(batch_size if limit is None else min(batch_size, limit), start_cursor=cursor)
+    while future is not None:
+        campaigns, cursor, more = future.get_result()
+        exported += len(campaigns)
+        remaining = batch_size if limit is None else min(batch_size, limit - exported)
+        future = query.fetch_page_async(remaining, start_cursor=cursor) if more and remaining > 0 else None
+        yield campaigns_to_rows_async(campaigns).get_result(), cursor, more
+
+
+def format_rows(rows, export_format):
+    """
+    Serialize export rows.
+    :param rows: List of rows as returned by export_batches.
+    :param export_format: One of EXPORT_FORMATS.
+    :return: String with one line per row.
+    """
+    if export_format == "ndjson":
+        # rows of the bulk export are serialized compact, with the fastest encoder
+        return "".join(encode(row, compact=True) + "\n" for row in rows)
+    output = StringIO()
+    writer = csv.writer(output)
+    for row in rows:
+        values = [row[column] for column in CSV_COLUMNS[:-len(PLATFORMS)]]
+        values.extend(row["platform_counters"].get(platform_name, "") for platform_name in PLATFORMS)
+        writer.writerow([value.encode("utf8") if isinstance(value, unicode) else value for value in values])
+    return output.getvalue()
+
+
+def format_header(export_format):
+    """Get the header line of the export format, an empty string if it has none."""
+    if export_format == "ndjson":
+        return ""
+    output = StringIO()
+    csv.writer(output).writerow(CSV_COLUMNS)
+    return output.getvalue()
+
+
+def start_export(export_format):
+    """
+    Start a background export of all campaigns.
+    :param export_format: One of EXPORT_FORMATS.
+    :return: CampaignExport instance.
+    """
+    export = CampaignExport(format=export_format)
+    export.put()
+    deferred.defer(run_export, export.key.id())
+    return export
+
+
+@ndb.transactional
+def _store_chunk(export_key, data, cursor, rows, done):
+    """Store the next chunk of the export together with the cursor it ends at, so that every chunk is stored once."""
+    export = export_key.get()
+    if export.status == "done" or export.cursor != cursor[0]:
+        # the batch was already stored by another attempt of the task, which continues the export
+        return None
+    export.chunks += 1
+    export.rows += rows
+    export.cursor = cursor[1]
+    if done:
+        export.status = "done"
+    ndb.put_multi([export, ExportChunk(parent=export_key, id=export.chunks, data=data)])
+    return export
+
+
+def run_export(export_id, batch_size=TRACKER_EXPORT_BATCH_SIZE, duration=EXPORT_TASK_DURATION):
+    """
+    Export the campaigns in batches starting at the cursor of the export, run as a deferred task. If the export is not
+    done after duration seconds, it is continued by a new task.
+    :param export_id: ID of the CampaignExport.
+    :param batch_size: Number of campaigns in a chunk.
+    :param duration: Number of seconds after which the export is continued by a new task.
+    """
+    started_at = time.time()
+    export_key = ndb.Key(CampaignExport, export_id)
+    export = export_key.get()
+    if export is None or export.status == "done":
+        return
+    cursor = Cursor(urlsafe=export.cursor) if export.cursor else None
+    data = format_header(export.format) if cursor is None else ""
+    for rows, next_cursor, more in export_batches(cursor, batch_size=batch_size):
+        data += format_rows(rows, export.format)
+        next_cursor = next_cursor.urlsafe() if next_cursor else None
+        export = _store_chunk(export_key, data, (export.cursor, next_cursor), len(rows), not more)
+        if export is None or export.status == "done":
+            return
+        if time.time() - started_at >= duration:
+            deferred.defer(run_export, export_id, batch_size=batch_size, duration=duration)
+            return
+        data = ""
+
+
+def read_export(export, batch_size=10):
+    """
+    Generate the data of the export chunk by chunk, fetching batch_size chunks at once.
+    :param export: CampaignExport instance.
+    :return: Generator of strings.
+    """
+    for start in range(1, export.chunks + 1, batch_size):
+        keys = [ndb.Key(ExportChunk, chunk_id, parent=export.key)
+                for chunk_id in range(start, min(start + batch_size, export.chunks + 1))]
+        for chunk in ndb.get_multi(keys):
+            yield chunk.data
@@ -0,0 +1,245 @@
+import hashlib
+import os
+import re
+import struct
+import threading
+import time
+
+from google.appengine.api import memcache
+from google.appengine.ext.deferred import deferred
+
+from cache import get_int_setting
+from models import Platform
+
+# number of seconds within which repeated clicks of a visitor on a platform are not counted, 0 disables deduplication
+TRACKER_DEDUP_WINDOW = get_int_setting("TRACKER_DEDUP_WINDOW", 0)
+# number of bits of each of the two deduplication Bloom filters kept by an instance
+TRACKER_DEDUP_FILTER_BITS = get_int_setting("TRACKER_DEDUP_FILTER_BITS", 2 ** 20)
+# number of bit positions set for every click, optimal for about 100000 clicks per window with the default size
+DEDUP_FILTER_HASHES = 7
+# comma separated user agent substrings (case insensitive) of clients whose clicks are not counted
+TRACKER_BOT_USER_AGENTS = os.environ.get("TRACKER_BOT_USER_AGENTS",
+                                         "bot/,bot-,crawler,spider,slurp,facebookexternalhit,curl/,wget/,"
+                                         "python-requests,headlesschrome,phantomjs")
+# reasons for not counting a click, the last two are the click limits of the campaign (see limits.py)
+FILTER_REASONS = ("duplicate", "bot", "rate_limited", "capped")
+# clicks on platforms that are not in the shared Bloom filter of all platform IDs are rejected without a Datastore get
+TRACKER_PLATFORM_FILTER = os.environ.get("TRACKER_PLATFORM_FILTER", "").lower() in ("1", "true", "yes")
+# number of bits of the platform IDs filter, it must fit into a memcache value (at most 1 MB)
+TRACKER_PLATFORM_FILTER_BITS = get_int_setting("TRACKER_PLATFORM_FILTER_BITS", 2 ** 22)
+# number of seconds between checks whether the platform IDs filter was changed and number of seconds a rebuild of the
+# filter is delayed after campaigns are deleted, so that deletions in quick succession cause a single rebuild
+PLATFORM_FILTER_CHECK_INTERVAL = get_int_setting("TRACKER_ROUTING_CACHE_CHECK_INTERVAL", 5)
+PLATFORM_FILTER_REBUILD_DELAY = 60
+
+
+def compile_user_agent_blocklist(substrings):
+    """
+    Compile the user agent substrings into a single regular expression.
+    :param substrings: Comma separated user agent substrings.
+    :return: Compiled regular expression or None if there are no substrings.
+    """
+    substrings = [substring.strip() for substring in substrings.split(",") if substring.strip()]
+    if not substrings:
+        return None
+    return re.compile("|".join(re.escape(substring) for substring in substrings), re.IGNORECASE)
+
+
+class BloomFilter(object):
+    """Fixed size set of strings that may report false positives (with a probability depending on its size and the
+    number of added strings), but never false negatives."""
+
+    def __init__(self, bits, hashes, data=None):
+        self.bits = bits
+        self.hashes = hashes
+        self._array = bytearray(data or (bits + 7) / 8)
+
+    def _positions(self, value):
+        # positions are derived from two hashes by double hashing
+        first, second = struct.unpack("<QQ", hashlib.md5(value).digest())
+        return [(first + i * second) % self.bits for i in range(self.hashes)]
+
+    def add(self, value):
+        """Add the value and return True if it was (probably) already present."""
+        present = True
+        for position in self._positions(value):
+            if not self._array[position / 8] & (1 << position % 8):
+                present = False
+                self._array[position / 8] |= 1 << position % 8
+        return present
+
+    def __contains__(self, value):
+        return all(self._array[position / 8] & (1 << position % 8) for position in self._positions(value))
+
+    def to_bytes(self):
+        return str(self._array)
+
+
+class RotatingBloomFilter(object):
+    """
+    Bloom filter of the values added during the last window (up to two windows) seconds. Values are added to the
+    current filter and looked up in both the current and the previous one. Every window seconds the current filter
+    becomes the previous one, so the memory used is fixed regardless of the number of values.
+    """
+
+    def __init__(self, window, bits, hashes):
+        self.window = window
+        self.bits = bits
+        self.hashes = hashes
+        self._current = BloomFilter(bits, hashes)
+        self._previous = None
+        self._rotated_at = time.time()
+        self._lock = threading.Lock()
+
+    def add(self, value):
+        """Add the value and return True if it was (probably) already added during the window."""
+        with self._lock:
+            now = time.time()
+            if now - self._rotated_at >= self.window:
+                # the current filter is dropped as well if nothing was added during the whole last window
+                self._previous = self._current if now - self._rotated_at < 2 * self.window else None
+                self._current = BloomFilter(self.bits, self.hashes)
+                self._rotated_at = now
+            present = self._previous is not None and value in self._previous
+            return self._current.add(value) or present
+
+
+class ClickFilter(object):
+    """Decides which clicks are not counted: clicks of known bots and repeated clicks of a visitor on a platform. The
+    deduplication is done in instance memory, so repeated clicks served by different instances are counted."""
+
+    def __init__(self, window, bits, user_agents):
+        self.dedup_filter = RotatingBloomFilter(window, bits, DEDUP_FILTER_HASHES) if window > 0 else None
+        self.blocklist = compile_user_agent_blocklist(user_agents)
+
+    def check(self, platform_id, visitor, user_agent):
+        """
+        Check whether the click should be counted.
+        :param platform_id: ID of the clicked platform.
+        :param visitor: Identifier of the visitor.
+        :param user_agent: User agent of the visitor.
+        :return: None if the click is counted, otherwise the reason, one of FILTER_REASONS.
+        """
+        if self.blocklist is not None and self.blocklist.search(user_agent):
+            return "bot"
+        if self.dedup_filter is not None:
+            value = "%s %s" % (platform_id, visitor)
+            if self.dedup_filter.add(value.encode("utf8") if isinstance(value, unicode) else value):
+                return "duplicate"
+        return None
+
+
+click_filter = ClickFilter(TRACKER_DEDUP_WINDOW, TRACKER_DEDUP_FILTER_BITS, TRACKER_BOT_USER_AGENTS)
+
+
+def count_filtered(campaign_id, reason):
+    """Count the click that was not counted for the given reason in total and for the campaign in memcache."""
+    memcache.offset_multi({reason: 1, "%s:%d" % (reason, campaign_id): 1}, namespace="filtered", initial_value=0)
+
+
+def get_filtered_counts(campaign_id=None):
+    """
+    Get the numbers of clicks that were not counted. The counts are kept in memcache, so they are approximate.
+    :param campaign_id: ID of the campaign or None for the numbers of all campaigns.
+    :return: Dictionary of reasons and numbers of clicks.
+    """
+    keys = {reason if campaign_id is None else "%s:%d" % (reason, campaign_id): reason for reason in FILTER_REASONS}
+    counts = memcache.get_multi(keys.keys(), namespace="filtered")
+    return {reason: counts.get(key, 0) for key, reason in keys.items()}
+
+
+class PlatformIdFilter(object):
+    """
+    Bloom filter of the IDs of all existing platforms, shared by all instances through memcache. Every instance checks
+    the version of the filter at most once per check_interval seconds and loads the filter when it changes. IDs of
+    created platforms are added to the filter right away, deleted platforms are only removed when the filter is
+    rebuilt. While the filter is not available (e.g. evicted from memcache), no click is rejected by it.
+    """
+
+    def __init__(self, enabled, bits, check_interval):
+        self.enabled = enabled
+        self.bits = bits
+        self.check_interval = check_interval
+        self._filter = None
+        self._version = None
+        self._checked_at = 0
+
+    def might_exist(self, platform_id):
+        """Check whether the platform may exist, False only if it does not exist for sure."""
+        if not self.enabled:
+            return True
+        now = time.time()
+        if now - self._checked_at >= self.check_interval:
+            self._checked_at = now
+            version = memcache.get("platform-filter-version", namespace="cache")
+            if version is None:
+                self._filter = None
+                self.schedule_rebuild(countdown=0)
+            elif version != self._version:
+                data = memcache.get("platform-filter", namespace="cache")
+                if data is None:
+                    self.schedule_rebuild(countdown=0)
+                self._filter = BloomFilter(self.bits, DEDUP_FILTER_HASHES, data) if data else None
+            self._version = version
+        return self._filter is None or platform_id in self._filter
+
+    def add(self, platform_ids):
+        """Add the IDs of created platforms to the shared filter, if it exists."""
+        if not self.enabled or not platform_ids:
+            return
+        client = memcache.Client()
+        for retry in range(5):
+            data = client.gets("platform-filter", namespace="cache")
+            if data is None:
+                # the rebuild will include the platforms
+                return self.schedule_rebuild(countdown=0)
+            bloom_filter = BloomFilter(self.bits, DEDUP_FILTER_HASHES, data)
+            for platform_id in platform_ids:
+                bloom_filter.add(platform_id)
+            if client.cas("platform-filter", bloom_filter.to_bytes(), namespace="cache"):
+                memcache.incr("platform-filter-version", namespace="cache", initial_value=0)
+                return
+        # the filter must not miss any existing platform, so drop it until it is rebuilt
+        memcache.delete_multi(["platform-filter", "platform-filter-version"], namespace="cache")
+        self.schedule_rebuild(countdown=0)
+
+    def schedule_rebuild(self, countdown=PLATFORM_FILTER_REBUILD_DELAY):
+        """Rebuild the shared filter in the background, unless a rebuild is already scheduled."""
+        if self.enabled and memcache.add("platform-filter-rebuild", 1, time=countdown + 60, namespace="cache"):
+            deferred.defer(rebuild_platform_filter, _countdown=countdown)
+
+    def rebuild(self, batch_size=1000):
+        """Build the filter from the IDs of all platforms and share it with all instances."""
+        memcache.delete("platform-filter-rebuild", namespace="cache")
+        client = memcache.Client()
+        # remember the filter before the platforms are read, so that concurrently added platforms are not lost
+        current = client.gets("platform-filter", namespace="cache")
+        bloom_filter = BloomFilter(self.bits, DEDUP_FILTER_HASHES)
+        query = Platform.query()
+        cursor, more = None, True
+        while more:
+            keys, cursor, more = query.fetch_page(batch_size, keys_only=True, start_cursor=cursor)
+            for key in keys:
+                bloom_filter.add(key.id())
+        data = bloom_filter.to_bytes()
+        for retry in range(5):
+            if current is None:
+                stored = client.add("platform-filter", data, namespace="cache")
+            else:
+                stored = client.cas("platform-filter", data, namespace="cache")
+            if stored:
+                break
+            # platforms were added meanwhile, keep them (together with the deleted ones until the next rebuild)
+            current = client.gets("platform-filter", namespace="cache")
+            if current is not None:
+                data = str(bytearray(a | b for a, b in zip(bytearray(current), bytearray(bloom_filter.to_bytes()))))
+        memcache.incr("platform-filter-version", namespace="cache", initial_value=0)
+
+
+platform_filter = PlatformIdFilter(TRACKER_PLATFORM_FILTER, TRACKER_PLATFORM_FILTER_BITS,
+                                   PLATFORM_FILTER_CHECK_INTERVAL)
+
+
+def rebuild_platform_filter():
+    """Rebuild the shared filter of all platform IDs, run as a deferred task."""
+    platform_filter.rebuild()
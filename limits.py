@@ -0,0 +1,142 @@
+import threading
+import time
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from cache import get_int_setting
+from counters import get_counters_async
+from models import Campaign, get_platforms_async
+
+# number of clicks of a capped campaign an instance takes from the shared budget at once, clicks taken but not used
+# by an instance are lost, so the budget of a campaign may run out up to this many clicks per instance early
+TRACKER_CAP_LEASE_SIZE = get_int_setting("TRACKER_CAP_LEASE_SIZE", 10)
+# an instance takes this fraction of the per second rate limit of a campaign at once
+RATE_LEASE_FRACTION = 10
+# number of seconds an instance redirects clicks of a campaign with an exhausted budget without checking it again
+EXHAUSTED_CHECK_INTERVAL = 5
+# redirect of the clicks over the limits of campaigns without a cap link
+DEFAULT_CAP_LINK = "http://outfit7.com"
+
+
+def validate_limits(campaign_dict):
+    """
+    Validate the click limits of a campaign: click_cap (maximum number of counted clicks), rate_limit (maximum number
+    of counted clicks per second) and cap_link (redirect of the clicks over the limits), all optional and nullable.
+    :param campaign_dict: Dictionary with campaign data.
+    :return: List of error messages, empty if the limits are valid.
+    """
+    errors = []
+    for name in ("click_cap", "rate_limit"):
+        value = campaign_dict.get(name)
+        if value is not None and (not isinstance(value, (int, long)) or isinstance(value, bool) or value <= 0):
+            errors.append("%s parameter must be a positive integer." % name.replace("_", " ").capitalize())
+    if campaign_dict.get("cap_link") is not None and not isinstance(campaign_dict["cap_link"], basestring):
+        errors.append("Cap link parameter must be a link.")
+    return errors
+
+
+def get_campaign_clicks(campaign_id):
+    """Get the number of flushed clicks of the campaign on all platforms."""
+    platforms = get_platforms_async([ndb.Key(Campaign, campaign_id)]).get_result()[0]
+    return sum(get_counters_async(platforms).get_result())
+
+
+def cap_key(campaign_id, click_cap):
+    """Get the memcache key of the budget counter of the campaign, every click cap has its own budget."""
+    return "cap:%d:%d" % (campaign_id, click_cap)
+
+
+def reset_click_cap(campaign_id, click_cap, clicks):
+    """
+    Start the budget of the changed click cap of the campaign at its flushed clicks. Instances drop their leases of
+    the previous cap as soon as they see the new one, as its budget has a different key.
+    :param campaign_id: ID of the campaign.
+    :param click_cap: New click cap of the campaign.
+    :param clicks: Number of flushed clicks of the campaign.
+    """
+    memcache.set(cap_key(campaign_id, click_cap), clicks, namespace="limits")
+
+
+class ClickLimiter(object):
+    """
+    Token buckets limiting the counted clicks of campaigns, shared by all instances through memcache counters of the
+    taken tokens (namespace "limits"). The budget of a campaign is a single counter of all its counted clicks, the rate
+    limit a counter per second. Instead of taking a token per click, every instance leases a number of tokens at once
+    and takes the clicks from its lease without any RPC until it runs out.
+    """
+
+    def __init__(self, cap_lease_size):
+        self.cap_lease_size = cap_lease_size
+        # (kind, campaign ID) -> [memcache key, tokens left in the lease, time until which the bucket is exhausted]
+        self._leases = {}
+        self._lock = threading.Lock()
+
+    def check(self, campaign_id, limits):
+        """
+        Take a token for a click of the campaign.
+        :param campaign_id: ID of the campaign.
+        :param limits: Click limits of the campaign as returned by Campaign.get_limits.
+        :return: None if the click is counted, otherwise the reason ("rate_limited" or "capped").
+        """
+        now = time.time()
+        rate_limit = limits.get("rate_limit")
+        if rate_limit and not self._take(("rate", campaign_id), "rate:%d:%d" % (campaign_id, now), rate_limit,
+                                         max(1, rate_limit / RATE_LEASE_FRACTION), int(now) + 1, lambda: 0):
+            return "rate_limited"
+        click_cap = limits.get("click_cap")
+        if click_cap and not self._take(("cap", campaign_id), cap_key(campaign_id, click_cap), click_cap,
+                                        self.cap_lease_size, now + EXHAUSTED_CHECK_INTERVAL,
+                                        lambda: get_campaign_clicks(campaign_id)):
+            return "capped"
+        return None
+
+    def _take(self, lease_key, key, limit, lease_size, exhausted_until, initial):
+        """
+        Take a token from the lease, leasing new tokens from the shared counter if the lease ran out.
+        :param lease_key: Key of the lease of the instance.
+        :param key: Memcache key of the counter of taken tokens.
+        :param limit: Number of tokens in the bucket.
+        :param lease_size: Number of tokens leased at once.
+        :param exhausted_until: Time until which the bucket is not checked again if it is exhausted.
+        :param initial: Function getting the number of already taken tokens if the counter is missing.
+        :return: True if a token was taken.
+        """
+        exhausted = False
+        with self._lock:
+            lease = self._leases.get(lease_key)
+            if lease is not None and lease[0] == key:
+                if lease[1] > 0:
+                    lease[1] -= 1
+                    return True
+                if lease[2] > time.time():
+                    return False
+                exhausted = lease[2] > 0
+        if exhausted:
+            # an exhausted bucket is re-checked without taking tokens, so that the counter does not grow past the limit
+            taken = memcache.get(key, namespace="limits")
+            if taken is not None and taken >= limit:
+                with self._lock:
+                    self._leases[lease_key] = [key, 0, exhausted_until]
+                return False
+        taken = memcache.incr(key, delta=lease_size, namespace="limits")
+        if taken is None:
+            # the per second counters expire, budget counters evicted from memcache restart at the flushed clicks
+            memcache.add(key, initial(), time=2 if lease_key[0] == "rate" else 0, namespace="limits")
+            taken = memcache.incr(key, delta=lease_size, namespace="limits")
+            if taken is None:
+                # clicks are not limited while memcache is not available
+                return True
+        # tokens of the lease that are still within the limit, the rest of the lease is returned
+        tokens = min(lease_size, limit - (taken - lease_size))
+        if tokens < lease_size:
+            memcache.decr(key, delta=lease_size - max(tokens, 0), namespace="limits")
+        with self._lock:
+            if tokens > 0:
+                self._leases[lease_key] = [key, tokens - 1, 0]
+                return True
+            self._leases[lease_key] = [key, 0, exhausted_until]
+            return False
+
+
+click_limiter = ClickLimiter(TRACKER_CAP_LEASE_SIZE)
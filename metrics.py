@@ -0,0 +1,177 @@
+import bisect
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+
+from google.appengine.api import apiproxy_stub_map, memcache
+
+from cache import get_int_setting
+
+# upper bounds (in milliseconds) of the latency histogram buckets, the last bucket is unbounded
+HISTOGRAM_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+TRACKER_METRICS_FLUSH_INTERVAL = get_int_setting("TRACKER_METRICS_FLUSH_INTERVAL", 60)
+TRACKER_SERVER_TIMING = os.environ.get("TRACKER_SERVER_TIMING", "").lower() in ("1", "true", "yes")
+
+
+class Histogram(object):
+    """Latency histogram with fixed buckets, also keeping the number and the sum of the recorded values."""
+
+    def __init__(self):
+        self.buckets = [0] * (len(HISTOGRAM_BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def record(self, value):
+        self.buckets[bisect.bisect_left(HISTOGRAM_BUCKETS, value)] += 1
+        self.count += 1
+        self.total += value
+
+
+class Metrics(object):
+    """
+    Collects the latencies of requests and of the RPCs they make, by service and method. The histograms are kept in
+    memory and periodically added to the histograms shared by all instances in memcache.
+    """
+
+    def __init__(self, flush_interval=TRACKER_METRICS_FLUSH_INTERVAL):
+        self.flush_interval = flush_interval
+        self.histograms = defaultdict(Histogram)
+        self._flushed_at = time.time()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._hooked_proxy = None
+
+    def install_hooks(self):
+        """Register the RPC hooks with the current API proxy (it is replaced e.g. by the testbed)."""
+        proxy = apiproxy_stub_map.apiproxy
+        if proxy is not self._hooked_proxy:
+            proxy.GetPreCallHooks().Append("metrics", self._pre_call_hook)
+            proxy.GetPostCallHooks().Append("metrics", self._post_call_hook)
+            self._hooked_proxy = proxy
+
+    def _pre_call_hook(self, service, call, request, response, rpc):
+        rpcs = getattr(self._local, "rpcs", None)
+        if rpcs is not None:
+            rpcs[id(rpc)] = time.time()
+
+    def _post_call_hook(self, service, call, request, response, rpc, error):
+        rpcs = getattr(self._local, "rpcs", None)
+        start = rpcs.pop(id(rpc), None) if rpcs is not None else None
+        if start is not None:
+            self._local.timings.append(("%s.%s" % (service, call), (time.time() - start) * 1000))
+
+    def start_request(self):
+        """Start collecting the RPCs of the request handled by the current thread."""
+        self._local.rpcs = {}
+        self._local.timings = []
+
+    def end_request(self, name, latency):
+        """
+        Stop collecting the RPCs of the current request and record them together with the request latency.
+        :param name: Name of the application that handled the request.
+        :param latency: Latency of the request in milliseconds.
+        :return: List of (service.method, latency in milliseconds) tuples of the RPCs made by the request.
+        """
+        timings = self._local.timings
+        self._local.rpcs = None
+        self._local.timings = []
+        with self._lock:
+            self.histograms["request.%s" % name].record(latency)
+            for rpc_name, rpc_latency in timings:
+                self.histograms["rpc.%s" % rpc_name].record(rpc_latency)
+        if time.time() - self._flushed_at >= self.flush_interval:
+            self.flush()
+        return timings
+
+    def flush(self):
+        """Add the histograms collected since the last flush to the ones in memcache."""
+        with self._lock:
+            histograms, self.histograms = self.histograms, defaultdict(Histogram)
+            self._flushed_at = time.time()
+        if not histograms:
+            return
+        deltas = {}
+        for name, histogram in histograms.items():
+            for index, count in enumerate(histogram.buckets):
+                if count:
+                    deltas["%s|%d" % (name, index)] = count
+            deltas["%s|count" % name] = histogram.count
+            # memcache counters are integers, so the sum is kept in microseconds
+            deltas["%s|total_us" % name] = int(histogram.total * 1000)
+        try:
+            memcache.offset_multi(deltas, namespace="metrics", initial_value=0)
+            self._register_names(histograms.keys())
+        except Exception:
+            logging.exception("Could not flush the metrics.")
+
+    def _register_names(self, names):
+        """Add the names of the histograms to the index of all histograms in memcache."""
+        client = memcache.Client()
+        for retry in range(3):
+            index = client.gets("index", namespace="metrics")
+            if index is None:
+                if client.add("index", sorted(names), namespace="metrics"):
+                    return
+                continue
+            if set(names).issubset(index):
+                return
+            if client.cas("index", sorted(set(index).union(names)), namespace="metrics"):
+                return
+
+    def read(self):
+        """
+        Get the histograms shared by all instances from memcache.
+        :return: Dictionary of histogram names and dictionaries with count, mean (in milliseconds) and buckets.
+        """
+        names = memcache.get("index", namespace="metrics") or []
+        keys = []
+        for name in names:
+            keys.extend("%s|%d" % (name, index) for index in range(len(HISTOGRAM_BUCKETS) + 1))
+            keys.extend(["%s|count" % name, "%s|total_us" % name])
+        values = memcache.get_multi(keys, namespace="metrics")
+        output = {}
+        for name in names:
+            count = values.get("%s|count" % name) or 0
+            bounds = ["<=%d" % bound for bound in HISTOGRAM_BUCKETS] + [">%d" % HISTOGRAM_BUCKETS[-1]]
+            output[name] = {
+                "count": count,
+                "mean_ms": (values.get("%s|total_us" % name) or 0) / 1000.0 / count if count else 0,
+                "buckets_ms": {bound: values.get("%s|%d" % (name, index)) or 0
+                               for index, bound in enumerate(bounds)},
+            }
+        return output
+
+
+metrics = Metrics()
+
+
+class MetricsMiddleware(object):
+    """WSGI middleware recording the latency and the RPCs of every request, optionally reporting them to the client
+    in the Server-Timing header."""
+
+    def __init__(self, app, name, server_timing=TRACKER_SERVER_TIMING):
+        self.app = app
+        self.name = name
+        self.server_timing = server_timing
+
+    def __call__(self, environ, start_response):
+        metrics.install_hooks()
+        metrics.start_request()
+        start = time.time()
+
+        def _start_response(status, headers, exc_info=None):
+            if self.server_timing:
+                durations = defaultdict(float)
+                for rpc_name, latency in metrics._local.timings:
+                    durations[rpc_name.split(".", 1)[0]] += latency
+                durations["total"] = (time.time() - start) * 1000
+                headers.append(("Server-Timing", ", ".join("%s;dur=%.1f" % (service, duration)
+                                                           for service, duration in sorted(durations.items()))))
+            return start_response(status, headers, exc_info)
+
+        try:
+            return self.app(environ, _start_response)
+        finally:
+            metrics.end_request(self.name, (time.time() - start) * 1000)
@@ -1,24 +1,364 @@
+import logging
+from collections import defaultdict
+from datetime import datetime
+
 from google.appengine.api import memcache
 from google.appengine.ext import ndb
 
+from cache import get_int_setting, invalidate_responses
+from targets import compile_targets
+from uniques import FLUSHED_SKETCH, UNIQUES_CACHE_TIME, carried_sketch_key, close_sketches, merge_sketches
+
+TRACKER_COUNTER_UPDATE_INTERVAL_LENGTH = get_int_setting("TRACKER_COUNTER_UPDATE_INTERVAL_LENGTH", 1)
+# maximum number of entity groups accessed in a single cross-group transaction
+XG_TRANSACTION_LIMIT = 25
+# number of most recently flushed intervals remembered by every platform
+FLUSHED_INTERVALS_KEPT = 64
+# names of the platforms a campaign can be enabled on
+PLATFORMS = ("android", "ios", "wp")
+# lengths (in seconds) of the click statistics buckets
+BUCKET_RESOLUTIONS = {"minute": 60, "hour": 3600, "day": 86400}
+
+
+def counter_key(platform_id, interval_index):
+    """
+    Get the memcache key (in namespace "counters") of the platform clicks counter for the given interval.
+    :param platform_id: ID of the platform.
+    :param interval_index: Index of the interval or None for the counter used by older versions.
+    :return: Memcache key.
+    """
+    if interval_index is None:
+        return platform_id
+    return "%s:%d" % (platform_id, interval_index)
+
+
+def target_counter_key(platform_id, interval_index, target):
+    """Get the memcache key (in namespace "counters") of the clicks counter of a redirect target for the interval."""
+    return "%s:%d:%d" % (platform_id, interval_index, target)
+
 
 class Campaign(ndb.Model):
     name = ndb.StringProperty()
     link = ndb.StringProperty()
     create_date = ndb.DateTimeProperty(auto_now=True)
     update_date = ndb.DateTimeProperty()
+    # weighted redirect targets, list of dictionaries with link, weight, start and end, clicks outside of the time
+    # windows of all targets are redirected to the link
+    targets = ndb.JsonProperty()
+    # maximum numbers of counted clicks in total and per second, clicks over the limits are redirected to the cap link
+    click_cap = ndb.IntegerProperty(indexed=False)
+    rate_limit = ndb.IntegerProperty(indexed=False)
+    cap_link = ndb.StringProperty(indexed=False)
+
+    def get_limits(self):
+        """Get the click limits of the campaign that are denormalized onto its platforms, None if its clicks are not
+        limited."""
+        if not self.click_cap and not self.rate_limit:
+            return None
+        return {"click_cap": self.click_cap, "rate_limit": self.rate_limit, "cap_link": self.cap_link}
 
 
 class Platform(ndb.Model):
     name = ndb.StringProperty()
     counter = ndb.IntegerProperty(default=0)
     campaign = ndb.KeyProperty(kind=Campaign)
+    # campaign link denormalized onto the platform, so that a click can be resolved with a single get
+    link = ndb.StringProperty(indexed=False)
+    # redirect targets of the campaign compiled by compile_targets and the numbers of clicks redirected to every target
+    targets = ndb.JsonProperty()
+    target_counters = ndb.IntegerProperty(repeated=True, indexed=False)
+    # click limits of the campaign as returned by Campaign.get_limits
+    limits = ndb.JsonProperty()
+
+    # indexes of the most recently flushed intervals, making repeated flushes of the same interval a no-op
+    flushed_intervals = ndb.IntegerProperty(repeated=True, indexed=False)
+    # number of CounterShard entities holding the clicks of the platform, 0 if clicks are counted in memcache
+    counter_shards = ndb.IntegerProperty(default=0, indexed=False)
+    # serialized HyperLogLog sketch of the visitors of the platform
+    uniques = ndb.BlobProperty(compressed=True)
+
+    def set_route(self, campaign):
+        """
+        Denormalize the link, the compiled redirect targets and the click limits of the campaign onto the platform.
+        Clicks of the targets are reset if the targets change.
+        :return: True if the platform was changed.
+        """
+        targets = compile_targets(campaign.targets)
+        limits = campaign.get_limits()
+        if self.link == campaign.link and self.targets == targets and self.limits == limits:
+            return False
+        if self.targets != targets:
+            self.targets = targets
+            self.target_counters = [0] * len(targets["links"]) if targets else []
+        self.link = campaign.link
+        self.limits = limits
+        return True
+
+    def shard_keys(self):
+        """Get the keys of all counter shards of the platform."""
+        return [CounterShard.key_for(self.key.id(), index) for index in range(self.counter_shards)]
+
+    @classmethod
+    def increment(cls, platform_id):
+        """Flush the clicks counted by older versions. Kept for the deferred tasks enqueued by them."""
+        cls.flush_counters([(platform_id, None)])
+
+    @classmethod
+    def flush_counters(cls, intervals):
+        """
+        Store the clicks counted in memcache during the given (already closed) intervals into the Datastore. Every
+        interval is added to the platform counter at most once, even if it is flushed concurrently or repeatedly.
+        Intervals whose counters were evicted from memcache are skipped.
+        :param intervals: List of (platform ID, interval index) tuples.
+        :return: Tuple of the number of flushed intervals and dictionary of platform IDs and numbers of their clicks.
+        """
+        keys = {counter_key(platform_id, interval_index): (platform_id, interval_index)
+                for platform_id, interval_index in intervals}
+        carried_keys = {carried_sketch_key(platform_id): platform_id for platform_id, interval_index in intervals}
+        values = memcache.get_multi(keys.keys(), namespace="counters")
+        # the sketches are read for compare-and-set, so that the ones merged after the read are not lost
+        client = memcache.Client()
+        sketches = client.get_multi(keys.keys() + carried_keys.keys(), namespace="uniques", for_cas=True)
+        deltas = defaultdict(dict)
+        for key, value in values.items():
+            if value:
+                platform_id, interval_index = keys[key]
+                sketch = sketches.get(key)
+                deltas[platform_id][interval_index] = (value, sketch if sketch != FLUSHED_SKETCH else None)
+        # visitors merged after their intervals were flushed are added to the earliest flushed interval of the platform
+        carried = []
+        for carried_key, platform_id in carried_keys.items():
+            if sketches.get(carried_key) and platform_id in deltas:
+                interval_index = min(deltas[platform_id])
+                value, sketch = deltas[platform_id][interval_index]
+                deltas[platform_id][interval_index] = (value, merge_sketches(sketch, sketches[carried_key]))
+                carried.append(carried_key)
+
+        # platforms of a campaign are flushed in the same transaction
+        campaigns = defaultdict(list)
+        for platform_id in deltas:
+            campaigns[platform_id.rsplit("-", 1)[0]].append(platform_id)
+        chunks = [[]]
+        for platform_ids in campaigns.values():
+            if len(chunks[-1]) + len(platform_ids) > XG_TRANSACTION_LIMIT:
+                chunks.append([])
+            chunks[-1].extend(platform_ids)
+        futures = [cls._flush_counters_async(platform_ids, deltas) for platform_ids in chunks if platform_ids]
+        ndb.Future.wait_all(futures)
+        # raise any error before the counters are removed, so that the flush is retried
+        totals = defaultdict(int)
+        total_sketches = {}
+        target_keys = []
+        for future in futures:
+            platform_totals, platform_sketches, platform_target_keys = future.get_result()
+            target_keys.extend(platform_target_keys)
+            for platform_name, value in platform_totals.items():
+                totals[platform_name] += value
+            for platform_name, sketch in platform_sketches.items():
+                total_sketches[platform_name] = merge_sketches(total_sketches.get(platform_name), sketch)
+        try:
+            PlatformTotal.add(totals, total_sketches)
+        except Exception, e:
+            # retrying the flush would not help, the intervals are already flushed
+            logging.exception("Could not update the platform totals, they need to be recomputed.")
+        memcache.delete_multi(keys.keys() + target_keys, namespace="counters")
+        close_sketches(client, keys.keys(), sketches)
+        # carried sketches changed since the read are kept for the next flush, merging them again is idempotent
+        client.cas_multi(dict((key, "") for key in carried), time=UNIQUES_CACHE_TIME, namespace="uniques")
+        if deltas:
+            invalidate_responses(set(platform_id.rsplit("-", 1)[0] for platform_id in deltas))
+        return (sum(len(platform_deltas) for platform_deltas in deltas.values()),
+                {platform_id: sum(value for value, sketch in platform_deltas.values())
+                 for platform_id, platform_deltas in deltas.items()})
 
     @classmethod
-    def increment(cls, platform_id):  #
-        platform = cls.get_by_id(platform_id)
-        if platform:
-            value = memcache.get(platform.key.id(), namespace="counters")
-            memcache.decr(platform.key.id(), delta=value, namespace="counters")
-            platform.counter += value
-            platform.put()
+    @ndb.transactional_tasklet(xg=True)
+    def _flush_counters_async(cls, platform_ids, deltas):
+        """
+        Add the interval deltas to the counters and the click statistics buckets of given platforms in a single
+        transaction. Counters of sharded platforms are kept in their shards, so only their statistics are updated.
+        Visitor sketches of the intervals are merged into the sketches of the platforms and the buckets and clicks of
+        the redirect targets into the target counters. Returns the number of added clicks and the merged visitor
+        sketches per platform name and the memcache keys of the flushed target counters.
+        """
+        platforms = yield ndb.get_multi_async([ndb.Key(cls, platform_id) for platform_id in platform_ids])
+        # platforms that no longer exist are skipped, their clicks are discarded
+        platforms = [platform for platform in platforms if platform]
+        pending = []
+        for platform in platforms:
+            for interval_index, (value, sketch) in deltas[platform.key.id()].items():
+                if interval_index not in platform.flushed_intervals:
+                    pending.append((platform, interval_index, value, sketch))
+
+        # buckets are children of the platforms, so they do not add entity groups to the transaction
+        bucket_keys = set()
+        for platform, interval_index, value, sketch in pending:
+            if interval_index is not None:
+                bucket_keys.update(ClickBucket.keys_for(platform.key.id(),
+                                                        interval_index * TRACKER_COUNTER_UPDATE_INTERVAL_LENGTH))
+        bucket_keys = list(bucket_keys)
+        buckets = yield ndb.get_multi_async(bucket_keys)
+        buckets = {key: bucket or ClickBucket.from_key(key) for key, bucket in zip(bucket_keys, buckets)}
+
+        # target counters are only read for the platforms with redirect targets, the reads are batched by the context
+        context = ndb.get_context()
+        targets = [(platform, target, target_counter_key(platform.key.id(), interval_index, target))
+                   for platform, interval_index, value, sketch in pending
+                   if interval_index is not None and platform.targets
+                   for target in range(len(platform.targets["links"]))]
+        target_values = yield [context.memcache_get(key, namespace="counters") for platform, target, key in targets]
+        for (platform, target, key), value in zip(targets, target_values):
+            if value and target < len(platform.target_counters):
+                platform.target_counters[target] += value
+
+        totals = defaultdict(int)
+        sketches = {}
+        for platform, interval_index, value, sketch in pending:
+            totals[platform.name] += value
+            if not platform.counter_shards:
+                platform.counter += value
+            if sketch:
+                platform.uniques = merge_sketches(platform.uniques, sketch)
+                sketches[platform.name] = merge_sketches(sketches.get(platform.name), sketch)
+            if interval_index is not None:
+                platform.flushed_intervals.append(interval_index)
+                for key in ClickBucket.keys_for(platform.key.id(),
+                                                interval_index * TRACKER_COUNTER_UPDATE_INTERVAL_LENGTH):
+                    buckets[key].count += value
+                    if sketch:
+                        buckets[key].uniques = merge_sketches(buckets[key].uniques, sketch)
+        for platform in platforms:
+            platform.flushed_intervals = sorted(platform.flushed_intervals)[-FLUSHED_INTERVALS_KEPT:]
+        yield ndb.put_multi_async(platforms + buckets.values())
+        raise ndb.Return((dict(totals), sketches, [key for platform, target, key in targets]))
+
+
+@ndb.tasklet
+def get_platforms_async(campaign_keys):
+    """
+    Fetch the platforms of given campaigns with a single batch get, using the deterministic platform IDs.
+    :param campaign_keys: List of campaign keys.
+    :return: List of lists of Platform instances (ordered by name), one for every campaign.
+    """
+    keys = [ndb.Key(Platform, "%d-%s" % (campaign_key.id(), platform_name))
+            for campaign_key in campaign_keys for platform_name in PLATFORMS]
+    platforms = yield ndb.get_multi_async(keys)
+    raise ndb.Return([filter(None, platforms[i:i + len(PLATFORMS)]) for i in range(0, len(platforms), len(PLATFORMS))])
+
+
+class CounterShard(ndb.Model):
+    """One of the shards of a durable platform clicks counter. Every shard is a separate entity group, so that the
+    platform can be clicked more often than an entity group can be updated."""
+    count = ndb.IntegerProperty(default=0, indexed=False)
+
+    @classmethod
+    def key_for(cls, platform_id, index):
+        return ndb.Key(cls, "%s-%d" % (platform_id, index))
+
+
+class ClickBucket(ndb.Model):
+    """Number of clicks of the parent platform during a minute, an hour or a day, starting at start."""
+    resolution = ndb.StringProperty()
+    start = ndb.DateTimeProperty()
+    count = ndb.IntegerProperty(default=0, indexed=False)
+    # serialized HyperLogLog sketch of the visitors during the bucket
+    uniques = ndb.BlobProperty(compressed=True)
+
+    @classmethod
+    def key_for(cls, platform_id, resolution, timestamp):
+        """
+        Get the key of the platform bucket with given resolution that contains the timestamp.
+        :param platform_id: ID of the platform.
+        :param resolution: Resolution of the bucket, one of the BUCKET_RESOLUTIONS.
+        :param timestamp: UNIX timestamp.
+        :return: Key of the bucket.
+        """
+        start = int(timestamp) - int(timestamp) % BUCKET_RESOLUTIONS[resolution]
+        return ndb.Key(Platform, platform_id, cls, "%s-%d" % (resolution, start))
+
+    @classmethod
+    def keys_for(cls, platform_id, timestamp):
+        """Get the keys of the platform buckets of all resolutions that contain the timestamp."""
+        return [cls.key_for(platform_id, resolution, timestamp) for resolution in BUCKET_RESOLUTIONS]
+
+    @classmethod
+    def from_key(cls, key):
+        """Construct an empty bucket with given key."""
+        resolution, start = key.id().rsplit("-", 1)
+        return cls(key=key, resolution=resolution, start=datetime.utcfromtimestamp(int(start)))
+
+
+class PlatformTotal(ndb.Model):
+    """Pre-aggregated number of clicks and visitors on all campaigns on a platform, the name of the platform is the
+    ID."""
+    counter = ndb.IntegerProperty(default=0, indexed=False)
+    # serialized HyperLogLog sketch of the visitors of all campaigns on the platform
+    uniques = ndb.BlobProperty(compressed=True)
+
+    @classmethod
+    def add(cls, deltas, sketches=None):
+        """
+        Add the numbers of clicks to the platform totals, merge the visitor sketches into them and drop their cached
+        values. Totals that do not exist yet are skipped, they are computed from the platforms when first read.
+        :param deltas: Dictionary of platform names and numbers of clicks to add (negative to subtract).
+        :param sketches: Dictionary of platform names and serialized visitor sketches to merge.
+        """
+        sketches = sketches or {}
+        platform_names = set(deltas) | set(sketches)
+        if platform_names:
+            cls._add(platform_names, deltas, sketches)
+            memcache.delete_multi(list(platform_names), namespace="platform-totals")
+
+    @classmethod
+    @ndb.transactional(xg=True)
+    def _add(cls, platform_names, deltas, sketches):
+        totals = filter(None, ndb.get_multi([ndb.Key(cls, platform_name) for platform_name in platform_names]))
+        for total in totals:
+            total.counter += deltas.get(total.key.id(), 0)
+            total.uniques = merge_sketches(total.uniques, sketches.get(total.key.id()))
+        ndb.put_multi(totals)
+
+
+class ClickEventLog(ndb.Model):
+    """Append-only batch of raw click events captured by the click handler, the ID is the name of the task that
+    delivered the batch, so that storing a batch again does not duplicate it."""
+    # time of the first event in the batch
+    start = ndb.DateTimeProperty()
+    count = ndb.IntegerProperty(default=0, indexed=False)
+    # list of [UNIX timestamp, platform ID, user agent, referrer, country, reason] lists, reason is None for the
+    # counted clicks and missing in the events captured by older versions
+    events = ndb.JsonProperty(compressed=True)
+
+
+class CampaignExport(ndb.Model):
+    """Background export of all campaigns with their platform counters. The export is written as ExportChunk entities
+    (children of the export) together with the cursor of the next campaign, so an interrupted export resumes where it
+    stopped."""
+    format = ndb.StringProperty(indexed=False)
+    # one of "running" and "done"
+    status = ndb.StringProperty(default="running")
+    # urlsafe cursor of the next campaign to export, None before the first batch
+    cursor = ndb.StringProperty(indexed=False)
+    rows = ndb.IntegerProperty(default=0, indexed=False)
+    chunks = ndb.IntegerProperty(default=0, indexed=False)
+    create_date = ndb.DateTimeProperty(auto_now_add=True)
+    update_date = ndb.DateTimeProperty(auto_now=True)
+
+
+class ExportChunk(ndb.Model):
+    """Part of the exported data of a CampaignExport, the IDs of the chunks of an export are 1, 2, 3..."""
+    data = ndb.BlobProperty(compressed=True)
+
+
+class CounterAudit(ndb.Model):
+    """Comparison of the clicks flushed during an hour with the clicks in the event log, the ID is the UNIX timestamp
+    of the start of the hour."""
+    start = ndb.DateTimeProperty()
+    # numbers of clicks of all platforms flushed into the hour buckets, logged in the event log and replayed
+    counted = ndb.IntegerProperty(default=0, indexed=False)
+    logged = ndb.IntegerProperty(default=0, indexed=False)
+    replayed = ndb.IntegerProperty(default=0, indexed=False)
+    # list of dictionaries with the campaign ID, platform name and counted and logged clicks of the platforms with
+    # the largest drift
+    platforms = ndb.JsonProperty(compressed=True)
+    create_date = ndb.DateTimeProperty(auto_now_add=True)
@@ -0,0 +1,129 @@
+import math
+import time
+
+from google.appengine.api import memcache
+
+from cache import LRUCache, get_int_setting
+from models import TRACKER_COUNTER_UPDATE_INTERVAL_LENGTH
+
+# number of seconds over which the click rates are averaged (the time constant of their exponential decay)
+TRACKER_RATE_TIME_CONSTANT = get_int_setting("TRACKER_RATE_TIME_CONSTANT", 60)
+# click rate (clicks per second) above which the counters of a campaign are flushed less often, the flush interval
+# doubles with every doubling of the rate, up to TRACKER_COUNTER_MAX_INTERVAL_FACTOR times the interval length
+TRACKER_HOT_CLICK_RATE = get_int_setting("TRACKER_HOT_CLICK_RATE", 1)
+TRACKER_COUNTER_MAX_INTERVAL_FACTOR = get_int_setting("TRACKER_COUNTER_MAX_INTERVAL_FACTOR", 16)
+# number of campaigns tracked by the hot campaigns sketch
+TRACKER_HOT_CAMPAIGNS_CAPACITY = get_int_setting("TRACKER_HOT_CAMPAIGNS_CAPACITY", 100)
+
+# in-process cache of the interval factors of the campaigns (campaign ID -> factor), the factors only change when the
+# counters are flushed, so every instance reads the factor of a campaign from memcache at most once per interval
+interval_factor_cache = LRUCache(max_size=get_int_setting("TRACKER_INTERVAL_FACTOR_CACHE_SIZE", 10000),
+                                 ttl=TRACKER_COUNTER_UPDATE_INTERVAL_LENGTH)
+
+
+def get_interval_factor(rate):
+    """
+    Get the number of consecutive intervals whose counters are flushed together for the given click rate, a power of
+    two between 1 and TRACKER_COUNTER_MAX_INTERVAL_FACTOR.
+    """
+    factor = 1
+    while factor * 2 <= TRACKER_COUNTER_MAX_INTERVAL_FACTOR and rate >= TRACKER_HOT_CLICK_RATE * factor * 2:
+        factor *= 2
+    return factor
+
+
+class SpaceSaving(object):
+    """
+    Space-saving sketch of the heaviest hitters among weighted items, using a fixed number of counters. Every counter
+    overestimates the weight of its item by at most its error. All counters are decayed together, so the sketch
+    follows the recent weights.
+    """
+
+    def __init__(self, capacity, counters=None):
+        self.capacity = capacity
+        # item -> [weight, error]
+        self.counters = counters or {}
+
+    def add(self, item, weight):
+        counter = self.counters.get(item)
+        if counter is not None:
+            counter[0] += weight
+        elif len(self.counters) < self.capacity:
+            self.counters[item] = [weight, 0]
+        else:
+            # the new item replaces the lightest one, inheriting its weight as the error
+            lightest = min(self.counters, key=lambda key: self.counters[key][0])
+            minimum = self.counters.pop(lightest)[0]
+            self.counters[item] = [minimum + weight, minimum]
+
+    def decay(self, factor):
+        for counter in self.counters.values():
+            counter[0] *= factor
+            counter[1] *= factor
+
+    def top(self, limit):
+        """Get the list of (item, weight, error) tuples of the limit heaviest items."""
+        items = sorted(self.counters.items(), key=lambda item: -item[1][0])[:limit]
+        return [(item, weight, error) for item, (weight, error) in items]
+
+
+def update_rates(clicks):
+    """
+    Update the decayed click rates, the interval factors and the hot campaigns sketch with the flushed clicks.
+    :param clicks: Dictionary of campaign IDs and numbers of flushed clicks.
+    """
+    if not clicks:
+        return
+    now = time.time()
+    keys = [str(campaign_id) for campaign_id in clicks]
+    rates = memcache.get_multi(keys, namespace="rates")
+    new_rates = {}
+    for key, campaign_id in zip(keys, clicks):
+        decayed, updated_at, factor = rates.get(key, (0.0, now, 1))
+        decayed = decayed * math.exp((updated_at - now) / TRACKER_RATE_TIME_CONSTANT) + clicks[campaign_id]
+        new_rates[key] = (decayed, now, get_interval_factor(decayed / TRACKER_RATE_TIME_CONSTANT))
+    memcache.set_multi(new_rates, time=10 * TRACKER_RATE_TIME_CONSTANT, namespace="rates")
+
+    client = memcache.Client()
+    for retry in range(3):
+        value = client.gets("hot-campaigns", namespace="rates")
+        counters, updated_at = value if value is not None else ({}, now)
+        sketch = SpaceSaving(TRACKER_HOT_CAMPAIGNS_CAPACITY, counters)
+        sketch.decay(math.exp((updated_at - now) / TRACKER_RATE_TIME_CONSTANT))
+        for campaign_id, count in clicks.items():
+            sketch.add(int(campaign_id), count)
+        if value is None:
+            if client.add("hot-campaigns", (sketch.counters, now), namespace="rates"):
+                return
+        elif client.cas("hot-campaigns", (sketch.counters, now), namespace="rates"):
+            return
+
+
+def get_campaign_interval_factor(campaign_id):
+    """
+    Get the current number of consecutive intervals whose counters of the campaign are flushed together. The factor is
+    cached in process for an interval, so marking the platforms dirty does not wait for memcache on every interval.
+    """
+    key = str(campaign_id)
+    factor = interval_factor_cache.get(key)
+    if factor is None:
+        rate = memcache.get(key, namespace="rates")
+        factor = rate[2] if rate is not None else 1
+        interval_factor_cache.set(key, factor)
+    return factor
+
+
+def get_hot_campaigns(limit):
+    """
+    Get the campaigns with the highest recent click rates.
+    :param limit: Number of campaigns.
+    :return: List of (campaign ID, clicks per second, maximum overestimation of the rate) tuples.
+    """
+    value = memcache.get("hot-campaigns", namespace="rates")
+    if value is None:
+        return []
+    counters, updated_at = value
+    # decayed numbers of clicks are converted to rates by dividing them with the time constant
+    scale = math.exp((updated_at - time.time()) / TRACKER_RATE_TIME_CONSTANT) / TRACKER_RATE_TIME_CONSTANT
+    return [(campaign_id, weight * scale, error * scale)
+            for campaign_id, weight, error in SpaceSaving(TRACKER_HOT_CAMPAIGNS_CAPACITY, counters).top(limit)]
@@ -0,0 +1,68 @@
+import json
+from datetime import datetime
+
+from google.appengine.ext import ndb
+
+from models import Campaign, Platform
+
+# internal properties of the platforms that are not shown by the admin API
+HIDDEN_PLATFORM_FIELDS = {"campaign", "link", "flushed_intervals", "counter_shards", "uniques", "targets", "limits"}
+# fields of the serialized entities and those holding datetimes, computed once from the model definitions
+CAMPAIGN_FIELDS = tuple(sorted(Campaign._properties))
+CAMPAIGN_DATE_FIELDS = frozenset(name for name in CAMPAIGN_FIELDS
+                                 if isinstance(Campaign._properties[name], ndb.DateTimeProperty))
+# optional campaign fields that are left out of the serialized campaign while they are not set
+OPTIONAL_CAMPAIGN_FIELDS = frozenset(["targets", "click_cap", "rate_limit", "cap_link"])
+PLATFORM_FIELDS = tuple(sorted(name for name in Platform._properties if name not in HIDDEN_PLATFORM_FIELDS))
+
+
+def json_serial(obj):
+    """JSON serializer for datetime objects."""
+    if isinstance(obj, datetime):
+        serial = obj.isoformat()
+        return serial
+    raise TypeError("Type not serializable")
+
+
+# encoders are built once, json.dumps builds a new one for every call with non-default options; the compact encoder
+# does not sort the keys, so it uses the C accelerated encoder
+_encoder = json.JSONEncoder(default=json_serial, sort_keys=True)
+_compact_encoder = json.JSONEncoder(default=json_serial, separators=(",", ":"))
+
+
+def encode(value, compact=False):
+    """
+    Serialize the value to JSON.
+    :param value: Value of the admin API response.
+    :param compact: If True the keys are not sorted and there is no whitespace, otherwise the keys are sorted.
+    :return: JSON string.
+    """
+    return (_compact_encoder if compact else _encoder).encode(value)
+
+
+def campaign_fields(campaign):
+    """
+    Get the fields of the Campaign instance as a dictionary that is suitable for JSON serialization, without the
+    generic to_dict conversion. Optional fields that are not set are left out.
+    :param campaign: Campaign instance.
+    :return: Dictionary
+    """
+    output = {}
+    for name in CAMPAIGN_FIELDS:
+        value = getattr(campaign, name)
+        if not value and name in OPTIONAL_CAMPAIGN_FIELDS:
+            continue
+        output[name] = value.isoformat() if value is not None and name in CAMPAIGN_DATE_FIELDS else value
+    if campaign.get_limits() is None:
+        # the cap link is only used while the clicks of the campaign are limited
+        output.pop("cap_link", None)
+    return output
+
+
+def platform_fields(platform):
+    """
+    Get the public fields of the Platform instance as a dictionary that is suitable for JSON serialization.
+    :param platform: Platform instance.
+    :return: Dictionary
+    """
+    return {name: getattr(platform, name) for name in PLATFORM_FIELDS}
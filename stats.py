@@ -0,0 +1,88 @@
+import time
+from datetime import datetime
+
+from google.appengine.ext import ndb
+from google.appengine.ext.deferred import deferred
+
+from cache import get_int_setting
+from models import BUCKET_RESOLUTIONS, ClickBucket, Platform
+from uniques import merge_sketches
+
+# number of seconds the buckets of given resolution are kept, day buckets are kept forever
+BUCKET_RETENTION = {
+    "minute": get_int_setting("TRACKER_STATS_MINUTE_RETENTION", 2 * 86400),
+    "hour": get_int_setting("TRACKER_STATS_HOUR_RETENTION", 90 * 86400),
+}
+# maximum number of buckets per platform returned by a single statistics query
+MAX_BUCKETS = 1000
+# number of seconds a bucket deletion task runs before the deletion is continued by a new task
+BUCKET_DELETION_DURATION = 300
+
+
+def get_click_series(platform_ids, resolution, start, end):
+    """
+    Get the number of clicks on given platforms and the sketch of their visitors in consecutive buckets of given
+    resolution. Only the pre-aggregated buckets are read, so the cost depends on the number of buckets and not on the
+    number of clicks.
+    :param platform_ids: List of platform IDs whose clicks are added up.
+    :param resolution: Resolution of the buckets, one of the BUCKET_RESOLUTIONS.
+    :param start: UNIX timestamp of the start of the range (inclusive).
+    :param end: UNIX timestamp of the end of the range (exclusive).
+    :return: List of (bucket start UNIX timestamp, number of clicks, serialized visitor sketch or None) tuples.
+    """
+    length = BUCKET_RESOLUTIONS[resolution]
+    first_start = start - start % length
+    if (end - first_start + length - 1) / length > MAX_BUCKETS:
+        raise ValueError("Range contains more than %d buckets." % MAX_BUCKETS)
+    bucket_starts = range(first_start, end, length)
+    keys = [ClickBucket.key_for(platform_id, resolution, bucket_start)
+            for bucket_start in bucket_starts for platform_id in platform_ids]
+    buckets = iter(ndb.get_multi(keys))
+    series = []
+    for bucket_start in bucket_starts:
+        platform_buckets = filter(None, (next(buckets) for _ in platform_ids))
+        series.append((bucket_start, sum(bucket.count for bucket in platform_buckets),
+                       merge_sketches(*[bucket.uniques for bucket in platform_buckets])))
+    return series
+
+
+def compact_buckets(batch_size=500):
+    """
+    Delete the minute and hour buckets that are older than their retention period. Their clicks remain available in
+    the buckets of the coarser resolutions, which are maintained together with them.
+    :param batch_size: Number of buckets deleted in a single batch.
+    :return: Number of deleted buckets.
+    """
+    deleted = 0
+    for resolution, retention in BUCKET_RETENTION.items():
+        cutoff = datetime.utcfromtimestamp(time.time() - retention)
+        query = ClickBucket.query(ClickBucket.resolution == resolution, ClickBucket.start < cutoff)
+        cursor, more = None, True
+        while more:
+            keys, cursor, more = query.fetch_page(batch_size, keys_only=True, start_cursor=cursor)
+            ndb.delete_multi(keys)
+            deleted += len(keys)
+    return deleted
+
+
+def delete_platform_buckets(platform_ids, batch_size=500):
+    """
+    Delete all buckets of the deleted platforms, which are not removed by the retention, with keys only ancestor
+    queries. Run as a deferred task, which continues in a new task if there are too many buckets.
+    :param platform_ids: List of IDs of the deleted platforms.
+    :param batch_size: Number of buckets deleted in a single batch.
+    :return: Number of deleted buckets.
+    """
+    start = time.time()
+    deleted = 0
+    for index, platform_id in enumerate(platform_ids):
+        if time.time() - start > BUCKET_DELETION_DURATION:
+            deferred.defer(delete_platform_buckets, platform_ids[index:], batch_size)
+            break
+        query = ClickBucket.query(ancestor=ndb.Key(Platform, platform_id))
+        cursor, more = None, True
+        while more:
+            keys, cursor, more = query.fetch_page(batch_size, keys_only=True, start_cursor=cursor)
+            ndb.delete_multi(keys)
+            deleted += len(keys)
+    return deleted
@@ -0,0 +1,91 @@
+import bisect
+import random
+import time
+
+# maximum number of weighted redirect targets of a campaign
+MAX_TARGETS = 10
+
+
+def validate_targets(targets):
+    """
+    Validate the redirect targets of a campaign, a list of dictionaries with the link, optional weight (a positive
+    integer, default 1) and optional start and end (UNIX timestamps) of the time window in which the target is active.
+    :param targets: Targets from the request.
+    :return: List of error messages, empty if the targets are valid.
+    """
+    if not isinstance(targets, list):
+        return ["Targets parameter must be a list of targets."]
+    if len(targets) > MAX_TARGETS:
+        return ["Targets parameter must contain at most %d targets." % MAX_TARGETS]
+    errors = []
+    for index, target in enumerate(targets):
+        if not isinstance(target, dict):
+            errors.append("Target %d must be an object." % index)
+            continue
+        for invalid_key in set(target).difference({"link", "weight", "start", "end"}):
+            errors.append("Target %d contains invalid parameter '%s'." % (index, invalid_key))
+        if not isinstance(target.get("link"), basestring) or not target["link"]:
+            errors.append("Target %d must have a link." % index)
+        weight = target.get("weight", 1)
+        if not isinstance(weight, (int, long)) or isinstance(weight, bool) or weight <= 0:
+            errors.append("Target %d weight must be a positive integer." % index)
+        for name in ("start", "end"):
+            if target.get(name) is not None and not isinstance(target[name], (int, long, float)):
+                errors.append("Target %d %s must be a UNIX timestamp." % (index, name))
+        if isinstance(target.get("start"), (int, long, float)) and isinstance(target.get("end"), (int, long, float)) \
+                and target["start"] >= target["end"]:
+            errors.append("Target %d must start before it ends." % index)
+    return errors
+
+
+def normalize_targets(targets):
+    """Fill in the default weight and time window of the validated targets."""
+    return [{"link": target["link"], "weight": target.get("weight", 1), "start": target.get("start"),
+             "end": target.get("end")} for target in targets]
+
+
+def compile_targets(targets):
+    """
+    Compile the normalized targets into a table that resolves a click with a binary search for the time segment and
+    one random draw and binary search for the target. The time is split into segments at the starts and ends of the
+    target windows, every segment lists the cumulative weights of its active targets.
+    :param targets: List of normalized targets or None.
+    :return: Dictionary with the target links, the segment starts and the cumulative weights and target indexes of
+    every segment, or None if there are no targets.
+    """
+    if not targets:
+        return None
+    boundaries = {0}
+    for target in targets:
+        boundaries.update(target[name] for name in ("start", "end") if target[name] is not None)
+    table = {"links": [target["link"] for target in targets], "starts": [], "weights": [], "targets": []}
+    for start in sorted(boundaries):
+        active = [index for index, target in enumerate(targets)
+                  if (target["start"] is None or target["start"] <= start) and
+                  (target["end"] is None or start < target["end"])]
+        if table["targets"] and table["targets"][-1] == active:
+            # the segment continues the previous one
+            continue
+        weights = []
+        for index in active:
+            weights.append((weights[-1] if weights else 0) + targets[index]["weight"])
+        table["starts"].append(start)
+        table["weights"].append(weights)
+        table["targets"].append(active)
+    return table
+
+
+def pick_target(table, now=None):
+    """
+    Pick the redirect target of a click.
+    :param table: Compiled targets as returned by compile_targets or None.
+    :param now: UNIX timestamp of the click, the current time if None.
+    :return: Index of the target or None if no target is active (the click is redirected to the campaign link).
+    """
+    if not table:
+        return None
+    segment = bisect.bisect_right(table["starts"], time.time() if now is None else now) - 1
+    if segment < 0 or not table["weights"][segment]:
+        return None
+    weights = table["weights"][segment]
+    return table["targets"][segment][bisect.bisect_right(weights, random.random() * weights[-1])]
@@ -11,7 +11,7 @@ SDK_PATH    Path to Google Cloud or Google App Engine SDK installation, usually
 TEST_PATH   Path to package containing test modules"""
 
 
-def main(sdk_path, test_path):
+def fix_sys_path(sdk_path):
     # If the sdk path points to a google cloud sdk installation
     # then we should alter it to point to the GAE platform location.
     if os.path.exists(os.path.join(sdk_path, 'platform/google_appengine')):
@@ -33,6 +33,10 @@ def main(sdk_path, test_path):
     except ImportError:
         print "Note: unable to import appengine_config."
 
+
+def main(sdk_path, test_path):
+    fix_sys_path(sdk_path)
+
     # Discover and run tests.
     suite = unittest.loader.TestLoader().discover(test_path)
     ret = unittest.TextTestRunner(verbosity=2).run(suite).wasSuccessful()
@@ -3,16 +3,34 @@ import base64
 import json
 import os
 import random
+import time
 import unittest
 from copy import deepcopy
+from datetime import datetime
 
 import webtest
+from google.appengine.api import datastore_errors, memcache
 from google.appengine.datastore import datastore_stub_util
-from google.appengine.ext import testbed
+from google.appengine.ext import ndb, testbed
 from google.appengine.ext.deferred import deferred
 
 from admin import app as admin_app
-from tracker import app as tracker_app
+from audit import audit_counters
+from cache import LRUCache, negative_cache, routing_cache
+from counters import COUNTERS_QUEUE, flush_counters, get_interval_index
+from events import EVENTS_QUEUE, TRACKER_EVENT_BATCH_SIZE, event_buffer, store_events
+from export import run_export
+from filters import DEDUP_FILTER_HASHES, RotatingBloomFilter, click_filter, platform_filter
+from limits import ClickLimiter, cap_key, click_limiter
+from metrics import MetricsMiddleware, metrics
+from models import Campaign, ClickBucket, ClickEventLog, Platform, PlatformTotal, counter_key
+from rates import (TRACKER_COUNTER_MAX_INTERVAL_FACTOR, TRACKER_HOT_CAMPAIGNS_CAPACITY, TRACKER_RATE_TIME_CONSTANT,
+                   SpaceSaving, get_campaign_interval_factor, interval_factor_cache, update_rates)
+from serializers import HIDDEN_PLATFORM_FIELDS, encode, platform_fields
+from targets import compile_targets, normalize_targets, pick_target
+import tracker
+from tracker import app as tracker_app, ship_buffers, uniques_buffer
+from uniques import FLUSHED_SKETCH, HyperLogLog, carried_sketch_key
 
 
 class TrackerTest(unittest.TestCase):
@@ -35,7 +53,7 @@ class TrackerTest(unittest.TestCase):
         self.testbed.init_memcache_stub()
 
         self.testbed.init_taskqueue_stub(
-            root_path=os.path.join(os.path.dirname(__file__), 'resources'))
+            root_path=os.path.dirname(os.path.abspath(__file__)))
         self.taskqueue_stub = self.testbed.get_stub(
             testbed.TASKQUEUE_SERVICE_NAME)
 
@@ -44,10 +62,20 @@ class TrackerTest(unittest.TestCase):
             TRACKER_ADMIN_PASSWORD='tracker',
             TRACKER_COUNTER_UPDATE_INTERVAL_LENGTH="10",
             overwrite=True)
+        routing_cache.clear()
+        routing_cache.reset_stats()
+        negative_cache.clear()
+        negative_cache.reset_stats()
+        interval_factor_cache.clear()
+        click_limiter._leases.clear()
 
     def tearDown(self):
         self.testbed.deactivate()
 
+    def _flush_counters(self):
+        """Flush the clicks of all intervals, including the current one."""
+        return flush_counters(until=get_interval_index() + 1)
+
     def _check_if_default_redirect(self, response):
         self.assertEqual(response.status_int, 301)
         self.assertEqual(response.headers["Location"], "http://outfit7.com")
@@ -136,7 +164,7 @@ class TrackerTest(unittest.TestCase):
         self.assertNotEqual(response.headers["Location"], "http://outfit7.com")
 
         # run the background task to store the click in Datastore
-        [deferred.run(task.payload) for task in self.taskqueue_stub.get_filtered_tasks()]
+        self._flush_counters()
 
         # check if click was stored properly
         response = self.admin_app.get("/api/admin/campaign/%d/platform/android" % campaign["id"],
@@ -202,7 +230,7 @@ class TrackerTest(unittest.TestCase):
         # simulate a user click
         response = self.tracker_app.get('/api/campaign/%d/platform/android' % campaign_id)
         # run the background task to store the click in Datastore
-        [deferred.run(task.payload) for task in self.taskqueue_stub.get_filtered_tasks()]
+        self._flush_counters()
 
         campaign_new = deepcopy(self.CAMPAIGN_SAMPLE)
         campaign_new["name"] = "new name"
@@ -215,6 +243,31 @@ class TrackerTest(unittest.TestCase):
         # check if update_date is not null any more
         self.assertIsNotNone(campaign_updated["update_date"])
 
+    def test_update_campaign_link(self):
+        # create new campaign
+        response = self.admin_app.post("/api/admin/campaign", params=json.dumps(self.CAMPAIGN_SAMPLE),
+                                       headers=self.ADMIN_HEADERS)
+        campaign = json.loads(response.body)
+        campaign_url = response.headers["Location"]
+
+        response = self.tracker_app.get('/api/campaign/%d/platform/android' % campaign["id"])
+        self.assertEqual(response.headers["Location"], "http://google.com")
+
+        # change the link and check if clicks are redirected to the new one
+        response = self.admin_app.put(campaign_url, params=json.dumps({"link": "http://example.com"}),
+                                      headers=self.ADMIN_HEADERS)
+        self.assertEqual(response.status_int, 200)
+        response = self.tracker_app.get('/api/campaign/%d/platform/android' % campaign["id"])
+        self.assertEqual(response.status_int, 302)
+        self.assertEqual(response.headers["Location"], "http://example.com")
+
+        # platforms stored before the link was denormalized may outlive their campaign
+        Platform(id="12345-ios", name="ios", counter=0).put()
+        platform_filter.add(["12345-ios"])
+        response = self.tracker_app.get('/api/campaign/12345/platform/ios')
+        self.assertEqual(response.headers["Location"], "http://outfit7.com")
+        self.assertTrue(negative_cache.get("12345-ios"))
+
     def test_invalid_update_campaign(self):
         self.policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=0)
         self.testbed.init_datastore_v3_stub(consistency_policy=self.policy)
@@ -228,7 +281,7 @@ class TrackerTest(unittest.TestCase):
         # simulate a user click
         self.tracker_app.get('/api/campaign/%d/platform/android' % campaign_id)
         # run the background task to store the click in Datastore
-        [deferred.run(task.payload) for task in self.taskqueue_stub.get_filtered_tasks()]
+        self._flush_counters()
 
         def check_missing_parameter(parameter):
             campaign_dict = deepcopy(self.CAMPAIGN_SAMPLE)
@@ -261,7 +314,7 @@ class TrackerTest(unittest.TestCase):
         for i in range(10):
             self.tracker_app.get('/api/campaign/%d/platform/android' % random.sample(campaign_ids, 1)[0])
         # run the background task to store the clicks in Datastore
-        [deferred.run(task.payload) for task in self.taskqueue_stub.get_filtered_tasks()]
+        self._flush_counters()
 
         response = self.admin_app.get("/api/admin/platform/android/clicks", headers=self.ADMIN_HEADERS)
         results = json.loads(response.body)
@@ -280,6 +333,9 @@ class TrackerTest(unittest.TestCase):
         response = self.admin_app.get("/api/admin/platform/android/campaigns", headers=self.ADMIN_HEADERS)
         results = json.loads(response.body)
         self.assertEqual(len(results), 10)
+        self.assertEqual({result["id"] for result in results}, set(campaign_ids))
+        for result in results:
+            self.assertEqual(result["platform_counters"], {"android": 0, "ios": 0, "wp": 0})
 
     def test_delete_campaign(self):
         # create new campaign
@@ -300,3 +356,706 @@ class TrackerTest(unittest.TestCase):
         # delete non-existent campaign
         response = self.admin_app.delete("/api/admin/campaign/999", headers=self.ADMIN_HEADERS, expect_errors=True)
         self.assertEqual(response.status_int, 204)
+
+    def test_delete_campaign_purges_counters(self):
+        response = self.admin_app.post("/api/admin/campaign", params=json.dumps(self.CAMPAIGN_SAMPLE),
+                                       headers=self.ADMIN_HEADERS)
+        campaign_id = json.loads(response.body)["id"]
+        self.tracker_app.get('/api/campaign/%d/platform/ios' % campaign_id)
+        key = counter_key("%d-ios" % campaign_id, get_interval_index())
+        self.assertEqual(memcache.get(key, namespace="counters"), 1)
+        ClickBucket.from_key(ClickBucket.key_for("%d-ios" % campaign_id, "day", time.time())).put()
+
+        self.admin_app.delete("/api/admin/campaign/%d" % campaign_id, headers=self.ADMIN_HEADERS)
+        self.assertIsNone(memcache.get(key, namespace="counters"))
+        self.assertIsNone(Platform.get_by_id("%d-ios" % campaign_id))
+        # the statistics buckets are deleted by a deferred task
+        [deferred.run(task.payload) for task in self.taskqueue_stub.get_filtered_tasks(queue_names="default")]
+        self.assertEqual(ClickBucket.query(ancestor=ndb.Key(Platform, "%d-ios" % campaign_id)).count(), 0)
+        # the pending flush task finds nothing to flush
+        self.assertEqual(self._flush_counters(), 0)
+        self.assertEqual(len(self.taskqueue_stub.get_filtered_tasks(queue_names=COUNTERS_QUEUE)), 0)
+
+        # updating a campaign that does not exist is not possible
+        response = self.admin_app.put("/api/admin/campaign/%d" % campaign_id, params=json.dumps({"name": "New"}),
+                                      headers=self.ADMIN_HEADERS, status=404)
+        self.assertIn("does not exist", json.loads(response.body)["error"])
+
+    def test_lru_cache(self):
+        cache = LRUCache(max_size=2, ttl=60)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        self.assertEqual(cache.get("a"), 1)
+        # "b" is the least recently used entry, so it gets evicted
+        cache.set("c", 3)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("c"), 3)
+        stats = cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["evictions"], stats["size"]), (2, 1, 1, 2))
+
+        # expired entries are not returned
+        cache.ttl = -1
+        cache.set("d", 4)
+        self.assertIsNone(cache.get("d"))
+
+    def test_routing_cache(self):
+        response = self.admin_app.post("/api/admin/campaign", params=json.dumps(self.CAMPAIGN_SAMPLE),
+                                       headers=self.ADMIN_HEADERS)
+        campaign = json.loads(response.body)
+        for i in range(3):
+            self.tracker_app.get('/api/campaign/%d/platform/ios' % campaign["id"])
+
+        response = self.admin_app.get("/api/admin/cache/routing", headers=self.ADMIN_HEADERS)
+        stats = json.loads(response.body)
+        self.assertEqual((stats["hits"], stats["misses"], stats["size"]), (2, 1, 1))
+
+        # deleting the campaign drops the cached routing data
+        self.admin_app.delete("/api/admin/campaign/%d" % campaign["id"], headers=self.ADMIN_HEADERS)
+        response = self.tracker_app.get('/api/campaign/%d/platform/ios' % campaign["id"])
+        self._check_if_default_redirect(response)
+
+    def test_counter_flush(self):
+        response = self.admin_app.post("/api/admin/campaign", params=json.dumps(self.CAMPAIGN_SAMPLE),
+                                       headers=self.ADMIN_HEADERS)
+        campaign = json.loads(response.body)
+        for i in range(5):
+            self.tracker_app.get('/api/campaign/%d/platform/android' % campaign["id"])
+        self.tracker_app.get('/api/campaign/%d/platform/ios' % campaign["id"])
+        # only the first click of the campaign in the interval marks it dirty
+        self.assertEqual(len(self.taskqueue_stub.get_filtered_tasks(queue_names=COUNTERS_QUEUE)), 1)
+
+        self.assertEqual(self._flush_counters(), 2)
+        self.assertEqual(len(self.taskqueue_stub.get_filtered_tasks(queue_names=COUNTERS_QUEUE)), 0)
+        response = self.admin_app.get("/api/admin/campaign/%d" % campaign["id"], headers=self.ADMIN_HEADERS)
+        self.assertEqual(json.loads(response.body)["platform_counters"], {"android": 5, "ios": 1, "wp": 0})
+
+    def test_counter_flush_is_idempotent(self):
+        response = self.admin_app.post("/api/admin/campaign", params=json.dumps(self.CAMPAIGN_SAMPLE),
+                                       headers=self.ADMIN_HEADERS)
+        campaign = json.loads(response.body)
+        platform_id = "%d-android" % campaign["id"]
+        memcache.set(counter_key(platform_id, 1), 3, namespace="counters")
+        memcache.set(counter_key(platform_id, 2), 4, namespace="counters")
+        self.assertEqual(Platform.flush_counters([(platform_id, 1), (platform_id, 2)])[0], 2)
+        self.assertEqual(Platform.get_by_id(platform_id).counter, 7)
+
+        # flushing an interval again (e.g. a duplicate task) does not count its clicks twice
+        memcache.set(counter_key(platform_id, 1), 3, namespace="counters")
+        Platform.flush_counters([(platform_id, 1)])
+        self.assertEqual(Platform.get_by_id(platform_id).counter, 7)
+
+        # counters evicted from memcache are skipped
+        self.assertEqual(Platform.flush_counters([(platform_id, 3)])[0], 0)
+        self.assertEqual(Platform.get_by_id(platform_id).counter, 7)
+
+    def test_sharded_counter(self):
+        campaign_dict = deepcopy(self.CAMPAIGN_SAMPLE)
+        campaign_dict["counter_backend"] = "sharded"
+        response = self.admin_app.post("/api/admin/campaign", params=json.dumps(campaign_dict),
+                                       headers=self.ADMIN_HEADERS)
+        campaign = json.loads(response.body)
+        for i in range(3):
+            self.tracker_app.get('/api/campaign/%d/platform/android' % campaign["id"])
+        # sharded counters are stored durably on every click, flushing only updates the statistics
+        self._flush_counters()
+
+        response = self.admin_app.get("/api/admin/campaign/%d/platform/android" % campaign["id"],
+                                      headers=self.ADMIN_HEADERS)
+        self.assertEqual(json.loads(response.body)["counter"], 3)
+        response = self.admin_app.get("/api/admin/platform/android/clicks", headers=self.ADMIN_HEADERS)
+        self.assertEqual(json.loads(response.body), 3)
+
+        # clicks whose shard is contended are redirected and stored by a deferred task
+        def contended_shard(platform_id, counter_shards):
+            future = ndb.Future()
+            future.set_exception(datastore_errors.TransactionFailedError())
+            return future
+        increment_shard_async, tracker.increment_shard_async = tracker.increment_shard_async, contended_shard
+        try:
+            response = self.tracker_app.get('/api/campaign/%d/platform/android' % campaign["id"])
+        finally:
+            tracker.increment_shard_async = increment_shard_async
+        self.assertEqual(response.headers["Location"], "http://google.com")
+        [deferred.run(task.payload) for task in self.taskqueue_stub.get_filtered_tasks(queue_names="default")]
+        memcache.flush_all()
+        response = self.admin_app.get("/api/admin/campaign/%d/platform/android" % campaign["id"],
+                                      headers=self.ADMIN_HEADERS)
+        self.assertEqual(json.loads(response.body)["counter"], 4)
+
+        # counter backend can not be changed or set to an unknown backend
+        response = self.admin_app.put("/api/admin/campaign/%d" % campaign["id"],
+                                      params=json.dumps({"counter_backend": "memcache"}),
+                                      headers=self.ADMIN_HEADERS, expect_errors=True)
+        self.assertEqual(response.status_int, 400)
+        campaign_dict["counter_backend"] = "foo"
+        response = self.admin_app.post("/api/admin/campaign", params=json.dumps(campaign_dict),
+                                       headers=self.ADMIN_HEADERS, expect_errors=True)
+        self.assertEqual(response.status_int, 400)
+
+    def test_click_stats(self):
+        response = self.admin_app.post("/api/admin/campaign", params=json.dumps(self.CAMPAIGN_SAMPLE),
+                                       headers=self.ADMIN_HEADERS)
+        campaign = json.loads(response.body)
+        for platform_name in ["android", "android", "ios"]:
+            self.tracker_app.get('/api/campaign/%d/platform/%s' % (campaign["id"], platform_name))
+        self._flush_counters()
+
+        for resolution in ["minute", "hour", "day"]:
+            response = self.admin_app.get("/api/admin/campaign/%d/stats?resolution=%s" % (campaign["id"], resolution),
+                                          headers=self.ADMIN_HEADERS)
+            stats = json.loads(response.body)
+            self.assertEqual(stats["total"], 3)
+            self.assertEqual(len(stats["buckets"]), 24)
+        response = self.admin_app.get("/api/admin/campaign/%d/platform/android/stats" % campaign["id"],
+                                      headers=self.ADMIN_HEADERS)
+        self.assertEqual(json.loads(response.body)["total"], 2)
+
+        response = self.admin_app.get("/api/admin/campaign/%d/stats?resolution=week" % campaign["id"],
+                                      headers=self.ADMIN_HEADERS, expect_errors=True)
+        self.assertEqual(response.status_int, 400)
+        response = self.admin_app.get("/api/admin/campaign/%d/stats?resolution=minute&start=0" % campaign["id"],
+                                      headers=self.ADMIN_HEADERS, expect_errors=True)
+        self.assertEqual(response.status_int, 400)
+
+    def test_campaign_pagination(self):
+        for i in range(5):
+            self.admin_app.post("/api/admin/campaign", params=json.dumps(self.CAMPAIGN_SAMPLE),
+                                headers=self.ADMIN_HEADERS)
+
+        campaign_ids = set()
+        url = "/api/admin/campaign?limit=2"
+        pages = 0
+        while url:
+            response = self.admin_app.get(url, headers=self.ADMIN_HEADERS)
+            campaigns = json.loads(response.body)
+            self.assertLessEqual(len(campaigns), 2)
+            campaign_ids.update(campaign["id"] for campaign in campaigns)
+            url = "/api/admin/campaign?limit=2&cursor=%s" % response.headers["X-Next-Cursor"] \
+                if "X-Next-Cursor" in response.headers else None
+            pages += 1
+        self.assertEqual(len(campaign_ids), 5)
+        self.assertGreaterEqual(pages, 3)
+
+        for params in ["limit=0", "limit=abc", "limit=100000", "cursor=foo"]:
+            response = self.admin_app.get("/api/admin/campaign?%s" % params, headers=self.ADMIN_HEADERS,
+                                          expect_errors=True)
+            self.assertEqual(response.status_int, 400)
+
+    def test_platform_clicks_total(self):
+        response = self.admin_app.post("/api/admin/campaign", params=json.dumps(self.CAMPAIGN_SAMPLE),
+                                       headers=self.ADMIN_HEADERS)
+        campaign = json.loads(response.body)
+        # the total is computed on the first read
+        response = self.admin_app.get("/api/admin/platform/ios/clicks", headers=self.ADMIN_HEADERS)
+        self.assertEqual(json.loads(response.body), 0)
+
+        # and then maintained by the flushes
+        for i in range(3):
+            self.tracker_app.get('/api/campaign/%d/platform/ios' % campaign["id"])
+        self._flush_counters()
+        response = self.admin_app.get("/api/admin/platform/ios/clicks", headers=self.ADMIN_HEADERS)
+        self.assertEqual(json.loads(response.body), 3)
+
+        # clicks of deleted campaigns are subtracted
+        self.admin_app.delete("/api/admin/campaign/%d" % campaign["id"], headers=self.ADMIN_HEADERS)
+        response = self.admin_app.get("/api/admin/platform/ios/clicks", headers=self.ADMIN_HEADERS)
+        self.assertEqual(json.loads(response.body), 0)
+
+        # repair a corrupted total
+        PlatformTotal(id="ios", counter=42).put()
+        memcache.flush_all()
+        response = self.admin_app.get("/api/admin/platform/ios/clicks?recompute=1", headers=self.ADMIN_HEADERS)
+        self.assertEqual(response.status_int, 202)
+        [deferred.run(task.payload) for task in self.taskqueue_stub.get_filtered_tasks(queue_names="default")]
+        response = self.admin_app.get("/api/admin/platform/ios/clicks", headers=self.ADMIN_HEADERS)
+        self.assertEqual(json.loads(response.body), 0)
+
+    def test_campaign_batch(self):
+        response = self.admin_app.post("/api/admin/campaign", params=json.dumps(self.CAMPAIGN_SAMPLE),
+                                       headers=self.ADMIN_HEADERS)
+        existing_id = json.loads(response.body)["id"]
+        response = self.admin_app.post("/api/admin/campaign", params=json.dumps(self.CAMPAIGN_SAMPLE),
+                                       headers=self.ADMIN_HEADERS)
+        deleted_id = json.loads(response.body)["id"]
+
+        operations = [
+            {"op": "create", "campaign": self.CAMPAIGN_SAMPLE},
+            {"op": "create", "campaign": {"name": "Only name"}},
+            {"op": "update", "id": existing_id, "campaign": {"link": "http://example.com", "platforms": ["wp"]}},
+            {"op": "update", "id": 999, "campaign": {"name": "foo"}},
+            {"op": "delete", "id": deleted_id},
+            {"op": "foo"},
+        ]
+        response = self.admin_app.post("/api/admin/campaign/batch", params=json.dumps(operations),
+                                       headers=self.ADMIN_HEADERS)
+        results = json.loads(response.body)
+        self.assertEqual([result["status"] for result in results], [201, 400, 200, 404, 200, 400])
+        self.assertEqual(results[0]["campaign"]["platform_counters"], {"android": 0, "ios": 0, "wp": 0})
+        self.assertEqual(results[2]["campaign"]["link"], "http://example.com")
+
+        response = self.admin_app.get("/api/admin/campaign/%d" % results[0]["id"], headers=self.ADMIN_HEADERS)
+        self.assertEqual(json.loads(response.body)["name"], self.CAMPAIGN_SAMPLE["name"])
+        response = self.tracker_app.get('/api/campaign/%d/platform/android' % existing_id)
+        self.assertEqual(response.headers["Location"], "http://example.com")
+        response = self.admin_app.get("/api/admin/campaign/%d" % deleted_id, headers=self.ADMIN_HEADERS,
+                                      expect_errors=True)
+        self.assertEqual(response.status_int, 404)
+
+        response = self.admin_app.post("/api/admin/campaign/batch", params=json.dumps({"op": "create"}),
+                                       headers=self.ADMIN_HEADERS, expect_errors=True)
+        self.assertEqual(response.status_int, 400)
+
+        # operations on a repeated campaign are all rejected
+        operations = [{"op": "update", "id": existing_id, "campaign": {"name": "foo"}},
+                      {"op": "delete", "id": existing_id}]
+        response = self.admin_app.post("/api/admin/campaign/batch", params=json.dumps(operations),
+                                       headers=self.ADMIN_HEADERS)
+        self.assertEqual([result["status"] for result in json.loads(response.body)], [400, 400])
+        response = self.admin_app.get("/api/admin/campaign/%d" % existing_id, headers=self.ADMIN_HEADERS)
+        self.assertEqual(json.loads(response.body)["name"], self.CAMPAIGN_SAMPLE["name"])
+
+    def test_metrics(self):
+        response = self.admin_app.post("/api/admin/campaign", params=json.dumps(self.CAMPAIGN_SAMPLE),
+                                       headers=self.ADMIN_HEADERS)
+        campaign = json.loads(response.body)
+        # the creation increments the cache generations, only the clicks are measured
+        metrics.histograms.clear()
+        for i in range(3):
+            self.tracker_app.get('/api/campaign/%d/platform/ios' % campaign["id"])
+
+        response = self.admin_app.get("/api/admin/metrics", headers=self.ADMIN_HEADERS)
+        histograms = json.loads(response.body)
+        self.assertEqual(histograms["request.tracker"]["count"], 3)
+        self.assertEqual(sum(histograms["request.tracker"]["buckets_ms"].values()), 3)
+        self.assertEqual(histograms["rpc.memcache.Increment"]["count"], 3)
+        self.assertNotIn("request.admin", histograms)
+        # the metrics are only available to the admin
+        response = self.admin_app.get("/api/admin/metrics", expect_errors=True)
+        self.assertEqual(response.status_int, 401)
+
+        app = webtest.TestApp(MetricsMiddleware(tracker_app.app, "tracker", server_timing=True))
+        response = app.get('/api/campaign/%d/platform/ios' % campaign["id"])
+        self.assertIn("memcache;dur=", response.headers["Server-Timing"])
+        self.assertIn("total;dur=", response.headers["Server-Timing"])
+
+    def test_event_capture(self):
+        response = self.admin_app.post("/api/admin/campaign", params=json.dumps(self.CAMPAIGN_SAMPLE),
+                                       headers=self.ADMIN_HEADERS)
+        campaign = json.loads(response.body)
+        event_buffer.enabled, event_buffer.batch_size = True, 2
+        try:
+            for i in range(3):
+                self.tracker_app.get('/api/campaign/%d/platform/ios' % campaign["id"],
+                                     headers={"User-Agent": "agent-%d" % i, "X-AppEngine-Country": "SI"})
+            # only the full batch was shipped
+            self.assertEqual(len(self.taskqueue_stub.get_filtered_tasks(queue_names=EVENTS_QUEUE)), 1)
+            # the partial batch is shipped once it is due, without another click
+            ship_buffers(due_only=True)
+            self.assertEqual(len(self.taskqueue_stub.get_filtered_tasks(queue_names=EVENTS_QUEUE)), 1)
+            event_buffer._started_at -= event_buffer.max_age
+            ship_buffers(due_only=True)
+            self.assertEqual(len(self.taskqueue_stub.get_filtered_tasks(queue_names=EVENTS_QUEUE)), 2)
+        finally:
+            event_buffer.enabled, event_buffer.batch_size = False, TRACKER_EVENT_BATCH_SIZE
+
+        self.assertEqual(store_events(), 3)
+        self.assertEqual(store_events(), 0)
+        logs = sorted(ClickEventLog.query().fetch(), key=lambda log: -log.count)
+        self.assertEqual([log.count for log in logs], [2, 1])
+        events = [event for log in logs for event in log.events]
+        self.assertEqual([event[2] for event in events], ["agent-0", "agent-1", "agent-2"])
+        self.assertEqual(set((event[1], event[4]) for event in events), {("%d-ios" % campaign["id"], "SI")})
+
+    def test_hyperloglog(self):
+        sketch, other = HyperLogLog(), HyperLogLog()
+        for i in range(10000):
+            sketch.add("visitor-%d" % i)
+            other.add("visitor-%d" % (i + 5000))
+        self.assertAlmostEqual(sketch.estimate(), 10000, delta=500)
+        sketch.merge(other)
+        self.assertAlmostEqual(sketch.estimate(), 15000, delta=750)
+        self.assertEqual(HyperLogLog(sketch.to_bytes()).estimate(), sketch.estimate())
+        self.assertEqual(HyperLogLog().estimate(), 0)
+
+    def test_uniques(self):
+        response = self.admin_app.post("/api/admin/campaign", params=json.dumps(self.CAMPAIGN_SAMPLE),
+                                       headers=self.ADMIN_HEADERS)
+        campaign = json.loads(response.body)
+        self.admin_app.get("/api/admin/platform/ios/clicks", headers=self.ADMIN_HEADERS)
+        first_index = get_interval_index()
+        for platform_name, address in [("ios", "1.1.1.1"), ("ios", "1.1.1.1"), ("ios", "2.2.2.2"),
+                                       ("android", "2.2.2.2"), ("android", "3.3.3.3")]:
+            self.tracker_app.get('/api/campaign/%d/platform/%s' % (campaign["id"], platform_name),
+                                 extra_environ={"REMOTE_ADDR": address})
+        uniques_buffer.merge()
+        self._flush_counters()
+
+        response = self.admin_app.get("/api/admin/campaign/%d/uniques" % campaign["id"], headers=self.ADMIN_HEADERS)
+        uniques = json.loads(response.body)
+        self.assertEqual(uniques["uniques"], 3)
+        self.assertEqual(uniques["platform_uniques"], {"android": 2, "ios": 2, "wp": 0})
+        response = self.admin_app.get("/api/admin/campaign/%d/stats" % campaign["id"], headers=self.ADMIN_HEADERS)
+        stats = json.loads(response.body)
+        self.assertEqual(stats["uniques"], 3)
+        self.assertEqual(sum(bucket["uniques"] for bucket in stats["buckets"]), 3)
+
+        # the existing total is updated by the flush, the missing one is computed on read
+        response = self.admin_app.get("/api/admin/platform/ios/uniques", headers=self.ADMIN_HEADERS)
+        self.assertEqual(json.loads(response.body), 2)
+        response = self.admin_app.get("/api/admin/platform/android/uniques", headers=self.ADMIN_HEADERS)
+        self.assertEqual(json.loads(response.body), 2)
+
+        # visitors merged after their interval was flushed are carried into the next flush of the platform
+        sketches = memcache.get_multi([counter_key("%d-ios" % campaign["id"], index)
+                                       for index in range(first_index, get_interval_index() + 1)], namespace="uniques")
+        key = sorted(key for key, value in sketches.items() if value == FLUSHED_SKETCH)[0]
+        uniques_buffer.add(key, "4.4.4.4")
+        uniques_buffer.merge()
+        self.assertEqual(memcache.get(key, namespace="uniques"), FLUSHED_SKETCH)
+        self.assertIsNotNone(memcache.get(carried_sketch_key("%d-ios" % campaign["id"]), namespace="uniques"))
+        self.tracker_app.get('/api/campaign/%d/platform/ios' % campaign["id"], extra_environ={"REMOTE_ADDR": "1.1.1.1"})
+        uniques_buffer.merge()
+        self._flush_counters()
+        response = self.admin_app.get("/api/admin/campaign/%d/uniques" % campaign["id"], headers=self.ADMIN_HEADERS)
+        self.assertEqual(json.loads(response.body)["platform_uniques"]["ios"], 3)
+        self.assertEqual(memcache.get(carried_sketch_key("%d-ios" % campaign["id"]), namespace="uniques"), "")
+
+    def test_click_filter(self):
+        response = self.admin_app.post("/api/admin/campaign", params=json.dumps(self.CAMPAIGN_SAMPLE),
+                                       headers=self.ADMIN_HEADERS)
+        campaign = json.loads(response.body)
+        url = '/api/campaign/%d/platform/ios' % campaign["id"]
+        dedup_filter = click_filter.dedup_filter
+        click_filter.dedup_filter = RotatingBloomFilter(60, 2 ** 16, DEDUP_FILTER_HASHES)
+        try:
+            for address in ["1.1.1.1", "1.1.1.1", "2.2.2.2", "1.1.1.1"]:
+                response = self.tracker_app.get(url, extra_environ={"REMOTE_ADDR": address})
+                self.assertEqual(response.headers["Location"], "http://google.com")
+            response = self.tracker_app.get(url, headers={"User-Agent": "Mozilla/5.0 (compatible; Googlebot/2.1)"})
+            self.assertEqual(response.headers["Location"], "http://google.com")
+        finally:
+            click_filter.dedup_filter = dedup_filter
+        self._flush_counters()
+
+        response = self.admin_app.get("/api/admin/campaign/%d" % campaign["id"], headers=self.ADMIN_HEADERS)
+        self.assertEqual(json.loads(response.body)["platform_counters"]["ios"], 2)
+        response = self.admin_app.get("/api/admin/campaign/%d/filtered" % campaign["id"], headers=self.ADMIN_HEADERS)
+        self.assertEqual(json.loads(response.body), {"duplicate": 2, "bot": 1, "rate_limited": 0, "capped": 0})
+        response = self.admin_app.get("/api/admin/clicks/filtered", headers=self.ADMIN_HEADERS)
+        self.assertEqual(json.loads(response.body), {"duplicate": 2, "bot": 1, "rate_limited": 0, "capped": 0})
+
+        # filters remember values only for up to two windows
+        bloom_filter = RotatingBloomFilter(-1, 2 ** 10, DEDUP_FILTER_HASHES)
+        self.assertFalse(bloom_filter.add("a"))
+        self.assertFalse(bloom_filter.add("a"))
+
+    def test_negative_cache(self):
+        for i in range(3):
+            response = self.tracker_app.get('/api/campaign/12345/platform/ios')
+            self._check_if_default_redirect(response)
+        response = self.admin_app.get("/api/admin/cache/routing", headers=self.ADMIN_HEADERS)
+        stats = json.loads(response.body)["negative"]
+        self.assertEqual((stats["hits"], stats["size"]), (2, 1))
+
+        # created campaigns drop the cached missing platforms
+        self.admin_app.post("/api/admin/campaign", params=json.dumps(self.CAMPAIGN_SAMPLE), headers=self.ADMIN_HEADERS)
+        self.assertIsNone(negative_cache.get("12345-ios"))
+
+    def test_platform_filter(self):
+        platform_filter.enabled, platform_filter._checked_at, platform_filter._version = True, 0, None
+        try:
+            # the missing filter is rebuilt in the background
+            response = self.admin_app.post("/api/admin/campaign", params=json.dumps(self.CAMPAIGN_SAMPLE),
+                                           headers=self.ADMIN_HEADERS)
+            first_id = json.loads(response.body)["id"]
+            for task in self.taskqueue_stub.get_filtered_tasks(queue_names="default"):
+                deferred.run(task.payload)
+
+            response = self.tracker_app.get('/api/campaign/%d/platform/ios' % first_id)
+            self.assertEqual(response.headers["Location"], "http://google.com")
+            response = self.tracker_app.get('/api/campaign/12345/platform/ios')
+            self._check_if_default_redirect(response)
+            # the platform was rejected by the filter, without a Datastore get
+            self.assertEqual(negative_cache.stats()["size"], 0)
+
+            # created platforms are added to the existing filter right away
+            response = self.admin_app.post("/api/admin/campaign", params=json.dumps(self.CAMPAIGN_SAMPLE),
+                                           headers=self.ADMIN_HEADERS)
+            second_id = json.loads(response.body)["id"]
+            platform_filter._checked_at = 0
+            response = self.tracker_app.get('/api/campaign/%d/platform/android' % second_id)
+            self.assertEqual(response.headers["Location"], "http://google.com")
+        finally:
+            platform_filter.enabled, platform_filter._filter = False, None
+
+    def test_hot_campaigns(self):
+        campaign_ids = []
+        for i in range(2):
+            response = self.admin_app.post("/api/admin/campaign", params=json.dumps(self.CAMPAIGN_SAMPLE),
+                                           headers=self.ADMIN_HEADERS)
+            campaign_ids.append(json.loads(response.body)["id"])
+        for campaign_id in [campaign_ids[1], campaign_ids[0], campaign_ids[1]]:
+            self.tracker_app.get('/api/campaign/%d/platform/ios' % campaign_id)
+        self._flush_counters()
+
+        response = self.admin_app.get("/api/admin/campaign/hot", headers=self.ADMIN_HEADERS)
+        hot_campaigns = json.loads(response.body)
+        self.assertEqual([campaign["id"] for campaign in hot_campaigns], [campaign_ids[1], campaign_ids[0]])
+        self.assertAlmostEqual(hot_campaigns[0]["clicks_per_second"], 2.0 / TRACKER_RATE_TIME_CONSTANT, places=3)
+        response = self.admin_app.get("/api/admin/campaign/hot?limit=1", headers=self.ADMIN_HEADERS)
+        self.assertEqual([campaign["id"] for campaign in json.loads(response.body)], [campaign_ids[1]])
+        for limit in (0, -1, TRACKER_HOT_CAMPAIGNS_CAPACITY + 1):
+            self.admin_app.get("/api/admin/campaign/hot?limit=%d" % limit, headers=self.ADMIN_HEADERS, status=400)
+
+        # hot campaigns are marked dirty for aligned blocks of intervals, the factors are cached for an interval
+        self.assertEqual(get_campaign_interval_factor(campaign_ids[0]), 1)
+        update_rates({str(campaign_ids[0]): 100 * TRACKER_RATE_TIME_CONSTANT})
+        self.assertEqual(get_campaign_interval_factor(campaign_ids[0]), 1)
+        interval_factor_cache.clear()
+        self.assertEqual(get_campaign_interval_factor(campaign_ids[0]), TRACKER_COUNTER_MAX_INTERVAL_FACTOR)
+        self.tracker_app.get('/api/campaign/%d/platform/android' % campaign_ids[0])
+        task, = self.taskqueue_stub.get_filtered_tasks(queue_names=COUNTERS_QUEUE)
+        campaign_id, interval_index, factor = map(int, task.payload.split(" "))
+        self.assertEqual(factor, TRACKER_COUNTER_MAX_INTERVAL_FACTOR)
+        self.assertEqual(interval_index % factor, 0)
+        self.assertEqual(flush_counters(until=interval_index + factor), 1)
+
+    def test_space_saving(self):
+        sketch = SpaceSaving(2)
+        for item, weight in [("a", 5), ("b", 1), ("c", 2), ("a", 1)]:
+            sketch.add(item, weight)
+        # "c" replaced the lightest item "b", inheriting its weight as the error
+        self.assertEqual(sketch.top(2), [("a", 6, 0), ("c", 3, 1)])
+
+    def test_response_cache(self):
+        response = self.admin_app.post("/api/admin/campaign", params=json.dumps(self.CAMPAIGN_SAMPLE),
+                                       headers=self.ADMIN_HEADERS)
+        campaign = json.loads(response.body)
+        url = "/api/admin/campaign/%d" % campaign["id"]
+        response = self.admin_app.get(url, headers=self.ADMIN_HEADERS)
+        etag = response.headers["ETag"]
+        headers = dict(self.ADMIN_HEADERS, **{"If-None-Match": etag})
+        response = self.admin_app.get(url, headers=headers)
+        self.assertEqual(response.status_int, 304)
+        self.assertEqual(response.body, "")
+
+        # cached responses are served without reading the campaign
+        campaign_entity = Campaign.get_by_id(campaign["id"])
+        campaign_entity.name = "Changed name"
+        campaign_entity.put()
+        response = self.admin_app.get(url, headers=self.ADMIN_HEADERS)
+        self.assertEqual(response.headers["ETag"], etag)
+        self.assertEqual(json.loads(response.body)["name"], self.CAMPAIGN_SAMPLE["name"])
+
+        # flushed clicks invalidate the responses of the campaign
+        self.tracker_app.get('/api/campaign/%d/platform/ios' % campaign["id"])
+        self._flush_counters()
+        response = self.admin_app.get(url, headers=headers)
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(json.loads(response.body)["platform_counters"]["ios"], 1)
+        response = self.admin_app.get("/api/admin/platform/ios/campaigns", headers=self.ADMIN_HEADERS)
+        self.assertEqual(len(json.loads(response.body)), 1)
+
+        # so do the admin mutations
+        self.admin_app.put(url, params=json.dumps({"link": "http://example.com"}), headers=self.ADMIN_HEADERS)
+        response = self.admin_app.get(url, headers=self.ADMIN_HEADERS)
+        self.assertEqual(json.loads(response.body)["link"], "http://example.com")
+        self.admin_app.delete(url, headers=self.ADMIN_HEADERS)
+        response = self.admin_app.get("/api/admin/platform/ios/campaigns", headers=self.ADMIN_HEADERS)
+        self.assertEqual(json.loads(response.body), [])
+
+    def test_export(self):
+        campaign_ids = []
+        for i in range(3):
+            response = self.admin_app.post("/api/admin/campaign", params=json.dumps(self.CAMPAIGN_SAMPLE),
+                                           headers=self.ADMIN_HEADERS)
+            campaign_ids.append(json.loads(response.body)["id"])
+        self.tracker_app.get('/api/campaign/%d/platform/ios' % campaign_ids[0])
+        self._flush_counters()
+
+        response = self.admin_app.get("/api/admin/campaign/export", headers=self.ADMIN_HEADERS)
+        self.assertEqual(response.content_type, "application/x-ndjson")
+        rows = [json.loads(line) for line in response.body.splitlines()]
+        self.assertEqual(sorted(row["id"] for row in rows), sorted(campaign_ids))
+        counters = {row["id"]: row["platform_counters"] for row in rows}
+        self.assertEqual(counters[campaign_ids[0]], {"android": 0, "ios": 1, "wp": 0})
+
+        # pages of a CSV export are resumed from the cursor, only the first one has a header line
+        response = self.admin_app.get("/api/admin/campaign/export?format=csv&limit=2", headers=self.ADMIN_HEADERS)
+        first_page = response.body.splitlines()
+        self.assertEqual(first_page[0], "id,name,link,create_date,update_date,android,ios,wp")
+        self.assertEqual(len(first_page), 3)
+        response = self.admin_app.get("/api/admin/campaign/export?format=csv&limit=2&cursor=%s" %
+                                      response.headers["X-Next-Cursor"], headers=self.ADMIN_HEADERS)
+        second_page = response.body.splitlines()
+        self.assertEqual(len(second_page), 1)
+        self.assertNotIn("X-Next-Cursor", response.headers)
+        self.admin_app.get("/api/admin/campaign/export?format=xml", headers=self.ADMIN_HEADERS, status=400)
+
+        # the background export continues in a new task after every chunk
+        response = self.admin_app.post("/api/admin/campaign/export", params=json.dumps({"format": "csv"}),
+                                       headers=self.ADMIN_HEADERS)
+        self.assertEqual(response.status_int, 202)
+        export_url = response.headers["Location"]
+        self.assertEqual(json.loads(response.body)["status"], "running")
+        self.admin_app.get(export_url + "/data", headers=self.ADMIN_HEADERS, status=409)
+        self.taskqueue_stub.FlushQueue("default")
+        run_export(json.loads(response.body)["id"], batch_size=1, duration=0)
+        tasks = self.taskqueue_stub.get_filtered_tasks(queue_names="default")
+        while tasks:
+            self.taskqueue_stub.FlushQueue("default")
+            for task in tasks:
+                deferred.run(task.payload)
+            tasks = self.taskqueue_stub.get_filtered_tasks(queue_names="default")
+        export = json.loads(self.admin_app.get(export_url, headers=self.ADMIN_HEADERS).body)
+        self.assertEqual((export["status"], export["rows"], export["chunks"]), ("done", 3, 3))
+        response = self.admin_app.get(export_url + "/data", headers=self.ADMIN_HEADERS)
+        self.assertEqual(response.content_type, "text/csv")
+        self.assertEqual(response.body.splitlines(), first_page + second_page)
+
+    def test_redirect_targets(self):
+        campaign_dict = deepcopy(self.CAMPAIGN_SAMPLE)
+        campaign_dict["targets"] = [{"link": "http://a.com", "weight": 2},
+                                    {"link": "http://b.com", "end": 1000},
+                                    {"link": "http://c.com", "start": 2 ** 40}]
+        response = self.admin_app.post("/api/admin/campaign", params=json.dumps(campaign_dict),
+                                       headers=self.ADMIN_HEADERS)
+        campaign = json.loads(response.body)
+        campaign_url = response.headers["Location"]
+        self.assertEqual(campaign["targets"][1], {"link": "http://b.com", "weight": 1, "start": None, "end": 1000})
+
+        # only the first target is active now
+        for i in range(3):
+            response = self.tracker_app.get('/api/campaign/%d/platform/ios' % campaign["id"])
+            self.assertEqual(response.headers["Location"], "http://a.com")
+        self._flush_counters()
+        response = self.admin_app.get(campaign_url, headers=self.ADMIN_HEADERS)
+        self.assertEqual(json.loads(response.body)["target_counters"], [3, 0, 0])
+        self.assertEqual(json.loads(response.body)["platform_counters"]["ios"], 3)
+
+        # clicks are redirected to the campaign link while no target is active
+        self.admin_app.put(campaign_url, params=json.dumps({"targets": [{"link": "http://b.com", "end": 1000}]}),
+                           headers=self.ADMIN_HEADERS)
+        response = self.tracker_app.get('/api/campaign/%d/platform/ios' % campaign["id"])
+        self.assertEqual(response.headers["Location"], "http://google.com")
+        self._flush_counters()
+        response = self.admin_app.get(campaign_url, headers=self.ADMIN_HEADERS)
+        self.assertEqual(json.loads(response.body)["target_counters"], [0])
+
+        campaign_dict["targets"] = [{"link": "http://a.com", "weight": 0}]
+        response = self.admin_app.post("/api/admin/campaign", params=json.dumps(campaign_dict),
+                                       headers=self.ADMIN_HEADERS, status=400)
+        self.assertIn("weight must be a positive integer", json.loads(response.body)["error"])
+
+    def test_pick_target(self):
+        table = compile_targets(normalize_targets([{"link": "http://a.com", "weight": 3},
+                                                   {"link": "http://b.com", "start": 100, "end": 200}]))
+        self.assertEqual(table["starts"], [0, 100, 200])
+        picks = [pick_target(table, now=150) for i in range(4000)]
+        self.assertAlmostEqual(picks.count(1) / 4000.0, 0.25, delta=0.05)
+        self.assertEqual(set(pick_target(table, now=250) for i in range(100)), {0})
+        self.assertIsNone(pick_target(compile_targets([])))
+
+    def test_counter_audit(self):
+        response = self.admin_app.post("/api/admin/campaign", params=json.dumps(self.CAMPAIGN_SAMPLE),
+                                       headers=self.ADMIN_HEADERS)
+        campaign_id = json.loads(response.body)["id"]
+        platform_id = "%d-ios" % campaign_id
+        self.admin_app.get("/api/admin/clicks/audit", headers=self.ADMIN_HEADERS, status=404)
+        hour = int(time.time()) / 3600 * 3600
+        event_buffer.enabled = True
+        try:
+            for user_agent in ("agent", "agent", "curl/7.0"):
+                self.tracker_app.get('/api/campaign/%d/platform/ios' % campaign_id, headers={"User-Agent": user_agent})
+            event_buffer.ship()
+            store_events()
+            self._flush_counters()
+            # two more clicks were logged, but their counters were lost
+            ClickEventLog(start=datetime.utcfromtimestamp(hour), count=2,
+                          events=[[hour, platform_id, "agent", "", "", None]] * 2).put()
+
+            audit = audit_counters(hour, replay=False)
+            self.assertEqual((audit.counted, audit.logged, audit.replayed), (2, 4, 0))
+            self.assertEqual(audit.platforms, [{"campaign_id": campaign_id, "platform": "ios", "counted": 2,
+                                                "logged": 4}])
+            audit = audit_counters(hour, replay=True)
+            self.assertEqual(audit.replayed, 2)
+            self.assertEqual(Platform.get_by_id(platform_id).counter, 4)
+            # the minute series add up to the hour
+            minute_buckets = ClickBucket.query(ClickBucket.resolution == "minute",
+                                               ancestor=ndb.Key(Platform, platform_id)).fetch()
+            self.assertEqual(sum(bucket.count for bucket in minute_buckets),
+                             ClickBucket.key_for(platform_id, "hour", hour).get().count)
+            # replaying is idempotent
+            self.assertEqual(audit_counters(hour, replay=True).replayed, 0)
+        finally:
+            event_buffer.enabled = False
+
+        response = self.admin_app.get("/api/admin/clicks/audit", headers=self.ADMIN_HEADERS)
+        summary = json.loads(response.body)
+        self.assertEqual((summary["counted"], summary["logged"], summary["drift"]), (4, 4, 0))
+
+    def test_click_limits(self):
+        campaign_dict = deepcopy(self.CAMPAIGN_SAMPLE)
+        campaign_dict.update(click_cap=3, cap_link="http://example.com")
+        response = self.admin_app.post("/api/admin/campaign", params=json.dumps(campaign_dict),
+                                       headers=self.ADMIN_HEADERS)
+        campaign = json.loads(response.body)
+        campaign_url = response.headers["Location"]
+        self.assertEqual(campaign["cap_state"], {"clicks": 0, "remaining": 3, "exhausted": False})
+        self.assertEqual((campaign["click_cap"], campaign["cap_link"]), (3, "http://example.com"))
+        self.assertNotIn("rate_limit", campaign)
+
+        locations = [self.tracker_app.get('/api/campaign/%d/platform/ios' % campaign["id"]).headers["Location"]
+                     for i in range(5)]
+        self.assertEqual(locations, ["http://google.com"] * 3 + ["http://example.com"] * 2)
+        # the unused part of the lease was returned and the exhausted budget was re-checked without taking tokens
+        self.assertEqual(memcache.get(cap_key(campaign["id"], 3), namespace="limits"), 3)
+        self._flush_counters()
+        response = self.admin_app.get(campaign_url, headers=self.ADMIN_HEADERS)
+        self.assertEqual(json.loads(response.body)["cap_state"], {"clicks": 3, "remaining": 0, "exhausted": True})
+        response = self.admin_app.get("/api/admin/campaign/%d/filtered" % campaign["id"], headers=self.ADMIN_HEADERS)
+        self.assertEqual(json.loads(response.body)["capped"], 2)
+
+        # raising the cap of the exhausted campaign counts the clicks again
+        self.admin_app.put(campaign_url, params=json.dumps({"click_cap": 5}), headers=self.ADMIN_HEADERS)
+        response = self.tracker_app.get('/api/campaign/%d/platform/ios' % campaign["id"])
+        self.assertEqual(response.headers["Location"], "http://google.com")
+        self.assertEqual(memcache.get(cap_key(campaign["id"], 5), namespace="limits"), 5)
+
+        # the budget is restored from the flushed clicks if it is evicted from memcache
+        memcache.flush_all()
+        self.assertEqual(ClickLimiter(5).check(campaign["id"], {"click_cap": 4}), None)
+        self.assertEqual(ClickLimiter(5).check(campaign["id"], {"click_cap": 4}), "capped")
+
+        limiter = ClickLimiter(5)
+        results = [limiter.check(12345, {"rate_limit": 20}) for i in range(25)]
+        self.assertIn("rate_limited", results)
+        self.assertLessEqual(results.count(None), 20)
+
+        campaign_dict["rate_limit"] = 0
+        self.admin_app.post("/api/admin/campaign", params=json.dumps(campaign_dict), headers=self.ADMIN_HEADERS,
+                            status=400)
+
+    def test_serializers(self):
+        value = {"b": [1, 2.5, None], "a": {"d": u"\u010d", "c": datetime(2016, 1, 2, 3, 4, 5)}}
+        expected = json.dumps(value, sort_keys=True, default=lambda obj: obj.isoformat())
+        self.assertEqual(encode(value), expected)
+        compact = encode(value, compact=True)
+        self.assertNotIn(" ", compact)
+        self.assertEqual(json.loads(compact), json.loads(expected))
+
+        response = self.admin_app.post("/api/admin/campaign", params=json.dumps(self.CAMPAIGN_SAMPLE),
+                                       headers=self.ADMIN_HEADERS)
+        campaign = json.loads(response.body)
+        response = self.admin_app.get("/api/admin/campaign", headers=self.ADMIN_HEADERS)
+        compact_response = self.admin_app.get("/api/admin/campaign?compact=1", headers=self.ADMIN_HEADERS)
+        self.assertNotIn(", ", compact_response.body)
+        self.assertEqual(json.loads(compact_response.body), json.loads(response.body))
+        self.assertEqual(json.loads(response.body)[0]["id"], campaign["id"])
+
+        platform = Platform.get_by_id("%d-ios" % campaign["id"])
+        fields = platform_fields(platform)
+        self.assertEqual(fields["name"], "ios")
+        self.assertFalse(HIDDEN_PLATFORM_FIELDS.intersection(fields))
+
@@ -1,26 +1,66 @@
-import os
+import logging
 import time
 
 import webapp2
-from google.appengine.api import memcache, taskqueue
-from google.appengine.ext import deferred
+from google.appengine.api import background_thread, datastore_errors, memcache, runtime, taskqueue
 from google.appengine.ext import ndb
+from google.appengine.ext.deferred import deferred
+from google.appengine.runtime import apiproxy_errors
 from webapp2_extras import routes
 
-from models import Campaign, Platform
+from audit import audit_counters
+from cache import negative_cache, routing_cache
+from counters import (TRACKER_COUNTER_UPDATE_INTERVAL_LENGTH, flush_counters, get_interval_index, increment_shard,
+                      increment_shard_async, mark_dirty)
+from events import click_event, event_buffer, store_events
+from filters import click_filter, count_filtered, platform_filter
+from limits import DEFAULT_CAP_LINK, click_limiter
+from metrics import MetricsMiddleware
+from models import Campaign, Platform, counter_key, target_counter_key
+from stats import compact_buckets
+from targets import pick_target
+from uniques import UniquesBuffer, visitor_id
 
 PLATFORMS = ("android", "ios", "wp")
-try:
-    TRACKER_COUNTER_UPDATE_INTERVAL_LENGTH = int(os.environ.get("TRACKER_COUNTER_UPDATE_INTERVAL_LENGTH", 1))
-except:
-    TRACKER_COUNTER_UPDATE_INTERVAL_LENGTH = 1
+# number of seconds between two invocations of the counter flush handler by cron, see cron.yaml
+COUNTER_FLUSH_CRON_PERIOD = 60
+# visitor sketches of the clicked platforms are merged into memcache once per interval
+uniques_buffer = UniquesBuffer(max_age=TRACKER_COUNTER_UPDATE_INTERVAL_LENGTH)
+# number of seconds between two checks of the buffers by the background thread of an instance
+BUFFER_CHECK_INTERVAL = 1
 
 
-def get_interval_index():
-    """Get the index of the interval from the UNIX epoch time. Interval length is defined by the
-    TRACKER_COUNTER_UPDATE_INTERVAL_LENGTH.
+def ship_buffers(due_only=False):
     """
-    return int(time.time() / TRACKER_COUNTER_UPDATE_INTERVAL_LENGTH)
+    Ship the click events and merge the visitor sketches buffered by this instance, so that they do not wait for the
+    next click.
+    :param due_only: If True only the buffers that are max_age seconds old are shipped.
+    """
+    try:
+        if due_only:
+            event_buffer.ship_due()
+        else:
+            event_buffer.ship()
+    except Exception, e:
+        logging.exception("Could not ship the buffered click events.")
+    try:
+        if due_only:
+            uniques_buffer.merge_due()
+        else:
+            uniques_buffer.merge()
+    except Exception, e:
+        logging.exception("Could not merge the buffered visitor sketches.")
+
+
+def ship_buffers_periodically():
+    """Ship the buffers once they are due, run by the background thread of manually and basic scaled instances."""
+    while not runtime.is_shutting_down():
+        time.sleep(BUFFER_CHECK_INTERVAL)
+        ship_buffers(due_only=True)
+
+
+# instances that are shut down ship their buffers first (manual and basic scaling)
+runtime.set_shutdown_hook(ship_buffers)
 
 
 class ClickHandler(webapp2.RedirectHandler):
@@ -36,25 +76,154 @@ class ClickHandler(webapp2.RedirectHandler):
             campaign_id = int(campaign_id)
         except ValueError:
             return webapp2.redirect("http://outfit7.com", permanent=True)
+        if platform_name not in PLATFORMS:
+            return webapp2.redirect("http://outfit7.com", permanent=True)
 
         platform_id = "%d-%s" % (campaign_id, platform_name)
-        platform = Platform.get_by_id(platform_id)
-        if platform:
-            memcache.incr(platform_id, 1, namespace="counters", initial_value=0)
+        # routing data is usually served from the cache, so counting the click is the only RPC
+        route = routing_cache.get(platform_id)
+        # platforms known not to exist are rejected without a Datastore get
+        if route is None and not negative_cache.get(platform_id) and platform_filter.might_exist(platform_id):
+            platform = Platform.get_by_id(platform_id)
+            link = platform.link if platform else None
+            if platform and link is None:
+                # platform was stored before the link was denormalized onto it, its campaign may no longer exist
+                campaign = Campaign.get_by_id(campaign_id)
+                link = campaign.link if campaign else None
+            if link is not None:
+                route = (link, platform.counter_shards, platform.targets, platform.limits)
+                routing_cache.set(platform_id, route)
+            else:
+                negative_cache.set(platform_id, True)
+        if route is None:
+            return webapp2.redirect("http://outfit7.com", permanent=True)
+
+        link, counter_shards, targets, limits = route
+        # the event and the counter of the click share its time, so the audit assigns the event to the same interval
+        now = time.time()
+        # weighted redirect targets are picked from the compiled table, without any additional reads
+        target = pick_target(targets)
+        if target is not None:
+            link = targets["links"][target]
+        visitor = visitor_id(self.request)
+        reason = click_filter.check(platform_id, visitor, self.request.headers.get("User-Agent", ""))
+        if reason is None and limits is not None:
+            # clicks over the caps of the campaign are redirected to its cap link, tokens are usually taken locally
+            reason = click_limiter.check(campaign_id, limits)
+            if reason is not None:
+                link = limits["cap_link"] or DEFAULT_CAP_LINK
+        # raw events are buffered in memory and only a full batch is shipped (as a single task) to the writer
+        event_rpc = event_buffer.append(click_event(platform_id, self.request, reason, now)) \
+            if event_buffer.enabled else None
+        if reason is not None:
+            # bots and repeated clicks are redirected, but not counted
+            count_filtered(campaign_id, reason)
+        else:
+            self.count_click(platform_id, counter_shards, visitor, target, now)
+        if event_rpc is not None:
             try:
-                deferred.defer(Platform.increment, platform_id, _countdown=TRACKER_COUNTER_UPDATE_INTERVAL_LENGTH,
-                               _name="%s-%d" % (platform_id, get_interval_index()))
-            except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError), e:
-                pass
-            # TODO: optimize with async operations
-            campaign = Campaign.get_by_id(campaign_id)
-            return webapp2.redirect(campaign.link.encode("utf8"))
+                event_rpc.get_result()
+            except taskqueue.Error, e:
+                logging.exception("Could not ship a batch of click events.")
+        return webapp2.redirect(link.encode("utf8"))
+
+    def count_click(self, platform_id, counter_shards, visitor, target=None, now=None):
+        """
+        Count the click in the current interval and add the visitor to the visitors of the platform. Clicks redirected
+        to a target are also counted for the target, with the same memcache call.
+        """
+        # clicks of sharded platforms are stored into the shards and are counted in memcache only for the statistics
+        shard_future = increment_shard_async(platform_id, counter_shards) if counter_shards else None
+        interval_index = get_interval_index(now)
+        key = counter_key(platform_id, interval_index)
+        if target is None:
+            value = memcache.incr(key, namespace="counters", initial_value=0)
         else:
-            return webapp2.redirect("http://outfit7.com", permanent=True)
+            value = memcache.offset_multi({key: 1, target_counter_key(platform_id, interval_index, target): 1},
+                                          namespace="counters", initial_value=0).get(key)
+        # the visitor is added after the click is counted, sketches of intervals without a counter are not merged
+        uniques_buffer.add(key, visitor)
+        # only the first click in the interval marks the platform dirty, all others are just counted in memcache
+        if value == 1:
+            try:
+                mark_dirty(platform_id, interval_index)
+            except taskqueue.Error, e:
+                logging.exception("Could not mark platform %s as dirty." % platform_id)
+        if shard_future is not None:
+            try:
+                shard_future.get_result()
+            except (datastore_errors.Error, apiproxy_errors.Error), e:
+                # contended shards fail the transaction, the click is still redirected and its shard is incremented
+                # by a retried task
+                logging.warning("Could not store a click of platform %s into its shard, deferring it." % platform_id)
+                try:
+                    deferred.defer(increment_shard, platform_id, counter_shards)
+                except taskqueue.Error, e:
+                    logging.exception("Could not defer a click of platform %s." % platform_id)
+
+
+class CounterFlushHandler(webapp2.RequestHandler):
+    def get(self):
+        """
+        Invoked by cron every COUNTER_FLUSH_CRON_PERIOD seconds. Flushes the pending clicks into the Datastore every
+        TRACKER_COUNTER_UPDATE_INTERVAL_LENGTH seconds until the next invocation is due.
+        """
+        start = time.time()
+        while True:
+            # the sketches buffered by this instance are merged before their intervals are flushed
+            uniques_buffer.merge_due()
+            flushed = flush_counters()
+            logging.info("Flushed clicks of %d platforms." % flushed)
+            if time.time() - start + TRACKER_COUNTER_UPDATE_INTERVAL_LENGTH >= COUNTER_FLUSH_CRON_PERIOD:
+                break
+            time.sleep(TRACKER_COUNTER_UPDATE_INTERVAL_LENGTH)
+
+
+class EventStoreHandler(webapp2.RequestHandler):
+    def get(self):
+        """Invoked by cron every minute. Stores the batches of raw click events shipped by the click handlers."""
+        stored = store_events()
+        logging.info("Stored %d click events." % stored)
+
+
+class CounterAuditHandler(webapp2.RequestHandler):
+    def get(self):
+        """Invoked by cron hourly. Compares the clicks flushed during the last audited hour with the event log."""
+        audit = audit_counters()
+        if audit is not None:
+            logging.info("Audited clicks: %d counted, %d logged, %d replayed." % (audit.counted, audit.logged,
+                                                                                  audit.replayed))
+
+
+class InstanceStartHandler(webapp2.RequestHandler):
+    def get(self):
+        """
+        Invoked by App Engine when a manually or basic scaled instance is started. Starts the background thread that
+        ships the buffers of idle instances. Automatically scaled instances can not run background threads, their
+        buffers are only shipped by the clicks.
+        """
+        try:
+            background_thread.start_new_background_thread(ship_buffers_periodically, [])
+        except background_thread.Error, e:
+            logging.warning("Buffers are shipped by the clicks only, the instance can not run background threads.")
+
+
+class StatsCompactionHandler(webapp2.RequestHandler):
+    def get(self):
+        """Invoked by cron daily. Deletes the click statistics buckets that are older than their retention period."""
+        deleted = compact_buckets()
+        logging.info("Deleted %d click statistics buckets." % deleted)
 
 
-app = ndb.toplevel(webapp2.WSGIApplication([
+app = MetricsMiddleware(ndb.toplevel(webapp2.WSGIApplication([
     routes.PathPrefixRoute('/api', [
         webapp2.Route(r'/campaign/<campaign_id>/platform/<platform_name>', ClickHandler),
-    ])
-], debug=False))
+    ]),
+    routes.PathPrefixRoute('/tasks', [
+        webapp2.Route(r'/counters/flush', CounterFlushHandler),
+        webapp2.Route(r'/counters/audit', CounterAuditHandler),
+        webapp2.Route(r'/stats/compact', StatsCompactionHandler),
+        webapp2.Route(r'/events/store', EventStoreHandler),
+    ]),
+    webapp2.Route(r'/_ah/start', InstanceStartHandler),
+], debug=False)), "tracker")
@@ -0,0 +1,206 @@
+import hashlib
+import logging
+import math
+import threading
+import time
+
+from google.appengine.api import memcache
+
+# number of index bits of the sketches, 2 ** HLL_PRECISION registers give a standard error of about 2.3%
+HLL_PRECISION = 11
+# number of seconds the sketches merged by the click handlers are kept in memcache if they are never flushed
+UNIQUES_CACHE_TIME = 86400
+# value of the sketch of an interval in memcache once the interval is flushed
+FLUSHED_SKETCH = "flushed"
+
+
+class HyperLogLog(object):
+    """HyperLogLog sketch estimating the number of distinct values added to it. Sketches are merged by taking the
+    maximum of every register, so merging is idempotent and the sketch of a union is the merge of the sketches."""
+
+    def __init__(self, registers=None):
+        self.registers = bytearray(registers or 2 ** HLL_PRECISION)
+
+    def add(self, value):
+        """Add the value (a string) to the sketch."""
+        if isinstance(value, unicode):
+            value = value.encode("utf8")
+        hashed = int(hashlib.sha1(value).hexdigest()[:16], 16)
+        index = hashed >> (64 - HLL_PRECISION)
+        # rank is the position of the leftmost 1 bit in the remaining bits
+        rank = 64 - HLL_PRECISION - (hashed & ((1 << (64 - HLL_PRECISION)) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        """Merge the other sketch into this one."""
+        self.registers = bytearray(max(a, b) for a, b in zip(self.registers, other.registers))
+
+    def estimate(self):
+        """Get the estimated number of distinct values added to the sketch."""
+        size = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / size)
+        estimate = alpha * size * size / sum(2.0 ** -register for register in self.registers)
+        zeros = self.registers.count("\x00")
+        if estimate <= 2.5 * size and zeros:
+            # linear counting is more accurate for small cardinalities
+            estimate = size * math.log(float(size) / zeros)
+        return int(round(estimate))
+
+    def to_bytes(self):
+        return str(self.registers)
+
+
+def merge_sketches(*values):
+    """
+    Merge serialized sketches.
+    :param values: Serialized sketches, None values are skipped.
+    :return: Serialized merged sketch or None if all values are None.
+    """
+    values = filter(None, values)
+    if not values:
+        return None
+    sketch = HyperLogLog(values[0])
+    for value in values[1:]:
+        sketch.merge(HyperLogLog(value))
+    return sketch.to_bytes()
+
+
+def estimate_uniques(value):
+    """Get the estimated number of distinct values of a serialized sketch, 0 if it is None."""
+    return HyperLogLog(value).estimate() if value else 0
+
+
+def carried_sketch_key(platform_id):
+    """
+    Get the memcache key (in namespace "uniques") of the sketch of the visitors that were merged after their intervals
+    were flushed, which is carried into the next flush of the platform.
+    :param platform_id: ID of the platform.
+    :return: Memcache key.
+    """
+    return "carried:%s" % platform_id
+
+
+def _carry_sketches(client, pending, current):
+    """
+    Move the pending sketches of the flushed intervals (and of the intervals whose counters are gone) to the carried
+    sketches of their platforms.
+    :return: Tuple of the pending sketches by key and list of the keys of the carried sketches.
+    """
+    missing = [key for key in pending if key not in current and not key.startswith("carried:")]
+    counters = client.get_multi(missing, namespace="counters") if missing else {}
+    result, carried = {}, []
+    for key, value in pending.items():
+        if current.get(key) == FLUSHED_SKETCH or (key in missing and key not in counters):
+            # interval counter keys are "<platform ID>:<interval index>"
+            key = carried_sketch_key(key.rsplit(":", 1)[0])
+            carried.append(key)
+        result[key] = merge_sketches(result.get(key), value)
+    return result, carried
+
+
+def merge_into_memcache(pending):
+    """
+    Merge the serialized sketches into the sketches in memcache with compare-and-set, retrying the conflicting ones.
+    Sketches of flushed intervals are carried into the next flush of their platforms instead.
+    :param pending: Dictionary of memcache keys (of interval counters or carried sketches) and serialized sketches.
+    """
+    client = memcache.Client()
+    for retry in range(3):
+        if not pending:
+            return
+        current = client.get_multi(pending.keys(), namespace="uniques", for_cas=True)
+        pending, carried = _carry_sketches(client, pending, current)
+        carried = [key for key in carried if key not in current]
+        if carried:
+            current.update(client.get_multi(carried, namespace="uniques", for_cas=True))
+        merged = dict((key, merge_sketches(current[key], pending[key])) for key in pending if key in current)
+        added = dict((key, value) for key, value in pending.items() if key not in current)
+        failed = client.cas_multi(merged, time=UNIQUES_CACHE_TIME, namespace="uniques")
+        failed += client.add_multi(added, time=UNIQUES_CACHE_TIME, namespace="uniques")
+        pending = dict((key, pending[key]) for key in failed)
+    if pending:
+        logging.warning("Could not merge the visitor sketches of %d intervals." % len(pending))
+
+
+def close_sketches(client, keys, read):
+    """
+    Replace the sketches of the flushed intervals in memcache by FLUSHED_SKETCH, so that the visitors merged after
+    the flush are carried into the next flush of their platforms instead of being lost. Sketches merged between the
+    read and the replacement are carried as well, merging is idempotent, so the visitors that were already flushed are
+    not counted twice by the platforms.
+    :param client: memcache.Client that read the sketches with for_cas.
+    :param keys: Memcache keys of the flushed intervals.
+    :param read: Dictionary of the keys and the sketches read by the flush.
+    """
+    failed = client.cas_multi(dict((key, FLUSHED_SKETCH) for key in keys if key in read), time=UNIQUES_CACHE_TIME,
+                              namespace="uniques")
+    failed += client.add_multi(dict((key, FLUSHED_SKETCH) for key in keys if key not in read),
+                               time=UNIQUES_CACHE_TIME, namespace="uniques")
+    late = {}
+    for retry in range(3):
+        if not failed:
+            break
+        current = client.get_multi(failed, namespace="uniques", for_cas=True)
+        replaced = dict((key, current[key]) for key in failed if current.get(key, FLUSHED_SKETCH) != FLUSHED_SKETCH)
+        failed = client.cas_multi(dict((key, FLUSHED_SKETCH) for key in replaced), time=UNIQUES_CACHE_TIME,
+                                  namespace="uniques")
+        for key, value in replaced.items():
+            if key not in failed:
+                carried_key = carried_sketch_key(key.rsplit(":", 1)[0])
+                late[carried_key] = merge_sketches(late.get(carried_key), value)
+    merge_into_memcache(late)
+
+
+def visitor_id(request):
+    """Get the identifier of the visitor making the request, derived from the IP address and the user agent."""
+    return "%s %s" % (request.remote_addr, request.headers.get("User-Agent", ""))
+
+
+class UniquesBuffer(object):
+    """
+    In-memory sketches of the visitors of the platforms clicked on this instance, by memcache counter key (platform
+    and interval). Once the oldest sketch is max_age seconds old, all sketches are merged into the sketches in memcache
+    (namespace "uniques"), from which they are stored into the Datastore together with the counters.
+    """
+
+    def __init__(self, max_age):
+        self.max_age = max_age
+        self._sketches = {}
+        self._started_at = None
+        self._lock = threading.Lock()
+
+    def add(self, key, visitor):
+        """
+        Add the visitor to the sketch of the key, merging the buffered sketches into memcache if they are due.
+        :param key: Memcache key of the platform interval counter.
+        :param visitor: Identifier of the visitor.
+        """
+        with self._lock:
+            if not self._sketches:
+                self._started_at = time.time()
+            sketch = self._sketches.get(key)
+            if sketch is None:
+                sketch = self._sketches[key] = HyperLogLog()
+            sketch.add(visitor)
+            if time.time() - self._started_at < self.max_age:
+                return
+            sketches, self._sketches = self._sketches, {}
+        self._merge(sketches)
+
+    def merge(self):
+        """Merge the buffered sketches into memcache regardless of their age."""
+        with self._lock:
+            sketches, self._sketches = self._sketches, {}
+        self._merge(sketches)
+
+    def merge_due(self):
+        """Merge the buffered sketches if the oldest one is max_age seconds old, without waiting for the next click."""
+        with self._lock:
+            if not self._sketches or time.time() - self._started_at < self.max_age:
+                return
+            sketches, self._sketches = self._sketches, {}
+        self._merge(sketches)
+
+    def _merge(self, sketches):
+        merge_into_memcache(dict((key, sketch.to_bytes()) for key, sketch in sketches.items()))